@@ -0,0 +1,14 @@
+"""
+Benchmarks of the generation pipeline. Run them from the repository root, e.g.
+`python -m benchmarks.import_time`, or all of them with `python -m benchmarks.run`.
+"""
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The pipeline modules import each other as top-level modules, like the CLIs do.
+MODULES_DIR = os.path.join(REPO_DIR, "modules")
+
+if MODULES_DIR not in sys.path:
+    sys.path.insert(0, MODULES_DIR)
@@ -0,0 +1,104 @@
+import argparse
+from typing import Dict, List
+
+from benchmarks.fixtures import median_seconds, quiet, workdir, write_results
+from cache import SEMANTIC_CACHE, get_cache, get_semantic_cache
+from llms import GPT_CACHE, SONNET_CACHE, _calculate_hash, _gpt_messages, gpt4, sonnet
+
+ENTRIES = [100, 10_000]
+
+_SYSTEM_PROMPT = "You are a helpful assistant.\n\n# Guidelines\nAnswer briefly."
+
+
+def _user_prompt(i: int) -> str:
+    return f"Benchmark prompt {i}: what matters when choosing between A and B?"
+
+
+def _fill(entries: int, start: int = 0):
+    """Cache a gpt and a sonnet response for the prompts `start` to `entries`."""
+    gpt_cache = get_cache(GPT_CACHE)
+    sonnet_cache = get_cache(SONNET_CACHE)
+    for i in range(start, entries):
+        messages = _gpt_messages(_user_prompt(i), _SYSTEM_PROMPT)
+        gpt_cache.set(_calculate_hash(messages), f"gpt response {i}")
+        sonnet_cache.set(
+            _calculate_hash([_SYSTEM_PROMPT, _user_prompt(i)]), f"sonnet response {i}"
+        )
+        if SEMANTIC_CACHE:
+            get_semantic_cache(GPT_CACHE).set(messages, f"gpt response {i}")
+
+
+def measure_hits(entries: int, calls: int = 1000, repeat: int = 5) -> dict:
+    """
+    Measure cache hits of `gpt4()` and `sonnet()` on a cache of `entries` responses.
+
+    Returns:
+        dict: The median microseconds per exact hit of `gpt4()` and `sonnet()`, and per
+            hit of `gpt4()` that only the second-tier cache of normalized prompts serves,
+            over `repeat` rounds of `calls` calls.
+    """
+    prompts = [_user_prompt(i * entries // calls) for i in range(calls)]
+    calls_by_name = {
+        "gpt4_hit_us": lambda p: gpt4(p, _SYSTEM_PROMPT),
+        "sonnet_hit_us": lambda p: sonnet(p, _SYSTEM_PROMPT),
+    }
+    if SEMANTIC_CACHE:
+        # Prompts that only differ in whitespace miss the exact cache.
+        calls_by_name["gpt4_normalized_hit_us"] = lambda p: gpt4(
+            f"  {p}\n", _SYSTEM_PROMPT
+        )
+
+    results = {}
+    with quiet():
+        for name, call in calls_by_name.items():
+            seconds = median_seconds(lambda: [call(p) for p in prompts], repeat)
+            results[name] = seconds / calls * 1e6
+    return results
+
+
+def run(entries: List[int] = ENTRIES, calls: int = 1000) -> Dict[str, dict]:
+    """Measure the hits on caches of growing sizes, filling the same cache further for each."""
+    results = {}
+    with workdir():
+        filled = 0
+        for n in sorted(entries):
+            _fill(n, filled)
+            filled = n
+            results[f"entries={n}"] = measure_hits(n, calls)
+    return results
+
+
+if __name__ == "__main__":
+    """Measure the cache hit path of the LLM calls."""
+
+    parser = argparse.ArgumentParser(
+        description="Measure how long gpt4() and sonnet() take to serve a cached response."
+    )
+    parser.add_argument(
+        "--entries",
+        type=int,
+        nargs="*",
+        default=ENTRIES,
+        help="The numbers of cached responses to measure the hits with.",
+    )
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=1000,
+        help="The number of calls to average over.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the results to this JSON file.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.entries, args.calls)
+    for entries, result in results.items():
+        print(entries)
+        for metric, value in result.items():
+            print(f"  {metric:<24} {value:10.1f}")
+
+    if args.output:
+        write_results(args.output, "cache_hits", results)
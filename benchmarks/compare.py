@@ -0,0 +1,93 @@
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+# Metrics with these suffixes are better when higher, all others when lower.
+HIGHER_IS_BETTER = ("_per_second",)
+
+
+def load_metrics(path: str) -> Dict[str, float]:
+    """
+    Load the numeric metrics of a results file of `benchmarks.run`, or of a single
+    benchmark, flattened to "benchmark.configuration.metric" paths.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    if "benchmarks" in data:
+        benchmarks = data["benchmarks"]
+    else:
+        benchmarks = {data["benchmark"]: data["results"]}
+    return dict(_flatten(benchmarks))
+
+
+def _flatten(data: dict, prefix: str = "") -> List[Tuple[str, float]]:
+    metrics = []
+    for key, value in data.items():
+        if isinstance(value, dict):
+            metrics += _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics.append((f"{prefix}{key}", float(value)))
+    return metrics
+
+
+def compare(
+    baseline: Dict[str, float], current: Dict[str, float], threshold: float = 0.2
+) -> List[dict]:
+    """
+    Compare the metrics both results have.
+
+    Returns:
+        List[dict]: Per metric, the baseline and current value, the relative change, and
+            whether it got worse by more than `threshold` (e.g. 0.2 for 20%).
+    """
+    rows = []
+    for metric in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[metric], current[metric]
+        change = (after - before) / before if before else 0.0
+        worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+        rows.append(
+            {
+                "metric": metric,
+                "baseline": before,
+                "current": after,
+                "change": change,
+                "regression": worse > threshold,
+            }
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    """Compare benchmark results, e.g. of two commits."""
+
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark result files, and fail on regressions."
+    )
+    parser.add_argument("baseline", type=str, help="The results to compare against.")
+    parser.add_argument("current", type=str, help="The new results.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Fail if a metric got worse by more than this fraction.",
+    )
+    args = parser.parse_args()
+
+    for path in [args.baseline, args.current]:
+        with open(path, "r") as f:
+            if json.load(f).get("quick"):
+                print(
+                    f"Note: {path} is from a quick run, compare it to quick runs only."
+                )
+    rows = compare(
+        load_metrics(args.baseline), load_metrics(args.current), args.threshold
+    )
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['metric']:<70} {row['baseline']:14.4f} {row['current']:14.4f} {row['change']:+8.1%}{flag}"
+        )
+    regressions = [row for row in rows if row["regression"]]
+    print(f"{len(rows)} metrics compared, {len(regressions)} regressions.")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,111 @@
+import argparse
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, List
+
+from benchmarks.fixtures import (
+    FakeProvider,
+    median_seconds,
+    quiet,
+    workdir,
+    write_results,
+)
+from providers import set_provider
+from utils import gp4o_price
+
+CLUSTER_SIZES = [10, 100, 500]
+
+
+def measure_dedupe_card(
+    cluster_size: int, repeat: int = 5, latency: float = 0.0
+) -> dict:
+    """
+    Measure what deduplicating one card against a cluster of `cluster_size` cards costs,
+    i.e. one `_fetch_duplicate_card` call, against a `FakeProvider`.
+
+    Returns:
+        dict: The seconds, prompt tokens and dollars per card, or the error if
+            deduplicate.py can't be imported.
+    """
+    try:
+        import deduplicate
+    except ImportError as e:
+        # deduplicate.py needs a generated Prisma client.
+        return {"error": f"Can't import deduplicate: {e}"}
+
+    set_provider(FakeProvider(median=latency, sigma=0.0))
+    cards = [
+        SimpleNamespace(
+            id=i,
+            title=f"Card {i}",
+            policies=[f"MOMENTS when policy {j} of card {i} applies" for j in range(4)],
+        )
+        for i in range(cluster_size + repeat)
+    ]
+    # Every call is for a different card, so none is served from the cache.
+    candidates = iter(cards[cluster_size:])
+    deduplicate.counter.clear()
+    with quiet():
+        seconds = median_seconds(
+            lambda: deduplicate._fetch_duplicate_card(
+                next(candidates), cards[:cluster_size]  # type: ignore
+            ),
+            repeat,
+        )
+    tokens: Counter = deduplicate.counter
+    return {
+        "seconds_per_card": seconds,
+        "prompt_tokens_per_card": tokens["prompt_tokens"] / repeat,
+        "dollars_per_card": gp4o_price(tokens) / repeat,
+    }
+
+
+def run(
+    cluster_sizes: List[int] = CLUSTER_SIZES, repeat: int = 5, latency: float = 0.0
+) -> Dict[str, dict]:
+    with workdir():
+        return {
+            f"cluster={n}": measure_dedupe_card(n, repeat, latency)
+            for n in cluster_sizes
+        }
+
+
+if __name__ == "__main__":
+    """Measure the cost of deduplicating a card."""
+
+    parser = argparse.ArgumentParser(
+        description="Measure the time, tokens and dollars of deduplicating one card, against a fake provider."
+    )
+    parser.add_argument(
+        "--cluster_sizes",
+        type=int,
+        nargs="*",
+        default=CLUSTER_SIZES,
+        help="The numbers of cards to deduplicate a card against.",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="The latency of the fake provider, in seconds. 0 measures only the overhead.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the results to this JSON file.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.cluster_sizes, args.repeat, args.latency)
+    for cluster, result in results.items():
+        if "error" in result:
+            print(f"{cluster:<14} failed: {result['error']}")
+            continue
+        print(
+            f"{cluster:<14} {result['seconds_per_card'] * 1000:8.2f}ms  "
+            f"{result['prompt_tokens_per_card']:8.0f} tokens  ${result['dollars_per_card']:.4f} per card"
+        )
+
+    if args.output:
+        write_results(args.output, "dedupe", results)
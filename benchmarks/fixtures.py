@@ -0,0 +1,146 @@
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Iterator
+
+from benchmarks import REPO_DIR
+from graph import Edge, EdgeMetadata, MoralGraph, Value, ValuesData
+from providers import Completion, ReplayProvider
+
+
+class FakeProvider(ReplayProvider):
+    """
+    Serves synthetic responses (see `synthetic_completion`) after a random delay.
+
+    Delays follow a log-normal distribution, like real provider latencies: most calls
+    take about `median` seconds, and a few take much longer.
+
+    Attributes:
+        median (float): The median delay, in seconds.
+        sigma (float): The spread of the delays. 0 delays every call by `median`.
+    """
+
+    def __init__(self, median: float = 0.05, sigma: float = 0.5, seed: int = 0):
+        super().__init__(trace_file=None, latency=None)
+        self.median = median
+        self.sigma = sigma
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def _lookup(
+        self, provider: str, params: dict, allow_partial: bool = False
+    ) -> tuple[Completion, float]:
+        completion, _ = super()._lookup(provider, params, allow_partial)
+        if not self.median:
+            return completion, 0.0
+        with self._rng_lock:
+            completion.latency = self._rng.lognormvariate(
+                math.log(self.median), self.sigma
+            )
+        return completion, completion.latency
+
+
+def synthetic_graph(
+    n_values: int, n_contexts: int | None = None, seed: int = 0
+) -> MoralGraph:
+    """
+    A moral graph of `n_values` values with one edge into every value but the first.
+
+    Edges go from an earlier value, under one of `n_contexts` contexts (by default the
+    square root of `n_values`), so each context has about as many edges as there are
+    contexts. Contexts have a fixed width so none is a substring of another.
+    """
+    rng = random.Random(seed)
+    n_contexts = n_contexts or max(1, int(math.sqrt(n_values)))
+    contexts = [f"Choices about topic {i:07d}" for i in range(n_contexts)]
+    values = [
+        Value(
+            ValuesData(
+                f"Value {i}",
+                [f"MOMENTS when policy {j} of value {i} applies" for j in range(3)],
+                rng.choice(contexts),
+            )
+        )
+        for i in range(n_values)
+    ]
+    edges = [
+        Edge(
+            values[rng.randrange(i)].id,
+            values[i].id,
+            rng.choice(contexts),
+            EdgeMetadata(
+                f"A story of how value {i} came to be.",
+                f"Context shifts {i}",
+                {"problem": f"problem {i}"},
+                [{"improvement": f"improvement {i}"}],
+            ),
+        )
+        for i in range(1, n_values)
+    ]
+    return MoralGraph(
+        values, edges, [f"Seed question {i}" for i in range(n_values // 4)]
+    )
+
+
+def median_seconds(fn: Callable[[], object], repeat: int = 5) -> float:
+    """The median time `fn` takes over `repeat` calls, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+@contextlib.contextmanager
+def workdir() -> Iterator[str]:
+    """Run in an empty temporary working directory, so caches, journals and traces start empty."""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(previous)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress output of the code under benchmark."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+        io.StringIO()
+    ):
+        yield
+
+
+def environment() -> dict:
+    """The commit and machine the benchmarks ran on."""
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=REPO_DIR
+    ).stdout.strip()
+    return {
+        "commit": commit or None,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path: str, benchmark: str, results: dict):
+    """Write the results of a benchmark to a JSON file, for `benchmarks.compare`."""
+    with open(path, "w") as f:
+        json.dump(
+            {"benchmark": benchmark, "environment": environment(), "results": results},
+            f,
+            indent=2,
+        )
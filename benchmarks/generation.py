@@ -0,0 +1,99 @@
+import argparse
+import time
+from typing import Dict, List
+
+from benchmarks.fixtures import FakeProvider, quiet, workdir, write_results
+from generate import generate_graph
+from providers import set_provider
+
+WORKERS = [1, 4, 16]
+
+
+def measure_generation(
+    n_questions: int,
+    n_hops: int,
+    workers: int = 1,
+    pipelined: bool = False,
+    latency: float = 0.05,
+) -> dict:
+    """
+    Generate a graph for `n_questions` made-up seed questions against a `FakeProvider`.
+
+    Returns:
+        dict: The questions generated per second, and the total seconds.
+    """
+    set_provider(FakeProvider(median=latency))
+    questions = [
+        f"Benchmark question {i}: what should I do?" for i in range(n_questions)
+    ]
+    mode = "pipelined" if pipelined else f"workers{workers}"
+    start = time.perf_counter()
+    with quiet():
+        graph = generate_graph(
+            questions,
+            n_hops=n_hops,
+            workers=workers,
+            pipelined=pipelined,
+            run_name=f"benchmark-{mode}-{time.time_ns()}",
+        )
+    seconds = time.perf_counter() - start
+    return {
+        "questions_per_second": len(graph.seed_questions) / seconds,
+        "seconds": seconds,
+    }
+
+
+def run(
+    workers: List[int] = WORKERS,
+    n_questions: int = 32,
+    n_hops: int = 1,
+    latency: float = 0.05,
+) -> Dict[str, dict]:
+    results = {}
+    with workdir():
+        for n in workers:
+            results[f"workers={n}"] = measure_generation(
+                n_questions, n_hops, workers=n, latency=latency
+            )
+        results["pipelined"] = measure_generation(
+            n_questions, n_hops, pipelined=True, latency=latency
+        )
+    return results
+
+
+if __name__ == "__main__":
+    """Measure generation throughput at several concurrency levels."""
+
+    parser = argparse.ArgumentParser(
+        description="Measure questions per second through generate_graph, against a fake provider."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="*",
+        default=WORKERS,
+        help="The numbers of concurrent questions to measure.",
+    )
+    parser.add_argument("--n_questions", type=int, default=32)
+    parser.add_argument("--n_hops", type=int, default=1)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="The median latency of the fake provider, in seconds.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the results to this JSON file.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.workers, args.n_questions, args.n_hops, args.latency)
+    for mode, result in results.items():
+        print(
+            f"{mode:<12} {result['questions_per_second']:8.2f} questions/s  {result['seconds']:.2f}s"
+        )
+
+    if args.output:
+        write_results(args.output, "generation", results)
@@ -0,0 +1,171 @@
+import argparse
+import os
+import random
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from benchmarks.fixtures import median_seconds, synthetic_graph, workdir, write_results
+from binary_graph import TOPOLOGY, read_compact_graph
+from compact_graph import CompactMoralGraph
+from graph import MoralGraph
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def peak_memory_mb(fn: Callable[[], object]) -> float:
+    """The peak memory allocated while `fn` runs, in MB."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory_mb(fn: Callable[[], object]) -> float:
+    """The memory still allocated when `fn` returns, while its result is alive, in MB."""
+    tracemalloc.start()
+    try:
+        result = fn()  # noqa: F841 (kept alive while measuring)
+        return tracemalloc.get_traced_memory()[0] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def measure_graph(n_values: int, repeat: int = 3, winning_values: bool = True) -> dict:
+    """
+    Measure the graph operations on a synthetic graph of `n_values` values.
+
+    Returns:
+        dict: The seconds per call of `get_winning_values` (over random contexts),
+            `get_winning_values_table` (of all contexts), `to_json`, `save_to_file` and
+            `from_file`, the values per second and MB per second of saving and
+            loading, their peak memory in MB, the MB that a loaded `MoralGraph` and
+            `CompactMoralGraph` take, and the size and seconds to save and load the
+            graph as a binary graph file.
+    """
+    graph = synthetic_graph(n_values)
+    rng = random.Random(0)
+    contexts = [
+        e.context for e in rng.sample(graph.edges, min(repeat, len(graph.edges)))
+    ]
+    results = {}
+
+    if winning_values:
+        queries = iter(contexts * repeat)
+        results["get_winning_values_seconds"] = median_seconds(
+            lambda: graph.get_winning_values(next(queries)), repeat
+        )
+
+    results["winning_values_table_seconds"] = median_seconds(
+        graph.get_winning_values_table, repeat
+    )
+    results["to_json_seconds"] = median_seconds(graph.to_json, repeat)
+    path = os.path.abspath("graph.json")
+    save_seconds = median_seconds(lambda: graph.save_to_file(path), repeat)
+    file_mb = os.path.getsize(path) / 1e6
+    load_seconds = median_seconds(lambda: MoralGraph.from_file(path), repeat)
+    results.update(
+        {
+            "save_to_file_seconds": save_seconds,
+            "save_to_file_values_per_second": n_values / save_seconds,
+            "save_to_file_mb_per_second": file_mb / save_seconds,
+            "save_to_file_peak_mb": peak_memory_mb(lambda: graph.save_to_file(path)),
+            "from_file_seconds": load_seconds,
+            "from_file_values_per_second": n_values / load_seconds,
+            "from_file_mb_per_second": file_mb / load_seconds,
+            "from_file_peak_mb": peak_memory_mb(lambda: MoralGraph.from_file(path)),
+            "file_mb": file_mb,
+            "graph_mb": retained_memory_mb(lambda: MoralGraph.from_file(path)),
+            "compact_graph_mb": retained_memory_mb(
+                lambda: CompactMoralGraph.from_file(path)
+            ),
+        }
+    )
+
+    binary_path = os.path.abspath("graph.mgraph")
+    compact = CompactMoralGraph.from_file(path)
+    results.update(
+        {
+            "save_binary_seconds": median_seconds(
+                lambda: graph.save_to_file(binary_path), repeat
+            ),
+            "save_compact_binary_seconds": median_seconds(
+                lambda: compact.save_to_file(binary_path), repeat
+            ),
+            "binary_file_mb": os.path.getsize(binary_path) / 1e6,
+            "from_binary_seconds": median_seconds(
+                lambda: MoralGraph.from_file(binary_path), repeat
+            ),
+            "from_binary_compact_seconds": median_seconds(
+                lambda: CompactMoralGraph.from_file(binary_path), repeat
+            ),
+            "from_binary_topology_seconds": median_seconds(
+                lambda: read_compact_graph(binary_path, TOPOLOGY), repeat
+            ),
+        }
+    )
+    return results
+
+
+def run(
+    sizes: List[int] = SIZES, repeat: int = 3, max_seconds: float = 30.0
+) -> Dict[str, dict]:
+    """
+    Measure every graph size, from small to large. Once `get_winning_values` takes longer
+    than `max_seconds` on a size, it is skipped on the larger sizes.
+    """
+    results = {}
+    winning_values = True
+    with workdir():
+        for n in sorted(sizes):
+            start = time.perf_counter()
+            results[f"values={n}"] = measure_graph(n, repeat, winning_values)
+            seconds = results[f"values={n}"].get("get_winning_values_seconds", 0.0)
+            if seconds > max_seconds:
+                winning_values = False
+            print(f"Measured {n} values in {time.perf_counter() - start:.1f}s")
+    return results
+
+
+if __name__ == "__main__":
+    """Measure the graph operations on synthetic graphs."""
+
+    parser = argparse.ArgumentParser(
+        description="Measure get_winning_values, serialization and loading of synthetic graphs."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=SIZES,
+        help="The numbers of values of the synthetic graphs, e.g. `1000 1000000`.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="The number of times to repeat each measurement, reporting the median.",
+    )
+    parser.add_argument(
+        "--max_seconds",
+        type=float,
+        default=30.0,
+        help="Stop measuring get_winning_values on larger graphs once it takes this long.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the results to this JSON file.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat, args.max_seconds)
+    for size, result in results.items():
+        print(size)
+        for metric, value in result.items():
+            print(f"  {metric:<34} {value:12.4f}")
+
+    if args.output:
+        write_results(args.output, "graph_ops", results)
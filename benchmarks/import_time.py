@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+from benchmarks import MODULES_DIR
+
+# Modules the CLIs import, which should start fast.
+MODULES = ["generate", "coordinator", "seeds", "graph", "llms", "cache"]
+
+# Dependencies that take long to import, and should only load once they are used.
+HEAVY_DEPENDENCIES = [
+    "anthropic",
+    "openai",
+    "httpx",
+    "prisma",
+    "networkx",
+    "numpy",
+    "tqdm",
+    "datasets",
+]
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure_import(module: str, runs: int = 5) -> dict:
+    """
+    Import a module in fresh interpreters, from an empty working directory.
+
+    Returns:
+        dict: The median import time in seconds, the heavy dependencies the import
+            loaded, and the slowest imports by cumulative time of the last run.
+    """
+    times = []
+    env = {**os.environ, "PYTHONPATH": MODULES_DIR}
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(runs):
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "-X",
+                    "importtime",
+                    "-c",
+                    _MEASURE.format(module=module, heavy=HEAVY_DEPENDENCIES),
+                ],
+                capture_output=True,
+                text=True,
+                cwd=cwd,
+                env=env,
+            )
+            if process.returncode != 0:
+                error = process.stderr.strip().splitlines()[-1]
+                return {"seconds": None, "heavy": [], "slowest": [], "error": error}
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            times.append(result["seconds"])
+
+    return {
+        "seconds": statistics.median(times),
+        "heavy": result["heavy"],
+        "slowest": _slowest_imports(process.stderr),
+    }
+
+
+def _slowest_imports(importtime_log: str, n: int = 5) -> List[List]:
+    # Lines look like "import time:  self [us] | cumulative | imported package".
+    imports = []
+    for line in importtime_log.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        imports.append([parts[2].strip(), int(parts[1]) / 1e6])
+    return sorted(imports, key=lambda i: i[1], reverse=True)[:n]
+
+
+def run(modules: List[str], runs: int = 5) -> Dict[str, dict]:
+    return {module: measure_import(module, runs) for module in modules}
+
+
+if __name__ == "__main__":
+    """Measure how long importing the CLI modules takes."""
+
+    parser = argparse.ArgumentParser(
+        description="Measure the import time of the pipeline modules."
+    )
+    parser.add_argument(
+        "--modules",
+        nargs="*",
+        default=MODULES,
+        help="The modules to import.",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="The number of fresh interpreters to import each module in.",
+    )
+    parser.add_argument(
+        "--max_seconds",
+        type=float,
+        help="Fail if a module takes longer than this to import, or loads a heavy dependency.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the results to this JSON file.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.modules, args.runs)
+    failed = False
+    for module, result in results.items():
+        if result["seconds"] is None:
+            print(f"{module:<14} failed: {result['error']}")
+            failed = True
+            continue
+        heavy = ", ".join(result["heavy"]) or "-"
+        print(f"{module:<14} {result['seconds']:.3f}s  heavy imports: {heavy}")
+        for name, seconds in result["slowest"]:
+            print(f"{'':<16}{seconds:.3f}s  {name}")
+        if args.max_seconds is not None and (
+            result["seconds"] > args.max_seconds or result["heavy"]
+        ):
+            failed = True
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "import_time", "results": results}, f, indent=2)
+
+    sys.exit(1 if failed else 0)
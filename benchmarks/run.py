@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+from benchmarks import REPO_DIR
+from benchmarks.fixtures import environment
+
+# The benchmarks of the suite, with the arguments of a full and a quick run.
+SUITE = {
+    "import_time": {"full": [], "quick": ["--runs", "3"]},
+    "generation": {"full": [], "quick": ["--n_questions", "16"]},
+    "graph_ops": {"full": [], "quick": ["--sizes", "1000", "10000"]},
+    "dedupe": {"full": [], "quick": ["--cluster_sizes", "10", "100"]},
+    "cache_hits": {"full": [], "quick": ["--entries", "100", "1000"]},
+}
+
+
+def run_benchmark(name: str, args: List[str]) -> dict:
+    """Run a benchmark in a fresh interpreter, returning its results or its error."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, f"{name}.json")
+        process = subprocess.run(
+            [sys.executable, "-m", f"benchmarks.{name}", *args, "--output", output],
+            capture_output=True,
+            text=True,
+            cwd=REPO_DIR,
+        )
+        if not os.path.exists(output):
+            lines = (process.stderr or process.stdout).strip().splitlines()
+            return {"error": lines[-1] if lines else f"exit code {process.returncode}"}
+        with open(output, "r") as f:
+            return json.load(f)["results"]
+
+
+def run(names: List[str], quick: bool = False) -> Dict[str, dict]:
+    results = {}
+    for name in names:
+        print(f"Running {name}...")
+        results[name] = run_benchmark(name, SUITE[name]["quick" if quick else "full"])
+        if "error" in results[name]:
+            print(f"{name} failed: {results[name]['error']}")
+    return results
+
+
+if __name__ == "__main__":
+    """Run the benchmark suite and write its results, to compare them between commits."""
+
+    parser = argparse.ArgumentParser(
+        description="Run all benchmarks, each in a fresh interpreter, and write the results to a JSON file."
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="*",
+        choices=list(SUITE),
+        default=list(SUITE),
+        help="The benchmarks to run.",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Run smaller versions of the benchmarks, e.g. for every commit.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./benchmark_results.json",
+        help="The JSON file to write the results to.",
+    )
+    args = parser.parse_args()
+
+    results = run(args.benchmarks, args.quick)
+    with open(args.output, "w") as f:
+        json.dump(
+            {"environment": environment(), "quick": args.quick, "benchmarks": results},
+            f,
+            indent=2,
+        )
+    print(f"Results written to {args.output}")
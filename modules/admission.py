@@ -0,0 +1,261 @@
+import argparse
+from collections import Counter
+import json
+import os
+import threading
+import time
+from typing import Dict
+
+from utils import BATCH_DISCOUNT, gp4o_price, sonnet_price
+
+PROVIDERS = ["gpt", "sonnet"]
+# The most calls to a provider in flight at once. Rate limit errors lower the limit.
+MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 64))
+# How long after lowering the concurrency limit further rate limit errors are ignored,
+# since they were most likely caused by calls that started before it was lowered.
+DECREASE_COOLDOWN = 5.0
+# How long to wait before checking again for a free concurrency slot, in seconds.
+_POLL_INTERVAL = 0.05
+
+
+class BudgetExceeded(Exception):
+    """Raised instead of a provider call once the run has spent its cost or token budget."""
+
+
+class TokenBucket:
+    """
+    Paces a rate per minute, allowing bursts of up to `burst_seconds` worth of it.
+
+    Attributes:
+        per_minute (float): The rate, e.g. requests or tokens per minute.
+        capacity (float): The largest burst.
+        tokens (float): The amount that can be taken right now. Can be negative after
+            `charge`, which makes later takers wait until it is paid back.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, per_minute / 60 * burst_seconds)
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        """How long until `amount` can be taken, in seconds."""
+        self._refill()
+        # Amounts larger than the capacity can be taken once the bucket is full.
+        needed = min(amount, self.capacity) - self.tokens
+        return max(0.0, needed / (self.per_minute / 60))
+
+    def charge(self, amount: float):
+        """Take `amount`, even if that leaves the bucket in debt."""
+        self._refill()
+        self.tokens -= amount
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self._updated_at) * self.per_minute / 60,
+        )
+        self._updated_at = now
+
+
+class AdmissionController:
+    """
+    Admits provider calls within a run's budget and the providers' rate limits.
+
+    A call waits until its provider has a free concurrency slot and its requests- and
+    tokens-per-minute buckets allow it. The concurrency limit of a provider adapts to
+    rate limit errors (additive increase, multiplicative decrease): it halves on a rate
+    limit error and grows back by one slot for every limit's worth of successful calls.
+    Once the spent cost or tokens reach the budget, calls raise `BudgetExceeded`. Calls
+    in flight at that moment still finish, so a run can overshoot its budget by those.
+    Spending is only counted in this process, so the budget limits one invocation: a
+    resumed run gets the full budget again.
+
+    Attributes:
+        max_cost (float | None): The budget in dollars.
+        max_tokens (int | None): The budget in input and output tokens, of all providers.
+        rpm (Dict[str, float]): Requests per minute per provider.
+        tpm (Dict[str, float]): Tokens per minute per provider. The input tokens of a
+            call are estimated before the call, and its output tokens charged after.
+        max_concurrency (int): The highest concurrency limit per provider.
+        spent_cost (float): The cost of the calls so far, in dollars.
+        spent_tokens (int): The input and output tokens of the calls so far.
+    """
+
+    def __init__(
+        self,
+        max_cost: float | None = None,
+        max_tokens: int | None = None,
+        rpm: Dict[str, float] | None = None,
+        tpm: Dict[str, float] | None = None,
+        max_concurrency: int = MAX_CONCURRENCY,
+    ):
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.rpm = rpm or {}
+        self.tpm = tpm or {}
+        self.max_concurrency = max_concurrency
+        self.spent_cost = 0.0
+        self.spent_tokens = 0
+        self._request_buckets = {p: TokenBucket(r) for p, r in self.rpm.items()}
+        self._token_buckets = {p: TokenBucket(t) for p, t in self.tpm.items()}
+        self._limits = {p: float(max_concurrency) for p in PROVIDERS}
+        self._in_flight = Counter()
+        self._decreased_at = {p: 0.0 for p in PROVIDERS}
+        self._lock = threading.Lock()
+
+    def check_budget(self):
+        """Raise `BudgetExceeded` if the budget is spent."""
+        if self.max_cost is not None and self.spent_cost >= self.max_cost:
+            raise BudgetExceeded(
+                f"Spent ${self.spent_cost:.2f} of the ${self.max_cost:.2f} budget"
+            )
+        if self.max_tokens is not None and self.spent_tokens >= self.max_tokens:
+            raise BudgetExceeded(
+                f"Spent {self.spent_tokens} of the {self.max_tokens} token budget"
+            )
+
+    def try_admit(self, provider: str, tokens: int) -> float:
+        """
+        Admit a call of about `tokens` input tokens if the limits allow it.
+
+        Returns:
+            float: 0 if the call was admitted, or how long to wait before trying again.
+        """
+        with self._lock:
+            self.check_budget()
+            if self._in_flight[provider] >= int(self._limits[provider]):
+                return _POLL_INTERVAL
+            requests = self._request_buckets.get(provider)
+            token_bucket = self._token_buckets.get(provider)
+            wait = max(
+                requests.wait_time(1) if requests else 0.0,
+                token_bucket.wait_time(tokens) if token_bucket else 0.0,
+            )
+            if wait > 0:
+                return wait
+            if requests:
+                requests.charge(1)
+            if token_bucket:
+                token_bucket.charge(tokens)
+            self._in_flight[provider] += 1
+            return 0.0
+
+    def admit(self, provider: str, tokens: int):
+        """Block until a call is admitted."""
+        while (wait := self.try_admit(provider, tokens)) > 0:
+            time.sleep(wait)
+
+    def release(self, provider: str, rate_limited: bool = False):
+        """Free the slot of a finished call, adapting the concurrency limit to its outcome."""
+        with self._lock:
+            self._in_flight[provider] -= 1
+            limit = self._limits[provider]
+            if not rate_limited:
+                self._limits[provider] = min(self.max_concurrency, limit + 1 / limit)
+            elif time.monotonic() - self._decreased_at[provider] > DECREASE_COOLDOWN:
+                self._limits[provider] = max(1.0, limit / 2)
+                self._decreased_at[provider] = time.monotonic()
+                print(
+                    f"{provider} is rate limited, lowering its concurrency to {int(self._limits[provider])}."
+                )
+
+    def record(self, provider: str, usage: Dict[str, int], batch: bool = False):
+        """Add the usage of a response to the spent budget, at a discount for batches."""
+        prefix = "sonnet_" if provider == "sonnet" else ""
+        counter = Counter({prefix + key: count for key, count in usage.items()})
+        cost = gp4o_price(counter) + sonnet_price(counter)
+        with self._lock:
+            self.spent_cost += cost * BATCH_DISCOUNT if batch else cost
+            self.spent_tokens += usage.get("prompt_tokens", 0) + usage.get(
+                "completion_tokens", 0
+            )
+            token_bucket = self._token_buckets.get(provider)
+            if token_bucket:
+                token_bucket.charge(usage.get("completion_tokens", 0))
+
+    def concurrency(self, provider: str) -> int:
+        """The current concurrency limit of a provider."""
+        return int(self._limits[provider])
+
+
+def estimate_tokens(params: dict) -> int:
+    """A rough estimate of the input tokens of a request, at four characters per token."""
+    prompt = json.dumps([params.get("system"), params.get("messages")], default=str)
+    return len(prompt) // 4
+
+
+def estimated_usage(params: dict, text: str | None) -> dict:
+    """
+    A rough estimate of the usage of a request whose provider reported none, e.g. a
+    stream that was closed before its final usage chunk.
+    """
+    return {
+        "prompt_tokens": estimate_tokens(params),
+        "completion_tokens": len(text or "") // 4,
+        "cached_prompt_tokens": 0,
+    }
+
+
+_controller = AdmissionController()
+
+
+def configure_admission(
+    max_cost: float | None = None,
+    max_tokens: int | None = None,
+    rpm: Dict[str, float] | None = None,
+    tpm: Dict[str, float] | None = None,
+) -> AdmissionController:
+    """Set the budget and rate limits of all provider calls from now on."""
+    global _controller
+    _controller = AdmissionController(max_cost, max_tokens, rpm, tpm)
+    return _controller
+
+
+def get_admission() -> AdmissionController:
+    return _controller
+
+
+def add_admission_args(parser: argparse.ArgumentParser):
+    """Add the budget and rate limit flags to a CLI."""
+    parser.add_argument(
+        "--max_cost",
+        type=float,
+        help="Stop once this invocation has spent this many dollars. Running it again resumes the run with a fresh budget.",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        help="Stop once this invocation has used this many input and output tokens.",
+    )
+    parser.add_argument(
+        "--rpm",
+        nargs="*",
+        default=[],
+        help="Requests per minute per provider, e.g. `gpt=500 sonnet=50`.",
+    )
+    parser.add_argument(
+        "--tpm",
+        nargs="*",
+        default=[],
+        help="Tokens per minute per provider, e.g. `gpt=30000 sonnet=40000`.",
+    )
+
+
+def configure_admission_from_args(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> AdmissionController:
+    """Configure admission control from the flags added by `add_admission_args`."""
+    limits = {}
+    for flag in ["rpm", "tpm"]:
+        limits[flag] = {}
+        for limit in getattr(args, flag):
+            provider, n = limit.split("=")
+            if provider not in PROVIDERS:
+                parser.error(f"Unknown provider: {provider}")
+            limits[flag][provider] = float(n)
+    return configure_admission(
+        args.max_cost, args.max_tokens, limits["rpm"], limits["tpm"]
+    )
@@ -0,0 +1,348 @@
+import contextlib
+import contextvars
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple, TypeVar
+
+from admission import get_admission
+from clients import get_client
+from providers import Completion, Provider, _from_anthropic, _from_openai, get_provider
+
+
+BATCH_DIR = "./data/batches"
+
+_ENDPOINTS = {"gpt": "/v1/chat/completions", "sonnet": "/v1/messages"}
+
+# Request params that configure the client rather than the request body.
+_CLIENT_PARAMS = ["timeout", "extra_headers"]
+
+
+class BatchPending(Exception):
+    """Raised by `gpt4()`/`sonnet()` in batch mode when a request was deferred to a batch."""
+
+
+class BatchService:
+    """
+    Base class for services that run a JSONL file of requests as one batch job.
+
+    Each line of the file is `{"custom_id", "method", "url", "body"}`, in the format
+    of the OpenAI Batch API.
+    """
+
+    def submit(self, provider: str, path: str) -> str:
+        """Submit a batch file, returning the batch id."""
+        raise NotImplementedError
+
+    def is_done(self, batch_id: str) -> bool:
+        """Whether the batch has finished, successfully or not."""
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Completion | None]]:
+        """Yield `(custom_id, completion)` pairs, with None for failed requests."""
+        raise NotImplementedError
+
+
+class OpenAIBatchService(BatchService):
+    """Runs batches through the OpenAI Batch API."""
+
+    def __init__(self):
+        self.client = get_client("openai")
+
+    def submit(self, provider: str, path: str) -> str:
+        assert provider == "gpt", "The OpenAI Batch API only serves gpt requests"
+        with open(path, "rb") as file:
+            input_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=_ENDPOINTS[provider],  # type: ignore
+            completion_window="24h",
+        )
+        return batch.id
+
+    def is_done(self, batch_id: str) -> bool:
+        status = self.client.batches.retrieve(batch_id).status
+        return status in ["completed", "failed", "expired", "cancelled"]
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Completion | None]]:
+        from openai.types.chat import ChatCompletion
+
+        batch = self.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return
+        content = self.client.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            record = json.loads(line)
+            response = record.get("response")
+            if not response or response["status_code"] != 200:
+                yield record["custom_id"], None
+                continue
+            result = ChatCompletion.model_validate(response["body"])
+            yield record["custom_id"], _from_openai(result)
+
+
+class AnthropicBatchService(BatchService):
+    """Runs batches through the Anthropic Message Batches API."""
+
+    def __init__(self):
+        self.client = get_client("anthropic")
+
+    def submit(self, provider: str, path: str) -> str:
+        assert provider == "sonnet", "The Anthropic batch API only serves sonnet requests"
+        requests = [
+            {"custom_id": line["custom_id"], "params": line["body"]}
+            for line in _read_batch_file(path)
+        ]
+        batch = self.client.messages.batches.create(requests=requests)  # type: ignore
+        return batch.id
+
+    def is_done(self, batch_id: str) -> bool:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        return batch.processing_status == "ended"
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Completion | None]]:
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type != "succeeded":
+                yield entry.custom_id, None
+                continue
+            yield entry.custom_id, _from_anthropic(entry.result.message)
+
+
+class ProviderBatchService(BatchService):
+    """Routes gpt batches to the OpenAI Batch API and sonnet batches to Anthropic."""
+
+    def __init__(self):
+        self.services: Dict[str, BatchService] = {
+            "gpt": OpenAIBatchService(),
+            "sonnet": AnthropicBatchService(),
+        }
+        self._batches: Dict[str, BatchService] = {}
+
+    def submit(self, provider: str, path: str) -> str:
+        batch_id = self.services[provider].submit(provider, path)
+        self._batches[batch_id] = self.services[provider]
+        return batch_id
+
+    def is_done(self, batch_id: str) -> bool:
+        return self._batches[batch_id].is_done(batch_id)
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Completion | None]]:
+        return self._batches[batch_id].results(batch_id)
+
+
+class LocalBatchService(BatchService):
+    """
+    A local stand-in for the provider batch APIs.
+
+    Runs every request in the batch file through a provider (by default the current
+    one, so a replay provider keeps batches offline) and writes the results next to
+    the batch file.
+    """
+
+    def __init__(self, provider: Provider | None = None):
+        self.provider = provider
+
+    def submit(self, provider: str, path: str) -> str:
+        backend = self.provider or get_provider()
+        results_path = path + ".results.jsonl"
+        with open(results_path, "w") as out:
+            for line in _read_batch_file(path):
+                body = {**line["body"], **line.get("client_params", {})}
+                try:
+                    completion = backend.complete(provider, body)
+                    record = {
+                        "custom_id": line["custom_id"],
+                        "response": completion.to_json(),
+                    }
+                except Exception as e:
+                    record = {"custom_id": line["custom_id"], "error": str(e)}
+                out.write(json.dumps(record) + "\n")
+        return results_path
+
+    def is_done(self, batch_id: str) -> bool:
+        return os.path.exists(batch_id)
+
+    def results(self, batch_id: str) -> Iterator[Tuple[str, Completion | None]]:
+        for record in _read_batch_file(batch_id):
+            if "response" not in record:
+                yield record["custom_id"], None
+                continue
+            yield record["custom_id"], Completion.from_json(record["response"])
+
+
+class Batch:
+    """
+    Collects the requests deferred while running a stage in batch mode.
+
+    Attributes:
+        name (str): The name of the stage, used for the batch file names.
+        requests (Dict[str, Tuple[str, dict, Callable, Callable]]): The deferred requests
+            by cache key, as (provider, params, parse, store), where `parse` turns a
+            completion into the response `gpt4()`/`sonnet()` return and `store` writes
+            that response to the response cache.
+        results (Dict[str, Any]): The parsed responses of all finished requests by key.
+        submitted (set): The keys of all requests submitted so far. A request that is
+            deferred again after it was submitted without a result (e.g. because it
+            failed) is sent live instead, so a batch run always terminates.
+    """
+
+    def __init__(self, name: str = "batch"):
+        self.name = name
+        self.requests: Dict[str, Tuple[str, dict, Callable, Callable]] = {}
+        self.results: Dict[str, Any] = {}
+        self.submitted = set()
+
+    def defer(
+        self,
+        provider: str,
+        key: str,
+        params: dict,
+        parse: Callable[[Completion], Any],
+        store: Callable[[Any], None],
+    ):
+        """
+        Look up a request in the batch.
+
+        Returns the parsed response if the request was already batched, or None if it
+        was submitted but failed. Otherwise the request is deferred to the next
+        submission, raising `BatchPending`.
+        """
+        if key in self.results:
+            return self.results[key]
+        if key in self.submitted:
+            return None
+        self.requests[key] = (provider, params, parse, store)
+        raise BatchPending(key)
+
+    def submit(self, service: BatchService, poll_interval: float = 30.0):
+        """Submit all deferred requests, wait for the results and cache them."""
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        requests, self.requests = self.requests, {}
+        self.submitted.update(requests.keys())
+
+        for provider in sorted({request[0] for request in requests.values()}):
+            provider_requests = {
+                key: request[1:]
+                for key, request in requests.items()
+                if request[0] == provider
+            }
+            path = os.path.join(
+                BATCH_DIR, f"{self.name}_{provider}_{int(time.time() * 1000)}.jsonl"
+            )
+            with open(path, "w") as file:
+                for key, (params, _, _) in provider_requests.items():
+                    file.write(json.dumps(_batch_line(provider, key, params)) + "\n")
+
+            print(f"Submitting batch of {len(provider_requests)} {provider} requests...")
+            batch_id = service.submit(provider, path)
+            while not service.is_done(batch_id):
+                time.sleep(poll_interval)
+
+            n_loaded = 0
+            for key, completion in service.results(batch_id):
+                if key not in provider_requests or completion is None:
+                    continue
+                _, parse, store = provider_requests[key]
+                try:
+                    self.results[key] = parse(completion)
+                    store(self.results[key])
+                    n_loaded += 1
+                except Exception as e:
+                    print(f"Error loading batch result {key}: {e}")
+            print(
+                f"Loaded {n_loaded} of {len(provider_requests)} {provider} batch results."
+            )
+
+
+_current_batch: contextvars.ContextVar[Batch | None] = contextvars.ContextVar(
+    "current_batch", default=None
+)
+
+
+def current_batch() -> Batch | None:
+    """The batch that cache misses are currently deferred to, if any."""
+    return _current_batch.get()
+
+
+@contextlib.contextmanager
+def batch_mode(batch: Batch):
+    """Defer the cache misses of all `gpt4()`/`sonnet()` calls in this block to a batch."""
+    token = _current_batch.set(batch)
+    try:
+        yield batch
+    finally:
+        _current_batch.reset(token)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def run_batched(
+    fn: Callable[[T], R],
+    items: List[T],
+    service: BatchService,
+    name: str = "batch",
+    poll_interval: float = 30.0,
+) -> List[R]:
+    """
+    Run `fn` over all items, one stage at a time, with every LLM call batched.
+
+    Each round runs `fn` for all unfinished items until their first uncached LLM call,
+    submits these calls as one batch, and loads the results into the response cache.
+    The next round then gets past the cached calls, up to the next stage. This repeats
+    until every item is done, so a pipeline with k dependent calls takes k batches.
+
+    Returns:
+        List: The results of `fn`, in the order of `items`.
+    """
+    batch = Batch(name)
+    results: Dict[int, R] = {}
+    pending = list(range(len(items)))
+    n_rounds = 0
+
+    while pending:
+        n_rounds += 1
+        still_pending = []
+        with batch_mode(batch):
+            for i in pending:
+                try:
+                    results[i] = fn(items[i])
+                except BatchPending:
+                    still_pending.append(i)
+
+        print(
+            f"Batch round {n_rounds}: {len(pending) - len(still_pending)} of {len(pending)} items done."
+        )
+        pending = still_pending
+        if pending:
+            get_admission().check_budget()
+            batch.submit(service, poll_interval=poll_interval)
+
+    return [results[i] for i in range(len(items))]
+
+
+def _batch_line(provider: str, key: str, params: dict) -> dict:
+    return {
+        "custom_id": key,
+        "method": "POST",
+        "url": _ENDPOINTS[provider],
+        "body": {k: v for k, v in params.items() if k not in _CLIENT_PARAMS},
+        "client_params": {k: v for k, v in params.items() if k in _CLIENT_PARAMS},
+    }
+
+
+def _read_batch_file(path: str) -> Iterator[dict]:
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_batch_service(name: str) -> BatchService:
+    """Get a batch service by name: "provider" (the OpenAI and Anthropic batch APIs) or "local"."""
+    if name == "provider":
+        return ProviderBatchService()
+    if name == "local":
+        return LocalBatchService()
+    raise ValueError(f"Unknown batch service: {name}")
@@ -0,0 +1,410 @@
+import argparse
+import json
+import os
+import struct
+import zlib
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+
+from compact_graph import CompactMoralGraph, StringColumn
+from graph import Edge, EdgeMetadata, MoralGraph, Value, ValuesData
+
+# A binary graph file is MAGIC followed by chunks. A chunk is the length of its header,
+# its JSON header ({"table", "rows", "codec", "columns": [[name, size], ...]}) and the
+# data of its columns, in the order of the header. A string column is the int64 offsets
+# of its strings followed by the UTF-8 strings end to end; a bool column is a byte per
+# row. Each column is compressed on its own, so columns can be skipped on read.
+MAGIC = b"MGRAPH1\n"
+SUFFIX = ".mgraph"
+CHUNK_SIZE = 50_000
+
+STR = "str"
+JSON = "json"  # A string column of JSON.
+BOOL = "bool"
+
+# The columns of each table: name, type, and the value of rows of columns that were not
+# read. Ids are always read.
+SCHEMA = {
+    "values": [
+        ("id", STR, ""),
+        ("title", STR, ""),
+        ("policies", JSON, "[]"),
+        ("choice_context", STR, ""),
+        # False for values without a choice context, whose choice context is empty.
+        ("has_choice_context", BOOL, True),
+    ],
+    "edges": [
+        ("from_id", STR, ""),
+        ("to_id", STR, ""),
+        ("context", STR, ""),
+        ("metadata", BOOL, False),
+        ("story", STR, ""),
+        ("context_shifts", STR, ""),
+        ("problem", JSON, "{}"),
+        ("improvements", JSON, "[]"),
+    ],
+    "seed_questions": [("question", STR, "")],
+}
+IDS = ["id", "from_id", "to_id"]
+METADATA = ["story", "context_shifts", "problem", "improvements"]
+# The columns to read for the graph structure only.
+TOPOLOGY = ["id", "from_id", "to_id", "context"]
+
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+def is_binary_graph(path: str) -> bool:
+    """Whether a file is a binary graph file."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _encode(column: StringColumn | np.ndarray) -> bytes:
+    if isinstance(column, StringColumn):
+        return column.offsets.astype("<i8").tobytes() + column.buffer
+    return np.asarray(column, dtype=np.uint8).tobytes()
+
+
+def _decode(data: bytes, kind: str, rows: int) -> StringColumn | np.ndarray:
+    if kind == BOOL:
+        return np.frombuffer(data, dtype=np.uint8).astype(bool)
+    split = (rows + 1) * 8
+    return StringColumn.from_buffer(
+        data[split:], np.frombuffer(data[:split], dtype="<i8").astype(np.int64)
+    )
+
+
+class GraphWriter:
+    """
+    Writes a binary graph file in chunks of up to `chunk_size` rows per table, so that a
+    graph can be written while it is produced, without holding all of it in memory.
+
+    Attributes:
+        path (str): The path to the file.
+        chunk_size (int): The most rows per chunk.
+        compress (bool): Whether to compress the columns with zlib.
+    """
+
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE, compress: bool = True):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._pending: Dict[str, list] = {table: [] for table in SCHEMA}
+
+    def __enter__(self) -> "GraphWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_values(self, values: Iterable[Value]):
+        self._add("values", values)
+
+    def write_edges(self, edges: Iterable[Edge]):
+        self._add("edges", edges)
+
+    def write_seed_questions(self, seed_questions: Iterable[str]):
+        self._add("seed_questions", seed_questions)
+
+    def write_graph(self, graph: MoralGraph | CompactMoralGraph):
+        """Write all values, edges and seed questions of a graph."""
+        if isinstance(graph, CompactMoralGraph):
+            self.flush()
+            self.write_columns("values", graph.value_columns())
+            self.write_columns("edges", graph.edge_columns())
+        else:
+            self.write_values(graph.values)
+            self.write_edges(graph.edges)
+        self.write_seed_questions(graph.seed_questions)
+
+    def _add(self, table: str, rows: Iterable):
+        for row in rows:
+            self._pending[table].append(row)
+            if len(self._pending[table]) >= self.chunk_size:
+                self._flush(table)
+
+    def flush(self):
+        """Write the rows added so far."""
+        for table in SCHEMA:
+            self._flush(table)
+        self._file.flush()
+
+    def _flush(self, table: str):
+        rows = self._pending[table]
+        if not rows:
+            return
+        self._pending[table] = []
+        if table == "values":
+            columns = {
+                "id": StringColumn(v.id for v in rows),
+                "title": StringColumn(v.data.title for v in rows),
+                "policies": StringColumn.dumps(v.data.policies for v in rows),
+                "choice_context": StringColumn(
+                    v.data.choice_context or "" for v in rows
+                ),
+                "has_choice_context": np.array(
+                    [v.data.choice_context is not None for v in rows], dtype=bool
+                ),
+            }
+        elif table == "edges":
+            metadata = [e.metadata for e in rows]
+            columns = {
+                "from_id": StringColumn(e.from_id for e in rows),
+                "to_id": StringColumn(e.to_id for e in rows),
+                "context": StringColumn(e.context for e in rows),
+                "metadata": np.array([m is not None for m in metadata], dtype=bool),
+                "story": StringColumn(m.story if m else "" for m in metadata),
+                "context_shifts": StringColumn(
+                    m.context_shifts if m else "" for m in metadata
+                ),
+                "problem": StringColumn.dumps(m.problem if m else {} for m in metadata),
+                "improvements": StringColumn.dumps(
+                    m.improvements if m else [] for m in metadata
+                ),
+            }
+        else:
+            columns = {"question": StringColumn(rows)}
+        self._write_chunk(table, len(rows), columns)
+
+    def write_columns(self, table: str, columns: Dict[str, StringColumn | np.ndarray]):
+        """Write the rows of a table given as columns, like `CompactMoralGraph` has them."""
+        rows = len(next(iter(columns.values())))
+        for start in range(0, rows, self.chunk_size):
+            stop = min(start + self.chunk_size, rows)
+            self._write_chunk(
+                table,
+                stop - start,
+                {
+                    name: (
+                        column.slice(start, stop)
+                        if isinstance(column, StringColumn)
+                        else column[start:stop]
+                    )
+                    for name, column in columns.items()
+                },
+            )
+
+    def _write_chunk(
+        self, table: str, rows: int, columns: Dict[str, StringColumn | np.ndarray]
+    ):
+        data = [_encode(columns[name]) for name, _, _ in SCHEMA[table]]
+        if self.compress:
+            data = [zlib.compress(d, 1) for d in data]
+        header = json.dumps(
+            {
+                "table": table,
+                "rows": rows,
+                "codec": "zlib" if self.compress else None,
+                "columns": [
+                    [name, len(d)] for (name, _, _), d in zip(SCHEMA[table], data)
+                ],
+            }
+        ).encode()
+        self._file.write(_HEADER_LENGTH.pack(len(header)) + header)
+        for d in data:
+            self._file.write(d)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class GraphReader:
+    """
+    Reads a binary graph file chunk by chunk, only reading the columns it is asked for.
+
+    Attributes:
+        path (str): The path to the file.
+        columns (List[str] | None): The columns to read, besides the ids, e.g. `TOPOLOGY`.
+            Columns that are not read hold the empty value of their `SCHEMA`. If None,
+            all columns are read.
+    """
+
+    def __init__(self, path: str, columns: Iterable[str] | None = None):
+        self.path = path
+        self.columns = None if columns is None else list(columns)
+        if columns is not None and any(c in METADATA for c in self.columns):
+            # Metadata columns are only used for edges that have metadata.
+            self.columns.append("metadata")
+        if columns is not None and "choice_context" in self.columns:
+            self.columns.append("has_choice_context")
+        if not is_binary_graph(path):
+            raise ValueError(f"{path} is not a binary graph file.")
+
+    def chunks(
+        self, tables: Iterable[str] = tuple(SCHEMA)
+    ) -> Iterator[Tuple[str, Dict[str, StringColumn | np.ndarray]]]:
+        """
+        Stream the chunks of the tables, skipping the chunks of other tables unread.
+
+        Yields:
+            Tuple[str, dict]: The table of a chunk, and its columns by name.
+        """
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(len(MAGIC))
+            while f.tell() < size:
+                chunk = self._read_chunk(f, size, set(tables))
+                if chunk is None:
+                    # Like a journal, a file whose writer was interrupted keeps its
+                    # complete chunks.
+                    print(f"Ignoring an incomplete chunk at the end of {self.path}")
+                    return
+                if chunk[1] is not None:
+                    yield chunk
+
+    def _read_chunk(self, f, size: int, tables: Set[str]):
+        """Read the chunk at the position of `f`, or return None if it is incomplete."""
+        length = f.read(_HEADER_LENGTH.size)
+        if len(length) < _HEADER_LENGTH.size:
+            return None
+        try:
+            header = json.loads(f.read(_HEADER_LENGTH.unpack(length)[0]))
+        except ValueError:
+            return None
+        table, rows = header["table"], header["rows"]
+        if table not in tables or table not in SCHEMA:
+            f.seek(sum(column_size for _, column_size in header["columns"]), 1)
+            return (table, None) if f.tell() <= size else None
+
+        kinds = {name: kind for name, kind, _ in SCHEMA[table]}
+        columns = {}
+        for name, column_size in header["columns"]:
+            wanted = self.columns is None or name in self.columns or name in IDS
+            if not wanted or name not in kinds:
+                f.seek(column_size, 1)
+                continue
+            data = f.read(column_size)
+            if len(data) < column_size:
+                return None
+            if header["codec"] == "zlib":
+                data = zlib.decompress(data)
+            columns[name] = _decode(data, kinds[name], rows)
+        # Seeking past the end of the file doesn't fail, so check it was that long.
+        if f.tell() > size:
+            return None
+
+        for name, kind, empty in SCHEMA[table]:
+            if name not in columns:
+                columns[name] = (
+                    np.full(rows, empty, dtype=bool)
+                    if kind == BOOL
+                    else StringColumn.repeat(empty, rows)
+                )
+        return table, columns
+
+    def values(self) -> Iterator[Value]:
+        """Stream the values of the file."""
+        for _, columns in self.chunks(["values"]):
+            yield from _values(columns)
+
+    def edges(self) -> Iterator[Edge]:
+        """Stream the edges of the file."""
+        for _, columns in self.chunks(["edges"]):
+            yield from _edges(columns)
+
+    def seed_questions(self) -> Iterator[str]:
+        """Stream the seed questions of the file."""
+        for _, columns in self.chunks(["seed_questions"]):
+            yield from columns["question"].tolist()
+
+
+def _values(columns: Dict[str, StringColumn]) -> Iterator[Value]:
+    for id, title, policies, choice_context, has_choice_context in zip(
+        columns["id"].tolist(),
+        columns["title"].tolist(),
+        columns["policies"].loads(),
+        columns["choice_context"].tolist(),
+        columns["has_choice_context"].tolist(),
+    ):
+        if not has_choice_context:
+            choice_context = None
+        yield Value(ValuesData(title, policies, choice_context), id)
+
+
+def _edges(columns: Dict[str, StringColumn | np.ndarray]) -> Iterator[Edge]:
+    for row in zip(
+        columns["from_id"].tolist(),
+        columns["to_id"].tolist(),
+        columns["context"].tolist(),
+        columns["metadata"].tolist(),
+        columns["story"].tolist(),
+        columns["context_shifts"].tolist(),
+        columns["problem"].loads(),
+        columns["improvements"].loads(),
+    ):
+        from_id, to_id, context, has_metadata = row[:4]
+        story, context_shifts, problem, improvements = row[4:]
+        metadata = (
+            EdgeMetadata(story, context_shifts, problem, improvements)
+            if has_metadata
+            else None
+        )
+        yield Edge(from_id, to_id, context, metadata)
+
+
+def write_graph(
+    graph: MoralGraph | CompactMoralGraph,
+    path: str,
+    chunk_size: int = CHUNK_SIZE,
+    compress: bool = True,
+):
+    """Write a graph to a binary graph file."""
+    with GraphWriter(path, chunk_size, compress) as writer:
+        writer.write_graph(graph)
+
+
+def read_graph(path: str, columns: Iterable[str] | None = None) -> MoralGraph:
+    """Read a binary graph file into a `MoralGraph`, optionally only some columns."""
+    graph = MoralGraph([], [], [])
+    for table, chunk in GraphReader(path, columns).chunks():
+        if table == "values":
+            graph.values += _values(chunk)
+        elif table == "edges":
+            graph.edges += _edges(chunk)
+        else:
+            graph.seed_questions += chunk["question"].tolist()
+    return graph
+
+
+def read_compact_graph(
+    path: str, columns: Iterable[str] | None = None
+) -> CompactMoralGraph:
+    """Read a binary graph file into a `CompactMoralGraph`, optionally only some columns."""
+    chunks: Dict[str, List[dict]] = {table: [] for table in SCHEMA}
+    for table, chunk in GraphReader(path, columns).chunks():
+        chunks[table].append(chunk)
+
+    def concat(table: str) -> Dict[str, StringColumn | np.ndarray]:
+        return {
+            name: (
+                np.concatenate([c[name] for c in chunks[table]] or [np.zeros(0, bool)])
+                if kind == BOOL
+                else StringColumn.concat(
+                    [c[name] for c in chunks[table]] or [StringColumn([])]
+                )
+            )
+            for name, kind, _ in SCHEMA[table]
+        }
+
+    return CompactMoralGraph(
+        concat("values"), concat("edges"), concat("seed_questions")["question"].tolist()
+    )
+
+
+if __name__ == "__main__":
+    """Convert a graph file between JSON and the binary format."""
+
+    parser = argparse.ArgumentParser(
+        description=f"Convert a graph file to JSON, or to the binary format if the output ends in {SUFFIX}."
+    )
+    parser.add_argument("input", type=str, help="The JSON or binary graph file.")
+    parser.add_argument("output", type=str, help="The graph file to write.")
+    args = parser.parse_args()
+
+    CompactMoralGraph.from_file(args.input).save_to_file(args.output)
+    print(f"Wrote {args.output}")
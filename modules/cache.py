@@ -0,0 +1,764 @@
+import argparse
+from collections import Counter
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+from clients import get_client
+
+# numpy is only needed for similarity lookups, so it is imported where those happen.
+if TYPE_CHECKING:
+    import numpy as np
+
+
+# "sqlite" for a single database file, or "sharded" for a directory of JSONL shards
+# that many processes (on many hosts, given a shared filesystem) can write to at once.
+CACHE_BACKEND = os.environ.get("LLM_CACHE_BACKEND", "sqlite")
+CACHE_DB_FILE = "./data/llm_cache.sqlite"
+CACHE_DIR = os.environ.get("LLM_CACHE_DIR", "./data/llm_cache")
+# How often the sharded cache merges its shards in the background, in seconds.
+MERGE_INTERVAL = float(os.environ.get("LLM_CACHE_MERGE_INTERVAL", 600))
+CACHE_MAX_ENTRIES = (
+    int(os.environ["LLM_CACHE_MAX_ENTRIES"])
+    if os.environ.get("LLM_CACHE_MAX_ENTRIES")
+    else None
+)
+
+# The second-tier cache matches prompts that only differ in formatting, and (for call
+# sites that opt in) prompts whose user prompt embeds this close to a cached one.
+SEMANTIC_CACHE = os.environ.get("LLM_SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("LLM_SEMANTIC_CACHE_THRESHOLD", 0.98))
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Evict a little more than strictly needed, so that a full cache doesn't run
+# an eviction query on every single insert.
+_EVICTION_SLACK = 0.1
+
+
+class ResponseCache:
+    """
+    A persistent hash -> response store for LLM calls, backed by SQLite.
+
+    Lookups go through the table's primary key, so a cache hit costs the same no
+    matter how many entries the cache holds. Several caches (one per provider) can
+    share one database file, separated by their namespace.
+
+    Attributes:
+        namespace (str): The namespace of the cache, e.g. "gpt" or "sonnet".
+        path (str): The path to the SQLite database file.
+        max_entries (int | None): If set, the least recently used entries are evicted
+            once the namespace holds more than this many responses.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        path: str = CACHE_DB_FILE,
+        max_entries: int | None = None,
+    ):
+        self.namespace = namespace
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                namespace TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, hash)
+            );
+            CREATE INDEX IF NOT EXISTS responses_lru
+                ON responses (namespace, accessed_at);
+            CREATE TABLE IF NOT EXISTS migrations (
+                source TEXT PRIMARY KEY,
+                migrated_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+        self._size = self._count()
+
+    def get(self, hash_key: str):
+        """Get the cached response for a hash, or None if there is none."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE namespace = ? AND hash = ?",
+                (self.namespace, hash_key),
+            ).fetchone()
+            if row is None:
+                return None
+
+            # Only bounded caches need to track recency.
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE namespace = ? AND hash = ?",
+                    (time.time(), self.namespace, hash_key),
+                )
+                self._conn.commit()
+
+        return json.loads(row[0])
+
+    def set(self, hash_key: str, response):
+        """Cache a response under a hash, replacing any previous response."""
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM responses WHERE namespace = ? AND hash = ?",
+                (self.namespace, hash_key),
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (namespace, hash, response, accessed_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, hash_key, json.dumps(response), time.time()),
+            )
+            self._conn.commit()
+            if not exists:
+                self._size += 1
+            if self.max_entries is not None and self._size > self.max_entries:
+                self._evict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count()
+
+    def migrate_jsonl(self, jsonl_file: str, force: bool = False) -> int:
+        """
+        Import a legacy `{"hash": ..., "response": ...}` JSONL cache file.
+
+        The import runs once per file, unless `force` is set. Duplicate hashes are
+        collapsed, keeping the first response (which is the one the old linear scan
+        returned), and corrupt lines are skipped.
+
+        Returns:
+            int: The number of responses imported.
+        """
+        source = f"{self.namespace}:{os.path.abspath(jsonl_file)}"
+        if not os.path.exists(jsonl_file):
+            return 0
+
+        with self._lock:
+            migrated = self._conn.execute(
+                "SELECT 1 FROM migrations WHERE source = ?", (source,)
+            ).fetchone()
+            if migrated and not force:
+                return 0
+
+            now = time.time()
+            rows = (
+                (self.namespace, record["hash"], json.dumps(record["response"]), now)
+                for record in _read_jsonl_records(jsonl_file)
+            )
+            before = self._count()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO responses (namespace, hash, response, accessed_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO migrations (source, migrated_at) VALUES (?, ?)",
+                (source, now),
+            )
+            self._conn.commit()
+            self._size = self._count()
+            imported = self._size - before
+
+            if self.max_entries is not None and self._size > self.max_entries:
+                self._evict()
+
+        print(f"Migrated {imported} cached responses from {jsonl_file}")
+        return imported
+
+    def compact(self):
+        """Apply the size bound and reclaim the space of deleted entries."""
+        with self._lock:
+            if self.max_entries is not None and self._size > self.max_entries:
+                self._evict(slack=0)
+            self._conn.execute("VACUUM")
+
+    def _count(self) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM responses WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    def _evict(self, slack: float = _EVICTION_SLACK):
+        assert self.max_entries is not None
+        # Other processes may have written to the cache too, so recount first.
+        self._size = self._count()
+        target = int(self.max_entries * (1 - slack))
+        excess = self._size - target
+        if excess <= 0:
+            return
+
+        self._conn.execute(
+            """DELETE FROM responses WHERE namespace = ? AND hash IN (
+                SELECT hash FROM responses WHERE namespace = ? ORDER BY accessed_at ASC LIMIT ?
+            )""",
+            (self.namespace, self.namespace, excess),
+        )
+        self._conn.commit()
+        self._size = self._count()
+
+
+def _read_jsonl_records(jsonl_file: str):
+    with open(jsonl_file, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and "hash" in record and "response" in record:
+                yield record
+
+
+def compact_jsonl(jsonl_file: str) -> int:
+    """
+    Rewrite a legacy JSONL cache file with one line per hash.
+
+    Keeps the first response for each hash and drops corrupt lines.
+
+    Returns:
+        int: The number of lines removed.
+    """
+    seen = set()
+    kept = 0
+    removed = 0
+    tmp_file = jsonl_file + ".tmp"
+
+    with open(tmp_file, "w") as out:
+        with open(jsonl_file, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    hash_key = record["hash"]
+                    record["response"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    removed += 1
+                    continue
+                if hash_key in seen:
+                    removed += 1
+                    continue
+                seen.add(hash_key)
+                out.write(json.dumps(record) + "\n")
+                kept += 1
+
+    os.replace(tmp_file, jsonl_file)
+    print(f"Compacted {jsonl_file}: kept {kept} lines, removed {removed}")
+    return removed
+
+
+class ShardedCache:
+    """
+    A hash -> response store for LLM calls that many processes can share.
+
+    Responses live in JSONL shard files, picked by the first characters of the hash.
+    Every write is a single append of one complete line, under an exclusive `flock` of
+    its shard, so concurrent writers never interleave. Each process keeps an in-memory
+    index per shard and reads only what other processes appended since its last read.
+    Lines that are incomplete or corrupt are skipped.
+
+    Appends may repeat a hash; `compact` (run periodically by `start_merger`) rewrites
+    each shard with one line per hash, atomically replacing the file.
+
+    The cache has no size bound, so `max_entries` is not supported.
+
+    Attributes:
+        namespace (str): The namespace of the cache, e.g. "gpt" or "sonnet".
+        directory (str): The directory holding the namespace's shards.
+        prefix_length (int): The number of hash characters that pick a shard.
+    """
+
+    def __init__(
+        self, namespace: str, directory: str = CACHE_DIR, prefix_length: int = 2
+    ):
+        self.namespace = namespace
+        self.directory = os.path.join(directory, namespace.replace(":", "_"))
+        self.prefix_length = prefix_length
+        self._shards: Dict[str, _Shard] = {}
+        self._lock = threading.Lock()
+        self._merger: threading.Thread | None = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, hash_key: str):
+        """Get the cached response for a hash, or None if there is none."""
+        return self._shard(hash_key[: self.prefix_length]).get(hash_key)
+
+    def set(self, hash_key: str, response):
+        """Cache a response under a hash, replacing any previous response."""
+        self._shard(hash_key[: self.prefix_length]).append({hash_key: response})
+
+    def __len__(self) -> int:
+        return sum(len(self._shard(prefix)) for prefix in self._prefixes())
+
+    def migrate_jsonl(self, jsonl_file: str, force: bool = False) -> int:
+        """
+        Import a legacy `{"hash": ..., "response": ...}` JSONL cache file.
+
+        Works like `ResponseCache.migrate_jsonl`: the import runs once per file, unless
+        `force` is set, keeping the first response per hash and skipping corrupt lines.
+
+        Returns:
+            int: The number of responses imported.
+        """
+        if not os.path.exists(jsonl_file):
+            return 0
+        marker = os.path.join(self.directory, "migrated.txt")
+        source = os.path.abspath(jsonl_file)
+        if not force and os.path.exists(marker):
+            with open(marker, "r") as file:
+                if source in file.read().splitlines():
+                    return 0
+
+        by_prefix: Dict[str, dict] = {}
+        for record in _read_jsonl_records(jsonl_file):
+            records = by_prefix.setdefault(record["hash"][: self.prefix_length], {})
+            records.setdefault(record["hash"], record["response"])
+
+        imported = 0
+        for prefix, records in by_prefix.items():
+            shard = self._shard(prefix)
+            new_records = {k: v for k, v in records.items() if shard.get(k) is None}
+            shard.append(new_records)
+            imported += len(new_records)
+
+        with open(marker, "a") as file:
+            file.write(source + "\n")
+        print(f"Migrated {imported} cached responses from {jsonl_file}")
+        return imported
+
+    def compact(self):
+        """Rewrite every shard with one line per hash, dropping corrupt lines."""
+        for prefix in self._prefixes():
+            self._shard(prefix).compact()
+
+    def start_merger(self, interval: float = MERGE_INTERVAL):
+        """Compact the shards every `interval` seconds in a background thread."""
+        with self._lock:
+            if self._merger is not None:
+                return
+
+            def merge():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.compact()
+                    except OSError as e:
+                        print(f"Error merging {self.namespace} cache shards: {e}")
+
+            self._merger = threading.Thread(target=merge, daemon=True)
+            self._merger.start()
+
+    def _prefixes(self) -> List[str]:
+        return sorted(
+            name[: -len(".jsonl")]
+            for name in os.listdir(self.directory)
+            if name.endswith(".jsonl")
+        )
+
+    def _shard(self, prefix: str) -> "_Shard":
+        with self._lock:
+            if prefix not in self._shards:
+                path = os.path.join(self.directory, f"{prefix}.jsonl")
+                self._shards[prefix] = _Shard(path)
+            return self._shards[prefix]
+
+
+class _Shard:
+    """One JSONL file of a `ShardedCache`, with an index of what was read from it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, object] = {}
+        # The file (by inode) and the offset the index was read up to.
+        self._inode: int | None = None
+        self._offset = 0
+        # The number of lines read that were corrupt or superseded by a later line.
+        self._stale = 0
+        # The keys this process appended past the offset, after lines of other writers.
+        self._unread_own: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, hash_key: str):
+        with self._lock:
+            if hash_key not in self.entries:
+                self._refresh()
+            return self.entries.get(hash_key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self.entries)
+
+    def append(self, records: dict):
+        if not records:
+            return
+        data = "".join(
+            json.dumps({"hash": k, "response": v}) + "\n" for k, v in records.items()
+        ).encode()
+        with self._lock:
+            fd = self._open_locked(os.O_RDWR | os.O_APPEND | os.O_CREAT)
+            try:
+                # Don't continue a line left incomplete by a writer that crashed.
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    data = b"\n" + data
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+                if os.fstat(fd).st_ino == self._inode:
+                    if size == self._offset:
+                        # Nobody appended since the last read, so the index stays
+                        # current without reading back our own lines.
+                        self._offset = size + len(data)
+                        self._stale += sum(k in self.entries for k in records)
+                    else:
+                        self._unread_own.update(records.keys())
+            finally:
+                os.close(fd)
+            self.entries.update(records)
+
+    def compact(self):
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            fd = self._open_locked(os.O_RDONLY)
+            try:
+                self._refresh()
+                if not self._stale:
+                    return
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as out:
+                    for hash_key, response in self.entries.items():
+                        out.write(
+                            json.dumps({"hash": hash_key, "response": response}) + "\n"
+                        )
+                    out.flush()
+                    os.fsync(out.fileno())
+                # Writers that wait for the lock see the file was replaced, and reopen.
+                os.replace(tmp_path, self.path)
+                self._refresh()
+            finally:
+                os.close(fd)
+
+    def _open_locked(self, flags: int) -> int:
+        """Open the shard file holding its lock, retrying if it was replaced meanwhile."""
+        while True:
+            fd = os.open(self.path, flags, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _refresh(self):
+        """Read the lines appended since the last read, starting over if the file was replaced."""
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            if inode != self._inode:
+                self._inode, self._offset, self._stale = inode, 0, 0
+                self.entries = {}
+                self._unread_own.clear()
+            file.seek(self._offset)
+            data = file.read()
+
+        # Only read up to the last complete line; the rest may still be being written.
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                hash_key, response = record["hash"], record["response"]
+            except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+                self._stale += 1
+                continue
+            if self._unread_own[hash_key]:
+                # Our own line, which is already in the index.
+                self._unread_own[hash_key] -= 1
+                if not self._unread_own[hash_key]:
+                    del self._unread_own[hash_key]
+            elif hash_key in self.entries:
+                self._stale += 1
+            self.entries[hash_key] = response
+
+
+def make_cache(namespace: str, max_entries: int | None = CACHE_MAX_ENTRIES):
+    """Open the response cache for a namespace with the configured `CACHE_BACKEND`."""
+    if CACHE_BACKEND == "sqlite":
+        return ResponseCache(namespace, max_entries=max_entries)
+    if CACHE_BACKEND == "sharded":
+        cache = ShardedCache(namespace)
+        cache.start_merger()
+        return cache
+    raise ValueError(f"Unknown cache backend: {CACHE_BACKEND}")
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    Normalize a prompt so that formatting-only changes map to the same text.
+
+    JSON prompts are re-serialized canonically (sorted keys, with lists of objects
+    such as card lists sorted too). Other prompts get trailing whitespace stripped,
+    runs of spaces collapsed and blank lines squeezed.
+    """
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        data = None
+    if isinstance(data, (dict, list)):
+        return json.dumps(_canonical_json(data), sort_keys=True)
+
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in text.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def _canonical_json(data):
+    if isinstance(data, dict):
+        return {k: _canonical_json(v) for k, v in data.items()}
+    if isinstance(data, list):
+        items = [_canonical_json(v) for v in data]
+        # The order of objects in a list (e.g. cards) doesn't change their meaning.
+        if items and all(isinstance(v, dict) for v in items):
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return items
+    return data
+
+
+def normalize_messages(messages):
+    """Normalize every prompt in a cache key (a list of prompts or chat messages)."""
+    if isinstance(messages, str):
+        return normalize_prompt(messages)
+    if isinstance(messages, dict):
+        return {k: normalize_messages(v) for k, v in messages.items()}
+    if isinstance(messages, list):
+        return [normalize_messages(v) for v in messages]
+    return messages
+
+
+def embed_text(text: str) -> List[float]:
+    """Embed a prompt for similarity lookups."""
+    response = get_client("openai").embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+
+class SemanticCache:
+    """
+    A second-tier cache that matches near-identical prompts.
+
+    Responses are stored under a hash of the normalized prompts (see
+    `normalize_prompt`), so prompts that only differ in whitespace or in the order of
+    their card lists share a response. Optionally, the user prompt (the last user
+    message of the key) is also embedded: a lookup with a `threshold` then returns the
+    response of the most similar cached user prompt, if its cosine similarity reaches
+    the threshold and all other prompts of the key match exactly after normalization.
+
+    Attributes:
+        namespace (str): The namespace of the cache, e.g. "gpt" or "sonnet".
+        path (str): The path to the SQLite database file.
+        embed (Callable[[str], List[float]]): Embeds a normalized user prompt.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        path: str = CACHE_DB_FILE,
+        embed: Callable[[str], List[float]] = embed_text,
+        max_entries: int | None = None,
+        responses: "ResponseCache | ShardedCache | None" = None,
+    ):
+        self.namespace = namespace
+        self.path = path
+        self.embed = embed
+        self.responses = responses or ResponseCache(
+            f"{namespace}:normalized", path, max_entries
+        )
+        # Embedding matrices by scope, loaded on first lookup.
+        self._scopes: Dict[str, Tuple[List[str], "np.ndarray"]] = {}
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                namespace TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                embedding TEXT NOT NULL,
+                PRIMARY KEY (namespace, scope, hash)
+            );
+            """
+        )
+        self._conn.commit()
+
+    def get(self, messages: list, threshold: float | None = None):
+        """
+        Get the response for the normalized prompts, or, with a `threshold`, for the
+        most similar cached user prompt. Returns None if there is none.
+        """
+        normalized = normalize_messages(messages)
+        response = self.responses.get(_hash(normalized))
+        if response or threshold is None:
+            return response
+
+        scope, query = _split_query(normalized)
+        if query is None:
+            return None
+        hashes, matrix = self._load_scope(scope)
+        if not hashes:
+            return None
+
+        import numpy as np
+
+        embedding = _unit(np.array(self.embed(query), dtype=np.float32))
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        print(f"Found similar cached prompt (similarity {similarities[best]:.3f})...")
+        return self.responses.get(hashes[best])
+
+    def set(self, messages: list, response, embed: bool = False):
+        """Cache a response under the normalized prompts, embedding the user prompt if `embed`."""
+        normalized = normalize_messages(messages)
+        hash_key = _hash(normalized)
+        self.responses.set(hash_key, response)
+        if not embed:
+            return
+
+        scope, query = _split_query(normalized)
+        if query is None:
+            return
+        import numpy as np
+
+        embedding = _unit(np.array(self.embed(query), dtype=np.float32))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (namespace, scope, hash, embedding) VALUES (?, ?, ?, ?)",
+                (self.namespace, scope, hash_key, json.dumps(embedding.tolist())),
+            )
+            self._conn.commit()
+            if scope in self._scopes:
+                hashes, matrix = self._scopes[scope]
+                if hash_key not in hashes:
+                    self._scopes[scope] = (
+                        [*hashes, hash_key],
+                        np.vstack([matrix, embedding]),
+                    )
+
+    def _load_scope(self, scope: str) -> Tuple[List[str], "np.ndarray"]:
+        import numpy as np
+
+        with self._lock:
+            if scope not in self._scopes:
+                rows = self._conn.execute(
+                    "SELECT hash, embedding FROM embeddings WHERE namespace = ? AND scope = ?",
+                    (self.namespace, scope),
+                ).fetchall()
+                hashes = [row[0] for row in rows]
+                matrix = np.array(
+                    [json.loads(row[1]) for row in rows], dtype=np.float32
+                )
+                self._scopes[scope] = (hashes, matrix)
+            return self._scopes[scope]
+
+
+def _hash(messages) -> str:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+
+
+def _split_query(messages: list) -> Tuple[str, str | None]:
+    """
+    Split normalized prompts into the user prompt that is compared by similarity and
+    a hash of everything else, which has to match exactly.
+    """
+    rest = list(messages)
+    for i in reversed(range(len(rest))):
+        message = rest[i]
+        if isinstance(message, str):
+            rest[i] = None
+            return _hash(rest), message
+        if isinstance(message, dict) and message.get("role") == "user":
+            rest[i] = {**message, "content": None}
+            return _hash(rest), message["content"]
+    return _hash(rest), None
+
+
+def _unit(vector: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+_caches: Dict[str, ResponseCache | ShardedCache] = {}
+_semantic_caches: Dict[str, SemanticCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(
+    namespace: str, legacy_file: str | None = None
+) -> ResponseCache | ShardedCache:
+    """
+    Get the shared cache for a namespace, opening it on first use.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        legacy_file (str | None): A JSONL cache file to migrate into the store, once.
+    """
+    with _caches_lock:
+        if namespace not in _caches:
+            cache = make_cache(namespace)
+            if legacy_file:
+                cache.migrate_jsonl(legacy_file)
+            _caches[namespace] = cache
+        return _caches[namespace]
+
+
+def get_semantic_cache(namespace: str) -> SemanticCache:
+    """Get the shared second-tier cache for a namespace, opening it on first use."""
+    with _caches_lock:
+        if namespace not in _semantic_caches:
+            _semantic_caches[namespace] = SemanticCache(
+                namespace, responses=make_cache(f"{namespace}:normalized")
+            )
+        return _semantic_caches[namespace]
+
+
+if __name__ == "__main__":
+    """Migrate legacy JSONL caches into the response cache and compact it."""
+    from llms import LEGACY_CACHE_FILES
+
+    parser = argparse.ArgumentParser(description="Maintain the LLM response cache.")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-import the legacy JSONL caches even if they were migrated before.",
+    )
+    parser.add_argument(
+        "--compact_jsonl",
+        action="store_true",
+        help="Also rewrite the legacy JSONL caches without duplicate or corrupt lines.",
+    )
+    args = parser.parse_args()
+
+    for namespace, jsonl_file in LEGACY_CACHE_FILES.items():
+        if args.compact_jsonl and os.path.exists(jsonl_file):
+            compact_jsonl(jsonl_file)
+        cache = make_cache(namespace)
+        cache.migrate_jsonl(jsonl_file, force=args.force)
+        cache.compact()
+        print(f"{namespace} cache holds {len(cache)} responses")
@@ -0,0 +1,112 @@
+import importlib.util
+import os
+import threading
+from typing import Any, Dict
+
+# Connection pool and timeout settings shared by all provider clients.
+POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", 64))
+KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_KEEPALIVE_CONNECTIONS", 32))
+KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 60.0))
+CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10.0))
+REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", 600.0))
+# HTTP/2 needs the optional `h2` package, so it is only used when that is installed.
+HTTP2 = os.environ.get("LLM_HTTP2", "1") == "1"
+
+_settings: Dict[str, Any] = {
+    "pool_size": POOL_SIZE,
+    "keepalive_connections": KEEPALIVE_CONNECTIONS,
+    "keepalive_expiry": KEEPALIVE_EXPIRY,
+    "connect_timeout": CONNECT_TIMEOUT,
+    "request_timeout": REQUEST_TIMEOUT,
+    "http2": HTTP2,
+}
+_clients: Dict[str, Any] = {}
+_db = None
+_lock = threading.Lock()
+
+
+def configure_clients(
+    pool_size: int | None = None,
+    keepalive_connections: int | None = None,
+    keepalive_expiry: float | None = None,
+    connect_timeout: float | None = None,
+    request_timeout: float | None = None,
+    http2: bool | None = None,
+):
+    """
+    Change the connection pool and timeout settings of the provider clients.
+
+    Clients handed out before are closed, so the next `get_client()` call opens a
+    new pool with the new settings.
+    """
+    updates = {
+        "pool_size": pool_size,
+        "keepalive_connections": keepalive_connections,
+        "keepalive_expiry": keepalive_expiry,
+        "connect_timeout": connect_timeout,
+        "request_timeout": request_timeout,
+        "http2": http2,
+    }
+    with _lock:
+        _settings.update({k: v for k, v in updates.items() if v is not None})
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def get_client(name: str):
+    """
+    Get the long-lived client for a provider API: "openai" or "anthropic".
+
+    The client is created on first use and reused afterwards, so its keep-alive
+    connections (and their TLS sessions) are shared by every request in the process.
+    Clients are thread-safe.
+    """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = _make_client(name)
+        return _clients[name]
+
+
+def get_db():
+    """
+    Get the shared Prisma client, created on first use. It isn't connected yet, so
+    callers connect and disconnect it as needed.
+    """
+    global _db
+    with _lock:
+        if _db is None:
+            from prisma import Prisma
+
+            _db = Prisma()
+        return _db
+
+
+def _http2_available() -> bool:
+    return _settings["http2"] and importlib.util.find_spec("h2") is not None
+
+
+def _make_client(name: str):
+    # The SDKs take a second or two to import, so they are only loaded once a client
+    # is needed, e.g. not in replay mode.
+    import anthropic
+    import httpx
+    import openai
+
+    limits = httpx.Limits(
+        max_connections=_settings["pool_size"],
+        max_keepalive_connections=_settings["keepalive_connections"],
+        keepalive_expiry=_settings["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(
+        _settings["request_timeout"], connect=_settings["connect_timeout"]
+    )
+    http_client_options = {"limits": limits, "http2": _http2_available()}
+
+    if name == "openai":
+        http_client = openai.DefaultHttpxClient(**http_client_options)
+        return openai.OpenAI(http_client=http_client, timeout=timeout)
+    if name == "anthropic":
+        http_client = anthropic.DefaultHttpxClient(**http_client_options)
+        return anthropic.Anthropic(http_client=http_client, timeout=timeout)
+    raise ValueError(f"Unknown client: {name}")
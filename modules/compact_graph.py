@@ -0,0 +1,526 @@
+import json
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+from graph import Edge, EdgeMetadata, MoralGraph, Value, ValuesData
+from utils import serialize
+
+T = TypeVar("T")
+
+# Reused, as creating an encoder takes about as long as encoding a small object.
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+class _Rows(Sequence[T]):
+    """A read-only list whose items are built from the columns of a graph on access."""
+
+    def __init__(self, length: int, row: Callable[[int], T]):
+        self._length = length
+        self._row = row
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._row(j) for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("graph row index out of range")
+        return self._row(i)
+
+
+class StringColumn:
+    """
+    A read-only list of strings stored end to end in one UTF-8 buffer, which costs the
+    encoded string plus an 8 byte offset per item instead of a `str` object.
+
+    Attributes:
+        buffer (bytes): The encoded strings, end to end.
+        offsets (np.ndarray): String i is `buffer[offsets[i]:offsets[i + 1]]`.
+    """
+
+    def __init__(self, strings: Iterable[str]):
+        encoded = [s.encode() for s in strings]
+        self.buffer = b"".join(encoded)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(
+            np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)),
+            out=self.offsets[1:],
+        )
+
+    @classmethod
+    def from_buffer(cls, buffer: bytes, offsets: np.ndarray) -> "StringColumn":
+        column = cls.__new__(cls)
+        column.buffer = buffer
+        column.offsets = offsets
+        return column
+
+    @classmethod
+    def repeat(cls, text: str, n: int) -> "StringColumn":
+        """A column of `n` times the same string."""
+        encoded = text.encode()
+        return cls.from_buffer(
+            encoded * n, np.arange(n + 1, dtype=np.int64) * len(encoded)
+        )
+
+    @classmethod
+    def concat(cls, columns: List["StringColumn"]) -> "StringColumn":
+        if len(columns) == 1:
+            return columns[0]
+        starts = np.cumsum([0] + [len(c.buffer) for c in columns[:-1]])
+        return cls.from_buffer(
+            b"".join(c.buffer for c in columns),
+            np.concatenate(
+                [np.zeros(1, dtype=np.int64)]
+                + [c.offsets[1:] + start for c, start in zip(columns, starts)]
+            ),
+        )
+
+    @classmethod
+    def dumps(cls, objs: Iterable) -> "StringColumn":
+        """A column of the compact JSON of each object."""
+        return cls(map(_JSON_ENCODER.encode, objs))
+
+    def loads(self) -> list:
+        """The objects of a column of JSON, parsed in one go."""
+        return json.loads("[" + ",".join(self.tolist()) + "]")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.buffer[self.offsets[i] : self.offsets[i + 1]].decode()
+
+    def tolist(self) -> List[str]:
+        offsets = self.offsets.tolist()
+        return [
+            self.buffer[start:end].decode() for start, end in zip(offsets, offsets[1:])
+        ]
+
+    def take(self, indices: np.ndarray) -> "StringColumn":
+        """The column of the strings at `indices`, in their order."""
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # The buffer position of every byte of the new buffer.
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        buffer = np.frombuffer(self.buffer, dtype=np.uint8)[positions].tobytes()
+        return StringColumn.from_buffer(buffer, offsets)
+
+    def slice(self, start: int, stop: int) -> "StringColumn":
+        """The column of the strings from `start` up to `stop`."""
+        offsets = self.offsets[start : stop + 1]
+        return StringColumn.from_buffer(
+            self.buffer[offsets[0] : offsets[-1]], offsets - offsets[0]
+        )
+
+
+def _numbers(
+    strings: List[str], numbers: Dict[str, int], table: List[str]
+) -> np.ndarray:
+    """Number the strings by their position in `table`, adding those it lacks."""
+    for s in strings:
+        if s not in numbers:
+            numbers[s] = len(table)
+            table.append(s)
+    return np.fromiter(
+        (numbers[s] for s in strings), dtype=np.int32, count=len(strings)
+    )
+
+
+class CompactMoralGraph:
+    """
+    A read-only moral graph stored in columns, which takes a fraction of the memory of a
+    `MoralGraph` of the same values and edges.
+
+    Nodes are numbered: the values first, in graph order, then the edge endpoints that
+    are not values of the graph. Edges refer to nodes and contexts by number, so a graph
+    keeps one copy of each distinct id and context rather than three strings per edge.
+    Ids, titles, policies and edge metadata are packed in `StringColumn`s, the policies,
+    problems and improvements as JSON.
+
+    `values` and `edges` build `Value` and `Edge` objects on access, so each access gives
+    new objects. Changes to them don't change the graph.
+
+    Attributes:
+        ids (StringColumn): The id of each node.
+        n_values (int): The number of values.
+        titles (StringColumn): The title of each value.
+        policies (StringColumn): The policies of each value.
+        choice_contexts (np.ndarray): The context number of each value's choice context,
+            or -1 if it has none.
+        contexts (List[str]): The distinct edge and choice contexts.
+        sources (np.ndarray): The node number of each edge's `from_id`.
+        targets (np.ndarray): The node number of each edge's `to_id`.
+        edge_contexts (np.ndarray): The context number of each edge.
+        has_metadata (np.ndarray): Whether each edge has metadata. The metadata columns
+            of edges without are empty.
+        stories (StringColumn): The metadata story of each edge.
+        context_shifts (StringColumn): The metadata context shifts of each edge.
+        problems (StringColumn): The metadata problem of each edge.
+        improvements (StringColumn): The metadata improvements of each edge.
+        indptr (np.ndarray): The out-edges of node i, in CSR form, are the edges
+            `indices[indptr[i]:indptr[i + 1]]`.
+        indices (np.ndarray): The edge positions, ordered by source node.
+        seed_questions (List[str]): A list of seed questions for the graph.
+    """
+
+    def __init__(
+        self,
+        values: Dict[str, StringColumn],
+        edges: Dict[str, StringColumn | np.ndarray],
+        seed_questions: List[str] = [],
+    ):
+        """
+        Args:
+            values (dict): The "id", "title", "policies" (JSON) and "choice_context"
+                columns of the values, and optionally the "has_choice_context" array of
+                whether each value has a choice context (all do if it is missing).
+            edges (dict): The "from_id", "to_id", "context", "story", "context_shifts",
+                "problem" (JSON) and "improvements" (JSON) columns of the edges, and the
+                "metadata" array of whether each edge has metadata.
+            seed_questions (List[str]): A list of seed questions for the graph.
+        """
+        self.seed_questions = list(seed_questions)
+        self.n_values = len(values["id"])
+        self.titles = values["title"]
+        self.policies = values["policies"]
+        self.has_metadata = np.asarray(edges["metadata"], dtype=bool)
+        self.stories = edges["story"]
+        self.context_shifts = edges["context_shifts"]
+        self.problems = edges["problem"]
+        self.improvements = edges["improvements"]
+
+        self.contexts: List[str] = []
+        # Values without a choice context (null in the database) get number -1.
+        context_numbers: Dict[str | None, int] = {None: -1}
+        choice_contexts = values["choice_context"].tolist()
+        if "has_choice_context" in values:
+            choice_contexts = [
+                c if has else None
+                for c, has in zip(choice_contexts, values["has_choice_context"])
+            ]
+        self.choice_contexts = _numbers(choice_contexts, context_numbers, self.contexts)
+        self.edge_contexts = _numbers(
+            edges["context"].tolist(), context_numbers, self.contexts
+        )
+
+        ids = values["id"].tolist()
+        # Edges go to the first value of an id, as in `MoralGraph`.
+        positions = {id: node for node, id in reversed(list(enumerate(ids)))}
+        self.sources = _numbers(edges["from_id"].tolist(), positions, ids)
+        self.targets = _numbers(edges["to_id"].tolist(), positions, ids)
+        self.ids = values["id"] if len(ids) == self.n_values else StringColumn(ids)
+
+        self.indices = np.argsort(self.sources, kind="stable").astype(np.int32)
+        self.indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.sources, minlength=len(ids)), out=self.indptr[1:])
+        # The node numbers by id, built on the first lookup by id.
+        self._positions: Dict[str, int] | None = None
+
+    @classmethod
+    def from_rows(
+        cls,
+        values: Iterable[Tuple[str, str, List[str], str | None]],
+        edges: Iterable[Tuple[str, str, str, dict | None]],
+        seed_questions: List[str] = [],
+    ) -> "CompactMoralGraph":
+        """
+        Creates a graph from rows.
+
+        Args:
+            values: The id, title, policies and choice context of each value.
+            edges: The from id, to id, context and serialized metadata of each edge.
+            seed_questions (List[str]): A list of seed questions for the graph.
+
+        Returns:
+            CompactMoralGraph: The created graph.
+        """
+        values = list(zip(*values)) or [(), (), (), ()]
+        edges = list(zip(*edges)) or [(), (), (), ()]
+        metadata = edges[3]
+        return cls(
+            {
+                "id": StringColumn(values[0]),
+                "title": StringColumn(values[1]),
+                "policies": StringColumn.dumps(values[2]),
+                "choice_context": StringColumn(
+                    c if c is not None else "" for c in values[3]
+                ),
+                "has_choice_context": np.array(
+                    [c is not None for c in values[3]], dtype=bool
+                ),
+            },
+            {
+                "from_id": StringColumn(edges[0]),
+                "to_id": StringColumn(edges[1]),
+                "context": StringColumn(edges[2]),
+                "metadata": np.array([m is not None for m in metadata], dtype=bool),
+                "story": StringColumn(m["story"] if m else "" for m in metadata),
+                "context_shifts": StringColumn(
+                    m["context_shifts"] if m else "" for m in metadata
+                ),
+                "problem": StringColumn.dumps(
+                    m["problem"] if m else {} for m in metadata
+                ),
+                "improvements": StringColumn.dumps(
+                    m["improvements"] if m else [] for m in metadata
+                ),
+            },
+            seed_questions,
+        )
+
+    @property
+    def values(self) -> Sequence[Value]:
+        return _Rows(self.n_values, self._value)
+
+    @property
+    def edges(self) -> Sequence[Edge]:
+        return _Rows(len(self.sources), self._edge)
+
+    def _value(self, i: int) -> Value:
+        return Value(
+            ValuesData(
+                self.titles[i],
+                json.loads(self.policies[i]),
+                self._choice_context(self.choice_contexts[i]),
+            ),
+            self.ids[i],
+        )
+
+    def _choice_context(self, number: int) -> str | None:
+        return self.contexts[number] if number >= 0 else None
+
+    def _edge(self, i: int) -> Edge:
+        return Edge(
+            self.ids[self.sources[i]],
+            self.ids[self.targets[i]],
+            self.contexts[self.edge_contexts[i]],
+            (
+                EdgeMetadata(
+                    self.stories[i],
+                    self.context_shifts[i],
+                    json.loads(self.problems[i]),
+                    json.loads(self.improvements[i]),
+                )
+                if self.has_metadata[i]
+                else None
+            ),
+        )
+
+    def _node(self, id: str) -> int | None:
+        if self._positions is None:
+            ids = self.ids.tolist()
+            self._positions = {id: node for node, id in reversed(list(enumerate(ids)))}
+        return self._positions.get(id)
+
+    def get_value(self, id: str) -> Value | None:
+        """Get a value by its id, or None if the graph has no such value."""
+        node = self._node(id)
+        return self._value(node) if node is not None and node < self.n_values else None
+
+    def out_edges(self, id: str) -> List[Edge]:
+        """Get the edges from the node with the id, in graph order."""
+        node = self._node(id)
+        if node is None:
+            return []
+        positions = self.indices[self.indptr[node] : self.indptr[node + 1]]
+        return [self._edge(p) for p in positions.tolist()]
+
+    def value_columns(self) -> Dict[str, StringColumn]:
+        """The columns of the values, as `__init__` takes them."""
+        # Values without a choice context get an empty one, at the end.
+        contexts = StringColumn(self.contexts + [""])
+        has_choice_context = self.choice_contexts >= 0
+        return {
+            "id": self.ids.slice(0, self.n_values),
+            "title": self.titles,
+            "policies": self.policies,
+            "choice_context": contexts.take(
+                np.where(has_choice_context, self.choice_contexts, len(self.contexts))
+            ),
+            "has_choice_context": has_choice_context,
+        }
+
+    def edge_columns(self) -> Dict[str, StringColumn | np.ndarray]:
+        """The columns of the edges, as `__init__` takes them."""
+        contexts = StringColumn(self.contexts)
+        return {
+            "from_id": self.ids.take(self.sources),
+            "to_id": self.ids.take(self.targets),
+            "context": contexts.take(self.edge_contexts),
+            "metadata": self.has_metadata,
+            "story": self.stories,
+            "context_shifts": self.context_shifts,
+            "problem": self.problems,
+            "improvements": self.improvements,
+        }
+
+    def to_json(self):
+        """
+        Serializes the graph to a JSON-compatible dictionary, the same as the `MoralGraph`
+        of its values and edges would.
+
+        Returns:
+            dict: The serialized moral graph.
+        """
+        ids = self.ids.tolist()
+        values = [
+            {
+                "data": {
+                    "title": title,
+                    "policies": policies,
+                    "choice_context": self._choice_context(choice_context),
+                },
+                "id": id,
+            }
+            for id, title, policies, choice_context in zip(
+                ids,
+                self.titles.tolist(),
+                self.policies.loads(),
+                self.choice_contexts.tolist(),
+            )
+        ]
+        edges = [
+            {
+                "from_id": ids[source],
+                "to_id": ids[target],
+                "context": self.contexts[context],
+                "metadata": (
+                    {
+                        "context_shifts": context_shifts,
+                        "improvements": improvements,
+                        "problem": problem,
+                        "story": story,
+                    }
+                    if has_metadata
+                    else None
+                ),
+            }
+            for source, target, context, has_metadata, story, context_shifts, problem, improvements in zip(
+                self.sources.tolist(),
+                self.targets.tolist(),
+                self.edge_contexts.tolist(),
+                self.has_metadata.tolist(),
+                self.stories.tolist(),
+                self.context_shifts.tolist(),
+                self.problems.loads(),
+                self.improvements.loads(),
+            )
+        ]
+        return {
+            "values": values,
+            "edges": edges,
+            "seed_questions": list(self.seed_questions),
+        }
+
+    def to_nx_graph(self):
+        """
+        Converts the graph to a NetworkX directed graph, like `MoralGraph.to_nx_graph`.
+
+        Returns:
+            nx.DiGraph: The NetworkX directed graph.
+        """
+        import networkx as nx
+
+        G = nx.DiGraph()
+        for value in self.values:
+            G.add_node(
+                value.id,
+                title=value.data.title,
+                policies=value.data.policies,
+                choice_context=value.data.choice_context,
+            )
+        for edge in self.edges:
+            G.add_edge(
+                edge.from_id, edge.to_id, context=edge.context, metadata=edge.metadata
+            )
+        return G
+
+    def to_graph(self) -> MoralGraph:
+        """Converts the graph to a `MoralGraph`."""
+        return MoralGraph(
+            list(self.values), list(self.edges), list(self.seed_questions)
+        )
+
+    @classmethod
+    def from_graph(cls, graph: MoralGraph) -> "CompactMoralGraph":
+        """Creates a compact copy of a `MoralGraph`."""
+        return cls.from_rows(
+            (
+                (v.id, v.data.title, v.data.policies, v.data.choice_context)
+                for v in graph.values
+            ),
+            (
+                (e.from_id, e.to_id, e.context, serialize(e.metadata))
+                for e in graph.edges
+            ),
+            graph.seed_questions,
+        )
+
+    @classmethod
+    def from_json(cls, data) -> "CompactMoralGraph":
+        """
+        Creates a graph from the JSON-compatible dictionary of a `MoralGraph`, without
+        creating a `Value` or `Edge` for each of its values and edges.
+
+        Args:
+            data (dict): The JSON-compatible dictionary.
+
+        Returns:
+            CompactMoralGraph: The created graph.
+        """
+        return cls.from_rows(
+            (
+                (
+                    v["id"],
+                    v["data"]["title"],
+                    v["data"]["policies"],
+                    v["data"]["choice_context"],
+                )
+                for v in data["values"]
+            ),
+            (
+                (e["from_id"], e["to_id"], e["context"], e.get("metadata"))
+                for e in data["edges"]
+            ),
+            data.get("seed_questions", []),
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "CompactMoralGraph":
+        """
+        Creates a graph from a `MoralGraph` JSON file or a binary graph file.
+
+        Args:
+            path (str): The path to the JSON or binary graph file.
+
+        Returns:
+            CompactMoralGraph: The created graph.
+        """
+        from binary_graph import is_binary_graph, read_compact_graph
+
+        if is_binary_graph(path):
+            return read_compact_graph(path)
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls.from_json(data)
+
+    def save_to_file(self, path: str):
+        """
+        Saves the graph to a JSON file that `MoralGraph.from_file` can load, or to a
+        binary graph file if the path ends in ".mgraph".
+
+        Args:
+            path (str): The path to the file.
+        """
+        from binary_graph import SUFFIX, write_graph
+
+        if path.endswith(SUFFIX):
+            return write_graph(self, path)
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
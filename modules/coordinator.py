@@ -0,0 +1,663 @@
+import argparse
+from collections import Counter
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+from admission import (
+    BudgetExceeded,
+    add_admission_args,
+    configure_admission_from_args,
+)
+from generate import generate_question
+from hedging import add_hedging_args, configure_hedging_from_args, get_hedger
+from graph import Edge, Value
+from metrics import start_trace
+from seeds import default_sources, sample_seed_questions
+from utils import print_token_usage, serialize
+
+WORK_QUEUE_DB_FILE = "./data/work_queue.sqlite"
+# How long a worker holds an item without a heartbeat before others may take it over.
+LEASE_SECONDS = float(os.environ.get("WORK_LEASE_SECONDS", 300))
+HEARTBEAT_INTERVAL = float(os.environ.get("WORK_HEARTBEAT_INTERVAL", 30))
+# How often an item is leased (and so retried) before it is marked as failed.
+MAX_ATTEMPTS = int(os.environ.get("WORK_MAX_ATTEMPTS", 3))
+
+PENDING = "PENDING"
+LEASED = "LEASED"
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+class WorkItem:
+    """
+    A seed question leased by a worker.
+
+    Attributes:
+        id (int): The id of the item in the queue.
+        question (str): The seed question.
+        n_hops (int): The number of hops to generate for the question.
+        attempts (int): The number of times the item was leased, including this time.
+    """
+
+    def __init__(self, id: int, question: str, n_hops: int, attempts: int):
+        self.id = id
+        self.question = question
+        self.n_hops = n_hops
+        self.attempts = attempts
+
+
+class PrismaWorkQueue:
+    """
+    The seed questions of a generation run, queued in the `WorkItem` table.
+
+    Workers lease one item at a time. A lease expires unless the worker renews it with
+    `heartbeat`, after which another worker can take the item over, so questions of a
+    worker that died are retried. Leases are taken with `FOR UPDATE SKIP LOCKED`, so any
+    number of workers on any number of hosts can share the queue. Lease times are taken
+    from the database clock, so hosts don't need synchronized clocks.
+
+    Attributes:
+        generation_id (int): The generation run the items belong to.
+        max_attempts (int): How often an item is leased before it is marked as failed.
+    """
+
+    def __init__(self, generation_id: int, max_attempts: int = MAX_ATTEMPTS):
+        from prisma import Prisma
+
+        self.generation_id = generation_id
+        self.max_attempts = max_attempts
+        self._db = Prisma()
+        self._db.connect()
+
+    @staticmethod
+    def create_generation() -> int:
+        from prisma import Prisma
+
+        db = Prisma()
+        db.connect()
+        generation_id = db.generation.create({"gitCommitHash": "foobar"}).id
+        db.disconnect()
+        return generation_id
+
+    def enqueue(self, questions: List[str], n_hops: int) -> int:
+        """Queue seed questions, skipping ones already queued. Returns the number queued."""
+        return self._db.workitem.create_many(
+            [
+                {"question": q, "nHops": n_hops, "generationId": self.generation_id}
+                for q in questions
+            ],
+            skip_duplicates=True,
+        )
+
+    def lease(self, worker_id: str, lease_seconds: float = LEASE_SECONDS):
+        """Lease the next pending or expired item, or return None if there is none."""
+        # Items whose worker died on their last attempt are not retried.
+        self._db.execute_raw(
+            """
+            UPDATE "WorkItem" SET state = 'FAILED', "workerId" = NULL,
+                error = 'Lease expired on the last attempt', "updatedAt" = now()
+            WHERE "generationId" = $1 AND state = 'LEASED'
+                AND "leaseExpiresAt" < now() AND attempts >= $2
+            """,
+            self.generation_id,
+            self.max_attempts,
+        )
+        rows = self._db.query_raw(
+            """
+            UPDATE "WorkItem" SET state = 'LEASED', "workerId" = $1,
+                attempts = attempts + 1, "updatedAt" = now(),
+                "leaseExpiresAt" = now() + make_interval(secs => $2)
+            WHERE id = (
+                SELECT id FROM "WorkItem"
+                WHERE "generationId" = $3 AND attempts < $4 AND (
+                    state = 'PENDING' OR (state = 'LEASED' AND "leaseExpiresAt" < now())
+                )
+                ORDER BY id LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, question, "nHops", attempts
+            """,
+            worker_id,
+            float(lease_seconds),
+            self.generation_id,
+            self.max_attempts,
+        )
+        if not rows:
+            return None
+        row = rows[0]
+        return WorkItem(row["id"], row["question"], row["nHops"], row["attempts"])
+
+    def heartbeat(self, worker_id: str, lease_seconds: float = LEASE_SECONDS):
+        """Renew the leases of all items held by a worker."""
+        self._db.execute_raw(
+            """
+            UPDATE "WorkItem" SET "leaseExpiresAt" = now() + make_interval(secs => $1)
+            WHERE "generationId" = $2 AND "workerId" = $3 AND state = 'LEASED'
+            """,
+            float(lease_seconds),
+            self.generation_id,
+            worker_id,
+        )
+
+    def complete(
+        self, item: WorkItem, worker_id: str, values: List[Value], edges: List[Edge]
+    ) -> bool:
+        """
+        Write the values and edges of an item and mark it as done, in one transaction.
+
+        Returns:
+            bool: False if the worker lost its lease in the meantime, in which case
+                nothing is written, since another worker took over the item.
+        """
+        from prisma import Json
+
+        with self._db.tx() as tx:
+            updated = tx.workitem.update_many(
+                where={"id": item.id, "workerId": worker_id, "state": LEASED},
+                data={"state": DONE, "leaseExpiresAt": None},
+            )
+            if not updated:
+                return False
+            uuid_to_id = {
+                value.id: tx.valuescard.create(
+                    {
+                        "title": value.data.title,
+                        "policies": value.data.policies,
+                        "generationId": self.generation_id,
+                        "choiceContext": value.data.choice_context,
+                    }
+                ).id
+                for value in values
+            }
+            tx.edge.create_many(
+                [
+                    {
+                        "fromId": uuid_to_id[edge.from_id],
+                        "toId": uuid_to_id[edge.to_id],
+                        "metadata": Json({**dict(serialize(edge.metadata))}),
+                        "contextName": edge.context,
+                        "generationId": self.generation_id,
+                    }
+                    for edge in edges
+                ],
+                skip_duplicates=True,
+            )
+        return True
+
+    def fail(self, item: WorkItem, worker_id: str, error: str):
+        """Release an item after an error, to be retried unless it ran out of attempts."""
+        self._db.workitem.update_many(
+            where={"id": item.id, "workerId": worker_id, "state": LEASED},
+            data={
+                "state": FAILED if item.attempts >= self.max_attempts else PENDING,
+                "workerId": None,
+                "leaseExpiresAt": None,
+                "error": error,
+            },
+        )
+
+    def release(self, item: WorkItem, worker_id: str):
+        """Put an item back without counting the attempt, e.g. when a worker stops."""
+        self._db.workitem.update_many(
+            where={"id": item.id, "workerId": worker_id, "state": LEASED},
+            data={
+                "state": PENDING,
+                "workerId": None,
+                "leaseExpiresAt": None,
+                "attempts": {"decrement": 1},
+            },
+        )
+
+    def counts(self) -> Dict[str, int]:
+        """The number of items per state."""
+        return {
+            state: self._db.workitem.count(
+                where={"generationId": self.generation_id, "state": state}
+            )
+            for state in [PENDING, LEASED, DONE, FAILED]
+        }
+
+    def finish(self):
+        """Mark the generation as finished."""
+        from prisma.enums import ProcessState
+
+        self._db.generation.update(
+            {"state": ProcessState.FINISHED}, where={"id": self.generation_id}
+        )
+
+
+class SqliteWorkQueue:
+    """
+    A local stand-in for `PrismaWorkQueue`, with the same interface, backed by SQLite.
+
+    Values and edges are written to tables of the same database, mirroring the Prisma
+    schema. The queue can be shared by the worker processes of one host.
+
+    Attributes:
+        generation_id (int): The generation run the items belong to.
+        path (str): The path to the SQLite database file.
+        max_attempts (int): How often an item is leased before it is marked as failed.
+    """
+
+    def __init__(
+        self,
+        generation_id: int,
+        path: str = WORK_QUEUE_DB_FILE,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.generation_id = generation_id
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = _connect_sqlite(path)
+
+    @staticmethod
+    def create_generation(path: str = WORK_QUEUE_DB_FILE) -> int:
+        conn = _connect_sqlite(path)
+        generation_id = conn.execute(
+            "INSERT INTO generations (state) VALUES ('IN_PROGRESS')"
+        ).lastrowid
+        conn.close()
+        return generation_id
+
+    def enqueue(self, questions: List[str], n_hops: int) -> int:
+        """Queue seed questions, skipping ones already queued. Returns the number queued."""
+        with self._lock, self._transaction():
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO work_items (generation_id, question, n_hops) VALUES (?, ?, ?)",
+                [(self.generation_id, q, n_hops) for q in questions],
+            )
+            return self._conn.total_changes - before
+
+    def lease(self, worker_id: str, lease_seconds: float = LEASE_SECONDS):
+        """Lease the next pending or expired item, or return None if there is none."""
+        now = time.time()
+        with self._lock, self._transaction():
+            # Items whose worker died on their last attempt are not retried.
+            self._conn.execute(
+                """
+                UPDATE work_items SET state = 'FAILED', worker_id = NULL,
+                    error = 'Lease expired on the last attempt'
+                WHERE generation_id = ? AND state = 'LEASED'
+                    AND lease_expires_at < ? AND attempts >= ?
+                """,
+                (self.generation_id, now, self.max_attempts),
+            )
+            row = self._conn.execute(
+                """
+                SELECT id FROM work_items
+                WHERE generation_id = ? AND attempts < ? AND (
+                    state = 'PENDING' OR (state = 'LEASED' AND lease_expires_at < ?)
+                )
+                ORDER BY id LIMIT 1
+                """,
+                (self.generation_id, self.max_attempts, now),
+            ).fetchone()
+            if row is None:
+                return None
+            row = self._conn.execute(
+                """
+                UPDATE work_items SET state = 'LEASED', worker_id = ?,
+                    attempts = attempts + 1, lease_expires_at = ?
+                WHERE id = ?
+                RETURNING id, question, n_hops, attempts
+                """,
+                (worker_id, now + lease_seconds, row[0]),
+            ).fetchone()
+        return WorkItem(*row)
+
+    def heartbeat(self, worker_id: str, lease_seconds: float = LEASE_SECONDS):
+        """Renew the leases of all items held by a worker."""
+        with self._lock, self._transaction():
+            self._conn.execute(
+                """
+                UPDATE work_items SET lease_expires_at = ?
+                WHERE generation_id = ? AND worker_id = ? AND state = 'LEASED'
+                """,
+                (time.time() + lease_seconds, self.generation_id, worker_id),
+            )
+
+    def complete(
+        self, item: WorkItem, worker_id: str, values: List[Value], edges: List[Edge]
+    ) -> bool:
+        """
+        Write the values and edges of an item and mark it as done, in one transaction.
+
+        Returns:
+            bool: False if the worker lost its lease in the meantime, in which case
+                nothing is written, since another worker took over the item.
+        """
+        with self._lock, self._transaction():
+            updated = self._conn.execute(
+                """
+                UPDATE work_items SET state = 'DONE', lease_expires_at = NULL
+                WHERE id = ? AND worker_id = ? AND state = 'LEASED'
+                """,
+                (item.id, worker_id),
+            ).rowcount
+            if not updated:
+                return False
+            uuid_to_id = {
+                value.id: self._conn.execute(
+                    "INSERT INTO values_cards (generation_id, title, policies, choice_context) VALUES (?, ?, ?, ?)",
+                    (
+                        self.generation_id,
+                        value.data.title,
+                        json.dumps(value.data.policies),
+                        value.data.choice_context,
+                    ),
+                ).lastrowid
+                for value in values
+            }
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO edges (generation_id, from_id, to_id, context_name, metadata) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        self.generation_id,
+                        uuid_to_id[edge.from_id],
+                        uuid_to_id[edge.to_id],
+                        edge.context,
+                        json.dumps(dict(serialize(edge.metadata))),
+                    )
+                    for edge in edges
+                ],
+            )
+        return True
+
+    def fail(self, item: WorkItem, worker_id: str, error: str):
+        """Release an item after an error, to be retried unless it ran out of attempts."""
+        with self._lock, self._transaction():
+            self._conn.execute(
+                """
+                UPDATE work_items SET state = ?, worker_id = NULL,
+                    lease_expires_at = NULL, error = ?
+                WHERE id = ? AND worker_id = ? AND state = 'LEASED'
+                """,
+                (
+                    FAILED if item.attempts >= self.max_attempts else PENDING,
+                    error,
+                    item.id,
+                    worker_id,
+                ),
+            )
+
+    def release(self, item: WorkItem, worker_id: str):
+        """Put an item back without counting the attempt, e.g. when a worker stops."""
+        with self._lock, self._transaction():
+            self._conn.execute(
+                """
+                UPDATE work_items SET state = 'PENDING', worker_id = NULL,
+                    lease_expires_at = NULL, attempts = attempts - 1
+                WHERE id = ? AND worker_id = ? AND state = 'LEASED'
+                """,
+                (item.id, worker_id),
+            )
+
+    def counts(self) -> Dict[str, int]:
+        """The number of items per state."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM work_items WHERE generation_id = ? GROUP BY state",
+                (self.generation_id,),
+            ).fetchall()
+        return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def finish(self):
+        """Mark the generation as finished."""
+        with self._lock, self._transaction():
+            self._conn.execute(
+                "UPDATE generations SET state = 'FINISHED' WHERE id = ?",
+                (self.generation_id,),
+            )
+
+    def _transaction(self):
+        # Take the write lock up front, so that two processes can't lease the same item.
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+
+def _connect_sqlite(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Transactions are managed explicitly, see `SqliteWorkQueue._transaction`.
+    conn = sqlite3.connect(
+        path, timeout=30, check_same_thread=False, isolation_level=None
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            state TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS work_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            generation_id INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            n_hops INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            lease_expires_at REAL,
+            error TEXT,
+            UNIQUE (generation_id, question)
+        );
+        CREATE TABLE IF NOT EXISTS values_cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            generation_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            policies TEXT NOT NULL,
+            choice_context TEXT
+        );
+        CREATE TABLE IF NOT EXISTS edges (
+            generation_id INTEGER NOT NULL,
+            from_id INTEGER NOT NULL,
+            to_id INTEGER NOT NULL,
+            context_name TEXT NOT NULL,
+            metadata TEXT,
+            PRIMARY KEY (from_id, to_id, context_name)
+        );
+        """)
+    return conn
+
+
+def make_work_queue(
+    backend: str, generation_id: int, path: str = WORK_QUEUE_DB_FILE
+) -> PrismaWorkQueue | SqliteWorkQueue:
+    """The work queue of a generation run, in the database ("prisma") or in SQLite."""
+    if backend == "sqlite":
+        return SqliteWorkQueue(generation_id, path)
+    return PrismaWorkQueue(generation_id)
+
+
+def run_worker(
+    queue: PrismaWorkQueue | SqliteWorkQueue,
+    threads: int = 1,
+    poll_interval: float = 10.0,
+    lease_seconds: float = LEASE_SECONDS,
+    heartbeat_interval: float = HEARTBEAT_INTERVAL,
+) -> int:
+    """
+    Generate the queued seed questions until none are left, writing each question's
+    values and edges as it is done.
+
+    While items are leased by other workers, the worker keeps polling, so it takes over
+    the items of workers that stop sending heartbeats. The last worker to finish marks
+    the generation as finished. A worker that runs out of budget (see
+    `configure_admission`) puts its items back and stops.
+
+    Args:
+        queue: The work queue of the generation run.
+        threads: The number of questions to generate at once.
+        poll_interval: How long to wait for other workers' leases to expire, in seconds.
+
+    Returns:
+        int: The number of questions this worker completed.
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    token_counter = Counter()
+    completed = []
+    stopped = threading.Event()
+    out_of_budget = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_interval):
+            # A failed heartbeat is retried on the next interval, so the leases only
+            # expire if the database stays unreachable.
+            try:
+                queue.heartbeat(worker_id, lease_seconds)
+            except Exception as e:
+                print(f"Worker {worker_id} failed to renew its leases: {e}")
+
+    def fail(item: WorkItem, error: Exception):
+        try:
+            queue.fail(item, worker_id, f"{type(error).__name__}: {error}")
+        except Exception as e:
+            print(
+                f"Failed to release {item.question}, retrying it once its lease expires: {e}"
+            )
+
+    def work():
+        while not out_of_budget.is_set():
+            try:
+                item = queue.lease(worker_id, lease_seconds)
+                if item is None:
+                    counts = queue.counts()
+                    if not counts[PENDING] and not counts[LEASED]:
+                        return
+            except Exception as e:
+                print(f"Worker {worker_id} failed to lease an item: {e}")
+                item = None
+            if item is None:
+                time.sleep(poll_interval)
+                continue
+
+            print(f"Worker {worker_id} generating seed question:", item.question)
+            try:
+                values, edges = generate_question(
+                    item.question, item.n_hops, token_counter
+                )
+            except BudgetExceeded as e:
+                print(f"Worker {worker_id} stopping: {e}.")
+                try:
+                    queue.release(item, worker_id)
+                except Exception as release_error:
+                    print(f"Failed to release {item.question}: {release_error}")
+                out_of_budget.set()
+                return
+            except Exception as e:
+                print(f"Failed to generate question {item.question}: {e}")
+                fail(item, e)
+                continue
+            try:
+                saved = queue.complete(item, worker_id, values, edges)
+            except Exception as e:
+                print(f"Failed to save question {item.question}: {e}")
+                fail(item, e)
+                continue
+            if saved:
+                completed.append(item.id)
+            else:
+                print(f"Lost the lease of {item.question}, discarding its results.")
+
+    trace = start_trace("worker")
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stopped.set()
+
+    counts = queue.counts()
+    if not counts[PENDING] and not counts[LEASED] and not out_of_budget.is_set():
+        queue.finish()
+    print(f"Worker {worker_id} completed {len(completed)} questions. Queue: {counts}")
+    print_token_usage(token_counter)
+    trace.print_summary()
+    hedger = get_hedger()
+    if hedger:
+        hedger.print_summary()
+    return len(completed)
+
+
+if __name__ == "__main__":
+    """Queue seed questions of a generation run, or work on them."""
+
+    parser = argparse.ArgumentParser(
+        description="Coordinate a generation run across many workers through a work queue."
+    )
+    parser.add_argument("command", choices=["enqueue", "work", "status"])
+    parser.add_argument(
+        "--generation_id",
+        type=int,
+        help="The generation run. `enqueue` creates a new one if not set.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["prisma", "sqlite"],
+        default="prisma",
+        help="Keep the queue in the database, or in a local SQLite stand-in.",
+    )
+    parser.add_argument(
+        "--db_path",
+        default=WORK_QUEUE_DB_FILE,
+        help="The SQLite database of the stand-in backend.",
+    )
+    parser.add_argument(
+        "--n_questions",
+        type=int,
+        default=25,
+        help="The number of seed questions to enqueue.",
+    )
+    parser.add_argument(
+        "--n_hops",
+        type=int,
+        default=2,
+        help="The number of hops to generate for each enqueued seed question.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The seed for sampling the enqueued seed questions.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="The number of questions a worker generates at once.",
+    )
+    add_admission_args(parser)
+    add_hedging_args(parser)
+    args = parser.parse_args()
+    configure_admission_from_args(parser, args)
+    configure_hedging_from_args(parser, args)
+
+    generation_id = args.generation_id
+    if generation_id is None:
+        if args.command != "enqueue":
+            parser.error("--generation_id is required")
+        generation_id = (
+            SqliteWorkQueue.create_generation(args.db_path)
+            if args.backend == "sqlite"
+            else PrismaWorkQueue.create_generation()
+        )
+    queue = make_work_queue(args.backend, generation_id, args.db_path)
+
+    if args.command == "enqueue":
+        questions = sample_seed_questions(
+            default_sources(), args.n_questions, seed=args.seed
+        )
+        n = queue.enqueue(list(questions), args.n_hops)
+        print(f"Queued {n} seed questions for generation {generation_id}.")
+    elif args.command == "work":
+        run_worker(queue, threads=args.threads)
+    else:
+        print(f"Generation {generation_id}: {queue.counts()}")
@@ -1,14 +1,22 @@
 import argparse
 from collections import Counter
 from typing import List
-from openai import OpenAI
 from pydantic import BaseModel
 import json
-from prisma import Json, Prisma
+import sys
+from prisma import Json
 from prisma.models import DeduplicatedCard, ValuesCard
 from prisma.enums import ProcessState
 from tqdm import tqdm
+from admission import (
+    BudgetExceeded,
+    add_admission_args,
+    configure_admission_from_args,
+)
+from batch import BatchPending, BatchService, get_batch_service, run_batched
+from clients import get_db
 from llms import gpt4, sonnet
+from metrics import span, start_trace
 
 from prompt_segments import attentional_policy_definition, attentional_policy_guidelines
 
@@ -26,10 +34,6 @@ class CardWithDistance(DeduplicatedCard):
     distance: float
 
 
-db = Prisma()
-client = OpenAI()
-
-
 dedupe_cards_prompt = f"""You are given a values card and a list of other canonical values cards. Determine if the value in the input values card is already represented by one of the canonical values. If so, return the id of the canonical values card that represents the source of meaning.
 
 A values card is made up of a set of attentional policies.
@@ -73,6 +77,8 @@ dedupe_function = {
 def _fetch_duplicate_card(
     candidate: ValuesCard, cards: List[ValuesCard]
 ) -> ValuesCard | None:
+    # Only the exact and normalized cache tiers apply: the prompts of one run differ
+    # only in the short input card, so similar prompts are usually other candidates.
     user_prompt = json.dumps(
         {
             "input_values_card": {"policies": candidate.policies},
@@ -82,21 +88,25 @@ def _fetch_duplicate_card(
         }
     )
     try:
-        response = gpt4(
-            user_prompt,
-            dedupe_cards_prompt,
-            function=dedupe_function,
-            token_counter=counter,
-        )
-        assert isinstance(response, dict)
-        matching_id = response["canonical_card_id"]
-        return next((c for c in cards if c.id == matching_id), None)
+        with span("dedupe-card"):
+            response = gpt4(
+                user_prompt,
+                dedupe_cards_prompt,
+                function=dedupe_function,
+                token_counter=counter,
+            )
+            assert isinstance(response, dict)
+            matching_id = response["canonical_card_id"]
+            return next((c for c in cards if c.id == matching_id), None)
+    except (BatchPending, BudgetExceeded):
+        raise
     except Exception as e:
         print("Error fetching duplicate card: ", e)
         return None
 
 
 def _create_deduplicated_card(card: ValuesCard, deduplication_id: int):
+    db = get_db()
     canonical = db.deduplicatedcard.create(
         data={
             "title": card.title,
@@ -109,6 +119,7 @@ def _create_deduplicated_card(card: ValuesCard, deduplication_id: int):
 
 
 def _merge_deduplicate_cards(db_duplicate_1, db_duplicate_2, deduplication_id):
+    db = get_db()
     print(f"Merging deduplicated cards {db_duplicate_1.id} and {db_duplicate_2.id}...")
 
     try:
@@ -152,6 +163,7 @@ def _merge_deduplicate_cards(db_duplicate_1, db_duplicate_2, deduplication_id):
 def _link_to_deduplicated_card(
     values_card_id: int, deduplicated_card_id: int, deduplication_id: int
 ):
+    db = get_db()
     db.valuescardtodeduplicatedcard.upsert(
         where={
             "valuesCardId_deduplicatedCardId_deduplicationId": {
@@ -176,6 +188,7 @@ def _link_to_deduplicated_card(
 
 
 def _get_or_create_deduplication():
+    db = get_db()
     if not db.is_connected():
         db.connect()
     deduplication = db.deduplication.find_first(
@@ -193,15 +206,12 @@ def _get_or_create_deduplication():
     return deduplication
 
 
-def _deduplicate_cards_for_contexts(
+def _get_cards_for_contexts(
     deduplication_id: int, generation_id: int, contexts: List[str]
-) -> None:
-    """Deduplicate cards for a set of contexts for the latest deduplication generation."""
-    if not db.is_connected():
-        db.connect()
-
-    # Get all cards that have not been deduplicated yet that is either linked to or from one of the contexts.
-    cards = db.valuescard.find_many(
+) -> List[ValuesCard]:
+    """Get all cards that have not been deduplicated yet that is either linked to or from one of the contexts."""
+    db = get_db()
+    return db.valuescard.find_many(
         where={
             "generationId": generation_id,
             "ValuesCardToDeduplicatedCard": {
@@ -214,6 +224,17 @@ def _deduplicate_cards_for_contexts(
         },
     )
 
+
+def _deduplicate_cards_for_contexts(
+    deduplication_id: int, generation_id: int, contexts: List[str]
+) -> None:
+    """Deduplicate cards for a set of contexts for the latest deduplication generation."""
+    db = get_db()
+    if not db.is_connected():
+        db.connect()
+
+    cards = _get_cards_for_contexts(deduplication_id, generation_id, contexts)
+
     print(
         f"Deduplicating {len(cards)} cards for {len(contexts)} contexts ({', '.join(contexts)})..."
     )
@@ -272,12 +293,9 @@ def _deduplicate_cards_for_contexts(
     db.disconnect()
 
 
-def _deduplicate_contexts(deduplication_id: int, generation_id: int):
-    """Deduplicate all contexts."""
-    if not db.is_connected():
-        db.connect()
-
-    # Find all contexts.
+def _get_contexts(deduplication_id: int, generation_id: int) -> List[str]:
+    """Find all contexts of edges that have not been deduplicated yet."""
+    db = get_db()
     contexts = [
         e.contextName
         for e in db.edge.find_many(
@@ -289,15 +307,30 @@ def _deduplicate_contexts(deduplication_id: int, generation_id: int):
             }
         )
     ]
-    contexts = sorted(list(set(contexts)))
+    return sorted(list(set(contexts)))
+
+
+def _fetch_context_clusters(contexts: List[str]) -> str:
+    with span("dedupe-context"):
+        return sonnet(
+            "\n".join(contexts),
+            dedupe_contexts_prompt,
+            temperature=0.0,
+            max_tokens=8192,
+            token_counter=counter,
+        )
+
+
+def _deduplicate_contexts(deduplication_id: int, generation_id: int):
+    """Deduplicate all contexts."""
+    db = get_db()
+    if not db.is_connected():
+        db.connect()
+
+    contexts = _get_contexts(deduplication_id, generation_id)
     print(f"Deduplicating {len(contexts)} unique contexts...")
 
-    response = sonnet(
-        "\n".join(contexts),
-        dedupe_contexts_prompt,
-        temperature=0.0,
-        max_tokens=8192,
-    )
+    response = _fetch_context_clusters(contexts)
     clusters = response.strip().split("\n\n")
     clusters = [c.split("\n") for c in clusters]
 
@@ -335,6 +368,7 @@ def _deduplicate_edges(
     deduplication_id: int, generation_id: int, context_mapping: dict
 ) -> None:
     """Deduplicate all edges for the latest deduplication generation."""
+    db = get_db()
     if not db.is_connected():
         db.connect()
 
@@ -445,6 +479,7 @@ def _deduplicate_edges(
 
 
 def _finish_deduplication(deduplication_id: int):
+    db = get_db()
     db.connect()
     db.deduplication.update(
         where={"id": deduplication_id}, data={"state": ProcessState.FINISHED}
@@ -452,8 +487,47 @@ def _finish_deduplication(deduplication_id: int):
     db.disconnect()
 
 
-def deduplicate(generation_id: int | None = None):
-    token_counter = Counter()
+def _prefetch_in_batches(
+    deduplication_id: int, generation_id: int, batch_service: BatchService
+):
+    """
+    Warm the response cache with batch jobs for the LLM calls of a deduplication.
+
+    The context clusters are fetched first, then the duplicate card lookups for every
+    card in every cluster. The deduplication itself then runs against the cache. Lookups
+    whose prompts change while deduplicating (e.g. because a card in several clusters was
+    already deduplicated) fall back to live calls.
+    """
+    db = get_db()
+    if not db.is_connected():
+        db.connect()
+
+    contexts = _get_contexts(deduplication_id, generation_id)
+    (response,) = run_batched(
+        _fetch_context_clusters, [contexts], batch_service, name="dedupe-context"
+    )
+    clusters = [c.split("\n") for c in response.strip().split("\n\n")]
+    clustered = {c for cluster in clusters for c in cluster}
+    clusters += [[c] for c in contexts if c not in clustered]
+
+    lookups = []
+    for cluster in clusters:
+        cards = _get_cards_for_contexts(deduplication_id, generation_id, cluster)
+        lookups += [(card, [c for c in cards if c.id != card.id]) for card in cards]
+
+    run_batched(
+        lambda lookup: _fetch_duplicate_card(*lookup),
+        lookups,
+        batch_service,
+        name="dedupe-card",
+    )
+    db.disconnect()
+
+
+def deduplicate(
+    generation_id: int | None = None, batch_service: BatchService | None = None
+):
+    db = get_db()
     # If no generation_id is provided, use the latest generation.
     if generation_id is None:
         db.connect()
@@ -466,6 +540,11 @@ def deduplicate(generation_id: int | None = None):
 
     # Create or continue deduplication run.
     deduplication = _get_or_create_deduplication()
+    trace = start_trace(f"deduplicate_{deduplication.id}")
+
+    # Batch the LLM calls up front, if requested.
+    if batch_service:
+        _prefetch_in_batches(deduplication.id, generation_id, batch_service)
 
     # Deduplicate contexts.
     clusters, mapping = _deduplicate_contexts(deduplication.id, generation_id)
@@ -481,10 +560,8 @@ def deduplicate(generation_id: int | None = None):
     # Mark the deduplication as finished.
     _finish_deduplication(deduplication.id)
     print(f"Finished deduplication {deduplication.id}.")
-    print(
-        "price: ",
-        gp4o_price(token_counter),
-    )
+    print_token_usage(counter)
+    trace.print_summary()
 
 
 if __name__ == "__main__":
@@ -495,5 +572,23 @@ if __name__ == "__main__":
         type=int,
         help="The generation to deduplicate.",
     )
+    parser.add_argument(
+        "--batch",
+        choices=["provider", "local"],
+        help="Submit the LLM calls as batch jobs to the provider batch APIs (or a local stand-in) before deduplicating.",
+    )
+    add_admission_args(parser)
     args = parser.parse_args()
-    deduplicate(args.generation_id)
+    configure_admission_from_args(parser, args)
+    try:
+        deduplicate(
+            args.generation_id,
+            batch_service=get_batch_service(args.batch) if args.batch else None,
+        )
+    except BudgetExceeded as e:
+        # The deduplication stays in progress, and the next run continues it.
+        print(
+            f"{e}. Run again to resume. The budget applies to each invocation, so the "
+            "resumed run can spend it again."
+        )
+        sys.exit(1)
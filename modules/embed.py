@@ -1,21 +1,20 @@
 import json
-from typing import List
-from openai import OpenAI
+from typing import TYPE_CHECKING, List
 
-from prisma import Prisma
 from tqdm import tqdm
-from prisma.models import DeduplicatedCard, ValuesCard
 
-db = Prisma()
-client = OpenAI()
+from clients import get_client, get_db
 
+if TYPE_CHECKING:
+    from prisma.models import DeduplicatedCard, ValuesCard
 
-def embed_card(card: ValuesCard | DeduplicatedCard) -> List[float]:
+
+def embed_card(card: "ValuesCard | DeduplicatedCard") -> List[float]:
     text = (
         "It feels meaningful to pay attention to the following in certain choices for me:\n"
         + "\n".join(card.policies)
     )
-    response = client.embeddings.create(
+    response = get_client("openai").embeddings.create(
         model="text-embedding-3-large", input=text, dimensions=1536
     )
     return response.data[0].embedding
@@ -23,7 +22,9 @@ def embed_card(card: ValuesCard | DeduplicatedCard) -> List[float]:
 
 def embed_cards(generation_id: int):
     """Embed all ValuesCards for a generation."""
+    from prisma.models import ValuesCard
 
+    db = get_db()
     if not db.is_connected():
         db.connect()
 
@@ -41,7 +42,9 @@ def embed_cards(generation_id: int):
 
 def embed_all_cards():
     """Embed all ValuesCards."""
+    from prisma.models import ValuesCard
 
+    db = get_db()
     if not db.is_connected():
         db.connect()
 
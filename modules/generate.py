@@ -1,24 +1,59 @@
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import partial
+import glob
+import hashlib
+import json
 import os
-from pathlib import Path
+import sys
+import threading
 import time
-from typing import List, Tuple
-
-from datasets import load_dataset, Dataset
-
-from tqdm import tqdm
+from typing import Dict, Iterator, List, Tuple
+
+from admission import (
+    BudgetExceeded,
+    add_admission_args,
+    configure_admission_from_args,
+)
+from batch import BatchPending, BatchService, get_batch_service, run_batched
+from hedging import add_hedging_args, configure_hedging_from_args, get_hedger
 from llms import gpt4, sonnet
-from graph import Edge, EdgeMetadata, MoralGraph, Value, ValuesData
-from utils import gp4o_price, parse_to_dict, retry
+from pipeline import Stage, run_pipeline
+from providers import get_provider
+from graph import Edge, EdgeMetadata, GraphJournal, MoralGraph, Value, ValuesData
+from utils import jaccard_similarity, parse_to_dict, print_token_usage
+from metrics import start_trace
+from seeds import default_sources, parse_shard, sample_seed_questions
+from retries import StageFailed, run_stage
 from prompt_segments import *
 
 import argparse
 
-policies_file = open("guidance/policies.md", "r", encoding="utf-8")
-policies_manual = policies_file.read()
+# Responses without a section header this far in are considered malformed.
+max_preamble_chars = 2000
+
+# Journals of generation runs, used to resume them.
+runs_dir = "./data/runs"
+
+# The sampling temperature of the extra upgrades of a value when branching.
+branch_temperature = 0.8
+
+# How many questions each stage of the pipelined scheduler works on at once. The value
+# stage calls gpt-4o, the others sonnet. "upgrade" also bounds the concurrent upgrades
+# of a level when branching.
+stage_concurrency = {"context": 8, "value": 16, "stories": 8, "upgrade": 8}
 
-choice_types_file = open("guidance/choice-types.md", "r", encoding="utf-8")
-choice_types_manual = choice_types_file.read()
+# The guidance manuals, found relative to the package so any working directory works.
+guidance_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "guidance"
+)
+
+with open(os.path.join(guidance_dir, "policies.md"), "r", encoding="utf-8") as file:
+    policies_manual = file.read()
+
+with open(os.path.join(guidance_dir, "choice-types.md"), "r", encoding="utf-8") as file:
+    choice_types_manual = file.read()
 
 
 gen_context_prompt = f"""Imagine a user says the below.
@@ -165,21 +200,47 @@ Finally, generate a 3-5 word title which sums up the revised attentional policie
 """
 
 
-@retry(times=3)
-def generate_value(
-    question: str, token_counter: Counter | None = None
-) -> Tuple[ValuesData, str]:
-    print("\n\n### Generating context")
+def _generate_context(
+    question: str, token_counter: Counter | None = None, attempt: int = 1
+) -> str:
     user_prompt1 = "# What the user says\n\n" + question
-    response1 = str(sonnet(user_prompt1, gen_context_prompt))
+    response1 = str(
+        sonnet(
+            user_prompt1,
+            gen_context_prompt,
+            caching_enabled=attempt == 1,
+            token_counter=token_counter,
+            required_sections=["Final Choice Type"],
+            max_preamble_chars=max_preamble_chars,
+        )
+    )
     response_dict = parse_to_dict(response1)
     context = response_dict["Final Choice Type"]
     print(response1)
     print("context", context)
-    print("\n\n### Generating value")
+    return context
+
+
+def _generate_values_data(
+    question: str,
+    context: str,
+    token_counter: Counter | None = None,
+    attempt: int = 1,
+) -> ValuesData:
     user_prompt2 = "# Question\n\n" + question + "\n\n" "# X\n\n" + context
     print(user_prompt2)
-    response2 = str(gpt4(gen_value_prompt, user_prompt2, token_counter=token_counter))
+    # The static, manual-laden prompt goes first, so it can be served from the
+    # provider's prompt cache.
+    response2 = str(
+        gpt4(
+            user_prompt2,
+            gen_value_prompt,
+            caching_enabled=attempt == 1,
+            token_counter=token_counter,
+            required_sections=["Attentional Policies Revised", "Title"],
+            max_preamble_chars=max_preamble_chars,
+        )
+    )
     print(response2)
     response_dict = parse_to_dict(response2)
     response_dict["Question"] = question
@@ -189,42 +250,89 @@ def generate_value(
     ]
     title = response_dict["Title"]
     policies = response_dict["Attentional Policies Revised"]
-    values_data = ValuesData(title=title, policies=policies, choice_context=context)
+    return ValuesData(title=title, policies=policies, choice_context=context)
+
+
+def generate_value(
+    question: str, token_counter: Counter | None = None
+) -> Tuple[ValuesData, str]:
+    """Generates the context and the first value for a seed question.
+
+    Each of the two stages is retried on its own, so a value that fails to parse
+    doesn't cost a new context.
+
+    Raises:
+        StageFailed: If a stage failed on all attempts.
+    """
+    print("\n\n### Generating context")
+    context = run_stage(
+        "context", lambda attempt: _generate_context(question, token_counter, attempt)
+    )
+    print("\n\n### Generating value")
+    values_data = run_stage(
+        "value",
+        lambda attempt: _generate_values_data(
+            question, context, token_counter, attempt
+        ),
+    )
     return values_data, context
 
 
-@retry(times=3)
-def generate_upgrade(
+def _generate_story(
     value: ValuesData,
     context: str,
     token_counter: Counter | None = None,
-    retry: bool = False,
-) -> Tuple[ValuesData, EdgeMetadata]:
-
-    # let's start by generating stories
-    print("\n\n### Generating stories")
+    attempt: int = 1,
+    variant: int = 0,
+) -> str:
     user_prompt = (
         f"""# Input\n\nX: {context}\n\nPolicies:\n\n{', '.join(value.policies)}"""
     )
     print(user_prompt)
     response = str(
-        sonnet(user_prompt, gen_stories_prompt, caching_enabled=not (retry))
-    )  # , token_counter=token_counter
+        sonnet(
+            user_prompt,
+            gen_stories_prompt,
+            temperature=branch_temperature if variant else 0.2,
+            caching_enabled=attempt == 1,
+            token_counter=token_counter,
+            variant=variant,
+            required_sections=["Deepening Story"],
+            max_preamble_chars=max_preamble_chars,
+        )
+    )
     print(response)
     response_dict1 = parse_to_dict(response)
     try:
-        story = response_dict1["Deepening Story"]
+        return response_dict1["Deepening Story"]
     except KeyError:
         print("** Error in story generation **")
         print(response)
         raise
 
-    print("\n\n### Generating upgrade")
+
+def _generate_wiser_value(
+    value: ValuesData,
+    context: str,
+    story: str,
+    token_counter: Counter | None = None,
+    attempt: int = 1,
+    variant: int = 0,
+) -> Tuple[ValuesData, EdgeMetadata]:
     user_prompt2 = f"""# Input\n\nX: good {context}\n\nPolicies:\n\n{', '.join(value.policies)}\n\nStory:\n\n{story}"""
     print(user_prompt2)
     response = str(
-        sonnet(user_prompt2, gen_upgrade_prompt, caching_enabled=not (retry))
-    )  # , token_counter=token_counter
+        sonnet(
+            user_prompt2,
+            gen_upgrade_prompt,
+            temperature=branch_temperature if variant else 0.2,
+            caching_enabled=attempt == 1,
+            token_counter=token_counter,
+            variant=variant,
+            required_sections=["Problem", "Attentional Policies Revised", "New Title"],
+            max_preamble_chars=max_preamble_chars,
+        )
+    )
     print(response)
     # raise NotImplementedError("Stop here for now")
     response_dict2 = parse_to_dict(response)
@@ -249,16 +357,57 @@ def generate_upgrade(
         problem=problem,
         story=story,
     )
-
     return wiser_value, metadata
 
 
+def generate_upgrade(
+    value: ValuesData,
+    context: str,
+    token_counter: Counter | None = None,
+    variant: int = 0,
+) -> Tuple[ValuesData, EdgeMetadata]:
+    """Generates a wiser value for a value, via a story of someone deepening it.
+
+    The story and the upgrade are retried on their own, like in `generate_value`.
+    Upgrades with a different `variant` are sampled independently.
+
+    Raises:
+        StageFailed: If a stage failed on all attempts.
+    """
+
+    # let's start by generating stories
+    print("\n\n### Generating stories")
+    story = run_stage(
+        "stories",
+        lambda attempt: _generate_story(
+            value, context, token_counter, attempt, variant
+        ),
+    )
+
+    print("\n\n### Generating upgrade")
+    return run_stage(
+        "upgrade",
+        lambda attempt: _generate_wiser_value(
+            value, context, story, token_counter, attempt, variant
+        ),
+    )
+
+
 def generate_hop(
-    from_value: Value, original_context: str, token_counter: Counter | None = None
+    from_value: Value,
+    original_context: str,
+    token_counter: Counter | None = None,
+    variant: int = 0,
 ) -> Tuple[Value, Edge]:
     wiser_value_data, metadata = generate_upgrade(
-        from_value.data, original_context, token_counter
+        from_value.data, original_context, token_counter, variant
     )
+    return _make_hop(from_value, wiser_value_data, metadata)
+
+
+def _make_hop(
+    from_value: Value, wiser_value_data: ValuesData, metadata: EdgeMetadata
+) -> Tuple[Value, Edge]:
     to_value = Value(wiser_value_data)
     new_context = wiser_value_data.choice_context
     edge = Edge(
@@ -271,59 +420,374 @@ def generate_hop(
     return to_value, edge
 
 
+def generate_question(
+    question: str,
+    n_hops: int,
+    token_counter: Counter | None = None,
+    branching: int = 1,
+    prune_similarity: float | None = None,
+) -> Tuple[List[Value], List[Edge]]:
+    """Generates the values and edges for a single seed question.
+
+    Args:
+        question: The seed question.
+        n_hops: The number of hops to take from the first value generated for the question.
+        branching: The number of upgrades to generate for every value. With more than one,
+            the hops form a tree of depth `n_hops` instead of a chain.
+        prune_similarity: When branching, drop upgrades whose words overlap this much
+            (by Jaccard similarity) with a sibling's.
+    """
+
+    # generate base value and context for the question perturbation
+    base_value, context = generate_value(question, token_counter)
+    values = [Value(base_value)]
+    edges = []
+
+    if branching > 1:
+        _expand_tree(
+            values, edges, context, n_hops, branching, prune_similarity, token_counter
+        )
+        return values, edges
+
+    # generate n hops from the base value for the context
+    for _ in range(n_hops):
+        wiser_value, edge = generate_hop(values[-1], context, token_counter)
+        values.append(wiser_value)
+        edges.append(edge)
+
+    return values, edges
+
+
+def _expand_tree(
+    values: List[Value],
+    edges: List[Edge],
+    context: str,
+    n_hops: int,
+    branching: int,
+    prune_similarity: float | None,
+    token_counter: Counter | None,
+):
+    """Grows a tree of upgrades from the last value, one level per hop."""
+    frontier = [values[-1]]
+    for _ in range(n_hops):
+        if not frontier:
+            break
+        hops = [
+            (parent, variant) for parent in frontier for variant in range(branching)
+        ]
+        # The upgrades of a level run concurrently, up to the upgrade stage's limit (the
+        # levels grow as branching ** depth), each in a copy of the current context so
+        # that batch mode and metrics still apply.
+        max_workers = min(len(hops), stage_concurrency["upgrade"])
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    generate_hop,
+                    parent,
+                    context,
+                    token_counter,
+                    variant,
+                )
+                for parent, variant in hops
+            ]
+
+        children: Dict[str, List[Value]] = {}
+        frontier = []
+        for (parent, variant), future in zip(hops, futures):
+            try:
+                to_value, edge = future.result()
+            except StageFailed as e:
+                print(f"Dropping upgrade {variant} of {parent.data.title}: {e}")
+                continue
+            siblings = children.setdefault(parent.id, [])
+            if prune_similarity is not None and any(
+                _value_similarity(to_value, s) >= prune_similarity for s in siblings
+            ):
+                print(f"Pruning near-duplicate upgrade: {to_value.data.title}")
+                continue
+            siblings.append(to_value)
+            values.append(to_value)
+            edges.append(edge)
+            frontier.append(to_value)
+
+
+def _value_similarity(a: Value, b: Value) -> float:
+    return jaccard_similarity(
+        "\n".join([a.data.title, *a.data.policies]),
+        "\n".join([b.data.title, *b.data.policies]),
+    )
+
+
+def _try_generate_question(
+    question: str,
+    n_hops: int,
+    token_counter: Counter | None = None,
+    branching: int = 1,
+    prune_similarity: float | None = None,
+) -> Tuple[List[Value], List[Edge]] | None:
+    print("Generating graph for seed question:", question)
+    try:
+        return generate_question(
+            question, n_hops, token_counter, branching, prune_similarity
+        )
+    except (BatchPending, BudgetExceeded):
+        raise
+    except Exception as e:
+        _print_question_error(question, e)
+        return None
+
+
+def _print_question_error(question: str, error: Exception):
+    print(
+        "------------------------------------\nError generating graph for seed question:",
+        question,
+    )
+    print(f"Error: {error}")
+    print("------------------------------------\n")
+
+
+class _QuestionState:
+    """The values and edges generated so far for a seed question, as it moves through the pipeline."""
+
+    def __init__(self, question: str):
+        self.question = question
+        self.context: str | None = None
+        self.story: str | None = None
+        self.values: List[Value] = []
+        self.edges: List[Edge] = []
+
+
+def _context_stage(state: _QuestionState, token_counter: Counter) -> _QuestionState:
+    print("\n\n### Generating context")
+    state.context = run_stage(
+        "context",
+        lambda attempt: _generate_context(state.question, token_counter, attempt),
+    )
+    return state
+
+
+def _value_stage(state: _QuestionState, token_counter: Counter) -> _QuestionState:
+    print("\n\n### Generating value")
+    values_data = run_stage(
+        "value",
+        lambda attempt: _generate_values_data(
+            state.question, str(state.context), token_counter, attempt
+        ),
+    )
+    state.values.append(Value(values_data))
+    return state
+
+
+def _stories_stage(state: _QuestionState, token_counter: Counter) -> _QuestionState:
+    print("\n\n### Generating stories")
+    state.story = run_stage(
+        "stories",
+        lambda attempt: _generate_story(
+            state.values[-1].data, str(state.context), token_counter, attempt
+        ),
+    )
+    return state
+
+
+def _upgrade_stage(state: _QuestionState, token_counter: Counter) -> _QuestionState:
+    print("\n\n### Generating upgrade")
+    wiser_value_data, metadata = run_stage(
+        "upgrade",
+        lambda attempt: _generate_wiser_value(
+            state.values[-1].data,
+            str(state.context),
+            str(state.story),
+            token_counter,
+            attempt,
+        ),
+    )
+    to_value, edge = _make_hop(state.values[-1], wiser_value_data, metadata)
+    state.values.append(to_value)
+    state.edges.append(edge)
+    return state
+
+
+def _generate_pipelined(
+    questions: List[str],
+    n_hops: int,
+    token_counter: Counter,
+    concurrency: Dict[str, int],
+) -> Iterator[Tuple[List[Value], List[Edge]] | None]:
+    """
+    Generates the questions through a pipeline of stages (context, value, and stories
+    and upgrade for every hop), each with its own concurrency limit, so that every
+    stage keeps its provider busy independently of the others. The stories and upgrade
+    stages of all hops share the limit of their step.
+
+    Yields the values and edges of every question in order, or None if it failed. If the
+    budget runs out, the remaining questions are still yielded before `BudgetExceeded`
+    is raised, so the ones that finished can be journaled.
+    """
+    steps = [("context", _context_stage), ("value", _value_stage)]
+    # Every hop gets its own stages, so questions only ever move forward.
+    for hop in range(1, n_hops + 1):
+        steps += [
+            (f"stories-{hop}", _stories_stage),
+            (f"upgrade-{hop}", _upgrade_stage),
+        ]
+    slots = {step: threading.BoundedSemaphore(n) for step, n in concurrency.items()}
+    stages = [
+        Stage(
+            name,
+            partial(fn, token_counter=token_counter),
+            concurrency[name.split("-")[0]],
+            slots=slots[name.split("-")[0]],
+        )
+        for name, fn in steps
+    ]
+
+    budget_exceeded = None
+    for item, state, error in run_pipeline(
+        (_QuestionState(q) for q in questions), stages
+    ):
+        if isinstance(error, BudgetExceeded):
+            # Later questions may still finish, so keep yielding them to be journaled.
+            budget_exceeded = budget_exceeded or error
+            yield None
+        elif error:
+            _print_question_error(item.question, error)
+            yield None
+        else:
+            yield state.values, state.edges
+    if budget_exceeded:
+        raise budget_exceeded
+
+
 def generate_graph(
     seed_questions: List[str],
     n_hops: int = 1,
-    graph: MoralGraph = MoralGraph(),
+    graph: MoralGraph | None = None,
     save_to_file: bool = True,
     save_to_db: bool = False,
+    batch_service: BatchService | None = None,
+    workers: int = 1,
+    pipelined: bool = False,
+    run_name: str | None = None,
+    branching: int = 1,
+    prune_similarity: float | None = None,
 ) -> MoralGraph:
     """Generates a moral graph based on a set of seed questions.
 
     Args:
         seed_questions: A list of seed questions to start the graph with.
         n_hops: The number of hops to take from the first value generated for each seed questions.
+        batch_service: If set, all questions are generated stage by stage, with the LLM calls
+            of each stage submitted to this service as one batch.
+        workers: The number of questions to generate concurrently. Results are still added
+            to the graph in the order of the seed questions.
+        pipelined: If set, questions are generated by a pipeline of stages with their own
+            concurrency limits (see `stage_concurrency`) instead of question by question.
+        save_to_file: If set, every finished question is appended to the run's journal in
+            `runs_dir`, and the graph is written to `graph_<run_name>.json` at the end. A run
+            with an existing journal resumes where it left off.
+        run_name: The name of the run. Defaults to a hash of the seed questions and
+            `n_hops`, so that running the same command again resumes the run.
+        branching: The number of upgrades to generate for every value, making each seed
+            question a tree of values instead of a chain.
+        prune_similarity: When branching, drop upgrades that are this similar to a sibling.
+
+    Raises:
+        BudgetExceeded: If the run's budget (see `configure_admission`) is spent. The
+            questions finished before are journaled, so running again resumes the run.
     """
 
-    token_counter = Counter()
-    start = time.time()
+    if pipelined and branching > 1:
+        raise ValueError("Branching is not supported by the pipelined generator")
 
-    for q in tqdm([s for s in seed_questions if s not in graph.seed_questions]):
-        print("Generating graph for seed question:", q)
-
-        try:
-
-            # generate base value and context for the question perturbation
-            base_value, context = generate_value(q, token_counter)
-            graph.values.append(Value(base_value))
-
-            # generate n hops from the base value for the context
-            for _ in range(n_hops):
-                wiser_value, edge = generate_hop(
-                    graph.values[-1], context, token_counter
-                )
-                graph.values.append(wiser_value)
-                graph.edges.append(edge)
+    from tqdm import tqdm
 
+    graph = graph if graph is not None else MoralGraph([], [], [])
+    run_name = run_name or _run_name(seed_questions, n_hops, branching)
+    journal = GraphJournal(os.path.join(runs_dir, f"{run_name}.jsonl"))
+    if save_to_file and journal.exists():
+        graph = journal.load(graph)
+        print(
+            f"Resuming run {run_name}, {len(graph.seed_questions)} seed questions done."
+        )
+    trace = start_trace("generate")
+    token_counter = Counter()
+    start = time.time()
+    provider = get_provider()
+    provider_latency = provider.total_latency
+    done = set(graph.seed_questions)
+    questions = [s for s in seed_questions if s not in done]
+    generate = partial(
+        _try_generate_question,
+        n_hops=n_hops,
+        token_counter=token_counter,
+        branching=branching,
+        prune_similarity=prune_similarity,
+    )
+    executor = None
+    futures = []
+    n_done = 0
+    budget_exceeded = None
+
+    def add_question(q: str, result: Tuple[List[Value], List[Edge]] | None):
+        if result:
+            values, edges = result
+            graph.values += values
+            graph.edges += edges
             graph.seed_questions.append(q)
-        except Exception as e:
-            print(
-                "------------------------------------\nError generating graph for seed question:",
-                q,
-            )
-            print(f"Error: {e}")
-            print("------------------------------------\n")
-
-        if save_to_file:
-            graph.save_to_file()
+            if save_to_file:
+                journal.append(q, values, edges)
 
-    print(f"Generated graph. Took {time.time() - start} seconds.")
-    print("input tokens: ", token_counter["prompt_tokens"])
-    print("output tokens: ", token_counter["completion_tokens"])
-    print("price: ", gp4o_price(token_counter))
+    try:
+        if batch_service:
+            results = run_batched(generate, questions, batch_service, name="generate")
+        elif pipelined:
+            results = _generate_pipelined(
+                questions, n_hops, token_counter, stage_concurrency
+            )
+        elif workers > 1:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = [executor.submit(generate, q) for q in questions]
+            # Yields the results in the order of the questions, as they become available.
+            results = (future.result() for future in futures)
+        else:
+            results = map(generate, questions)
+
+        # Results are read to the end, as the pipeline raises after its last result.
+        for result in tqdm(results, total=len(questions)):
+            add_question(questions[n_done], result)
+            n_done += 1
+    except BudgetExceeded as e:
+        # Finished questions are journaled, so running again resumes from here.
+        budget_exceeded = e
+        print(f"Stopping run {run_name}: {e}.")
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    if budget_exceeded:
+        # Questions after the one that ran out of budget may have finished already.
+        for q, future in zip(questions[n_done:], futures[n_done:]):
+            if not future.cancelled() and future.exception() is None:
+                add_question(q, future.result())
+
+    elapsed = time.time() - start
+    provider_latency = provider.total_latency - provider_latency
+    print(f"Generated graph. Took {elapsed} seconds.")
+    print(
+        f"provider latency: {provider_latency} seconds, pipeline overhead: {elapsed - provider_latency} seconds"
+    )
+    print_token_usage(token_counter)
+    trace.print_summary()
+    hedger = get_hedger()
+    if hedger:
+        hedger.print_summary()
 
     if save_to_file:
-        graph.save_to_file()
+        graph.save_to_file(f"./graph_{run_name}.json")
+
+    if budget_exceeded:
+        raise budget_exceeded
 
     if save_to_db:
         graph.save_to_db()
@@ -331,6 +795,15 @@ def generate_graph(
     return graph
 
 
+def _run_name(seed_questions: List[str], n_hops: int, branching: int = 1) -> str:
+    params = {"seed_questions": seed_questions, "n_hops": n_hops}
+    # Chains keep the run names they had before branching existed.
+    if branching > 1:
+        params["branching"] = branching
+    key = json.dumps(params)
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
 if __name__ == "__main__":
     """Generate a moral graph based on console args and save it to the database."""
 
@@ -349,42 +822,117 @@ if __name__ == "__main__":
         default=25,
         help="The number of questions to generate values for.",
     )
+    parser.add_argument(
+        "--batch",
+        choices=["provider", "local"],
+        help="Generate stage by stage, submitting the LLM calls of each stage as one batch job to the provider batch APIs (or a local stand-in).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of seed questions to generate concurrently.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Generate through a pipeline of stages, each working on several questions at once.",
+    )
+    parser.add_argument(
+        "--stage_concurrency",
+        nargs="*",
+        default=[],
+        help="Concurrency limits of pipeline stages, e.g. `value=32 stories=16`. `upgrade` also limits concurrent upgrades when branching.",
+    )
+    parser.add_argument(
+        "--run_name",
+        type=str,
+        help="The name of the run, used to resume it. Defaults to a hash of the seed questions.",
+    )
+    parser.add_argument(
+        "--branching",
+        type=int,
+        default=1,
+        help="The number of upgrades to generate for every value, growing a tree of values per seed question.",
+    )
+    parser.add_argument(
+        "--prune_similarity",
+        type=float,
+        help="When branching, drop upgrades whose title and policies overlap this much (Jaccard similarity, 0-1) with a sibling's.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The seed for sampling seed questions from the sources.",
+    )
+    parser.add_argument(
+        "--source_weights",
+        nargs="*",
+        default=[],
+        help="Relative weights of seed question sources, e.g. `cai=2 coaching=1`. Sources default to 1.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default="0/1",
+        help="Only generate shard i/N of the seed questions, to split a run across N processes.",
+    )
+    parser.add_argument(
+        "--skip_done",
+        action="store_true",
+        help="Skip seed questions already completed in any run journal.",
+    )
+    add_admission_args(parser)
+    add_hedging_args(parser)
     args = parser.parse_args()
-    seed_questions = []
-
-    cai_path = "./data/cai-harmless-sorted-deduped-filtered.jsonl"
-    gen_q_folder_path = "./data/generated_questions"
-    gen_q_files = os.listdir(gen_q_folder_path)
-    n_sources = 1 + len(gen_q_files)  # cai + all generated question files.
-
-    #
-    # Load seed questions from the "generated_questions" datasets.
-    #
-    for filename in gen_q_files:
-        with open(Path(gen_q_folder_path, filename), "r") as file:
-            file_questions = [q.strip() for q in file.read().splitlines()]
-            seed_questions += file_questions[: args.n_questions // n_sources]
-
-    #
-    # Load seed questions from the CAI dataset.
-    #
-    ds = load_dataset(
-        "json",
-        data_files=cai_path,
-        split="train",
-    )
-    assert isinstance(ds, Dataset)
-    cai_length = max(
-        args.n_questions // n_sources, args.n_questions - len(seed_questions)
-    )  # if we request more questions than the total of generated questions, include more from the CAI dataset.
-    ds = ds.select(range(cai_length))
-    seed_questions += ds["init_prompt"]
+    for limit in args.stage_concurrency:
+        stage, n = limit.split("=")
+        if stage not in stage_concurrency:
+            parser.error(f"Unknown stage: {stage}")
+        stage_concurrency[stage] = int(n)
+    configure_admission_from_args(parser, args)
+    configure_hedging_from_args(parser, args)
+
+    sources = default_sources()
+    for weight in args.source_weights:
+        name, w = weight.split("=")
+        source = next((s for s in sources if s.name == name), None)
+        if source is None:
+            parser.error(f"Unknown seed source: {name}")
+        source.weight = float(w)
+    done = set()
+    if args.skip_done:
+        for path in glob.glob(os.path.join(runs_dir, "*.jsonl")):
+            done.update(GraphJournal(path).seed_questions())
+    seed_questions = list(
+        sample_seed_questions(
+            sources,
+            args.n_questions,
+            seed=args.seed,
+            shard=parse_shard(args.shard),
+            skip=done,
+        )
+    )
 
     print(f"Generating graph for {len(seed_questions)} seed questions.")
 
-    graph = generate_graph(
-        seed_questions=seed_questions,
-        n_hops=args.n_hops,
-    )
+    try:
+        graph = generate_graph(
+            seed_questions=seed_questions,
+            n_hops=args.n_hops,
+            batch_service=get_batch_service(args.batch) if args.batch else None,
+            workers=args.workers,
+            pipelined=args.pipeline,
+            run_name=args.run_name,
+            branching=args.branching,
+            prune_similarity=args.prune_similarity,
+        )
+    except BudgetExceeded:
+        print(
+            "Run the same command to resume. The budget applies to each invocation, "
+            "so the resumed run can spend it again."
+        )
+        sys.exit(1)
 
     graph.save_to_db()
@@ -1,10 +1,22 @@
 import json
-from typing import List
+import os
+import re
+import sys
+import threading
+from typing import Dict, Iterable, Iterator, List, Set
 from uuid import uuid4 as uuid
-from prisma import Prisma, Json
-from prisma.enums import ProcessState
 from utils import serialize
-import networkx as nx
+
+# How `get_edges` and `get_winning_values` match edge contexts to a query context.
+EXACT = "exact"  # The edge context is the query.
+SUBSTRING = "substring"  # The edge context appears anywhere in the query.
+TOKEN = "token"  # Every word of the edge context is a word of the query, ignoring case.
+MATCH_MODES = [EXACT, SUBSTRING, TOKEN]
+
+
+def _intern(text: str | None) -> str | None:
+    """Intern a string, passing through None (e.g. a null `choiceContext` in the database)."""
+    return sys.intern(text) if isinstance(text, str) else text
 
 
 class ValuesData:
@@ -14,13 +26,17 @@ class ValuesData:
     Attributes:
         title (str): The title of the value.
         policies (List[str]): A list of policies associated with the value.
-        choice_context (str): The context in which the choice is made.
+        choice_context (str | None): The context in which the choice is made.
     """
 
-    def __init__(self, title: str, policies: List[str], choice_context: str):
+    # Slots instead of a __dict__ per instance, in the order the fields serialize in.
+    __slots__ = ("title", "policies", "choice_context")
+
+    def __init__(self, title: str, policies: List[str], choice_context: str | None):
         self.title = title
         self.policies = policies
-        self.choice_context = choice_context
+        # Many values and edges share a context, so they share one string of it.
+        self.choice_context = _intern(choice_context)
 
 
 class Value:
@@ -32,9 +48,12 @@ class Value:
         id (str): The unique identifier for the value.
     """
 
+    __slots__ = ("data", "id")
+
     def __init__(self, data: ValuesData, id: str | None = None):
         self.data = data
-        self.id = id if id else str(uuid())
+        # Interned, so the edges to the value share its id string.
+        self.id = sys.intern(id if id else str(uuid()))
 
 
 class EdgeMetadata:
@@ -48,6 +67,8 @@ class EdgeMetadata:
         improvements (List[dict]): Improvements associated with the edge.
     """
 
+    __slots__ = ("context_shifts", "improvements", "problem", "story")
+
     def __init__(
         self,
         story: str,
@@ -72,6 +93,8 @@ class Edge:
         metadata (EdgeMetadata | None): The metadata associated with the edge.
     """
 
+    __slots__ = ("from_id", "to_id", "context", "metadata")
+
     def __init__(
         self,
         from_id: str,
@@ -79,12 +102,109 @@ class Edge:
         context: str,
         metadata: EdgeMetadata | None = None,
     ):
-        self.from_id = from_id
-        self.to_id = to_id
-        self.context = context
+        self.from_id = _intern(from_id)
+        self.to_id = _intern(to_id)
+        self.context = _intern(context)
         self.metadata = metadata
 
 
+def _tokens(text: str) -> Set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+class ContextIndex:
+    """
+    Indexes the edges of a graph by context and its values by id, so that a context
+    lookup costs time proportional to the edges it finds rather than to the graph.
+
+    The index follows the graph's `values` and `edges` lists as they are appended to:
+    every lookup first indexes the items appended since the last one. If a list was
+    replaced or shrunk, it is indexed again from scratch. Items replaced in place are
+    not noticed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset_values([])
+        self._reset_edges([])
+
+    def _reset_values(self, values: List[Value]):
+        self._values = values
+        self._indexed_values = 0
+        self._value_positions: Dict[str, int] = {}
+
+    def _reset_edges(self, edges: List[Edge]):
+        self._edges = edges
+        self._indexed_edges = 0
+        self._edges_by_context: Dict[str, List[int]] = {}
+        # The distinct context lengths, to find the contexts inside a query.
+        self._context_lengths: Set[int] = set()
+        # Contexts by their longest word, which tends to be their rarest.
+        self._contexts_by_token: Dict[str, Set[str]] = {}
+        self._context_tokens: Dict[str, Set[str]] = {}
+
+    def sync(self, values: List[Value], edges: List[Edge]):
+        """Index the values and edges appended since the last call."""
+        with self._lock:
+            if values is not self._values or len(values) < self._indexed_values:
+                self._reset_values(values)
+            for position in range(self._indexed_values, len(values)):
+                self._value_positions.setdefault(values[position].id, position)
+            self._indexed_values = len(values)
+
+            if edges is not self._edges or len(edges) < self._indexed_edges:
+                self._reset_edges(edges)
+            for position in range(self._indexed_edges, len(edges)):
+                self._index_edge(edges[position].context, position)
+            self._indexed_edges = len(edges)
+
+    def _index_edge(self, context: str, position: int):
+        if context not in self._edges_by_context:
+            self._edges_by_context[context] = []
+            self._context_lengths.add(len(context))
+            tokens = _tokens(context)
+            self._context_tokens[context] = tokens
+            key = max(tokens, key=lambda t: (len(t), t), default="")
+            self._contexts_by_token.setdefault(key, set()).add(context)
+        self._edges_by_context[context].append(position)
+
+    def contexts(self, query: str, match: str = SUBSTRING) -> Set[str]:
+        """The indexed contexts that match a query."""
+        if match == EXACT:
+            return {query} if query in self._edges_by_context else set()
+        if match == SUBSTRING:
+            return {
+                query[start : start + length]
+                for length in self._context_lengths
+                for start in range(len(query) - length + 1)
+                if query[start : start + length] in self._edges_by_context
+            }
+        if match == TOKEN:
+            tokens = _tokens(query)
+            # Contexts without any words are keyed by "".
+            return {
+                context
+                for token in [*tokens, ""]
+                for context in self._contexts_by_token.get(token, ())
+                if self._context_tokens[context] <= tokens
+            }
+        raise ValueError(f"Unknown match mode: {match}")
+
+    def edge_positions(self, contexts: Iterable[str]) -> List[int]:
+        """The positions of the edges with the contexts, in graph order."""
+        return sorted(p for c in contexts for p in self._edges_by_context[c])
+
+    def value_position(self, id: str) -> int | None:
+        """The position of the value with the id, or None if there is none."""
+        return self._value_positions.get(id)
+
+    def value_positions(self, ids: Iterable[str]) -> List[int]:
+        """The positions of the values with the ids, in graph order."""
+        return sorted(
+            self._value_positions[id] for id in ids if id in self._value_positions
+        )
+
+
 class MoralGraph:
     """
     Represents a moral graph consisting of values and edges.
@@ -104,26 +224,71 @@ class MoralGraph:
         self.values = values
         self.edges = edges
         self.seed_questions = seed_questions
+        self._index = ContextIndex()
 
-    def get_winning_values(self, context: str, n_values: int = 1):
-        """Get `n` the winning values for the context."""
+    def get_value(self, id: str) -> Value | None:
+        """Get a value by its id, or None if the graph has no such value."""
+        self._index.sync(self.values, self.edges)
+        positions = self._index.value_positions([id])
+        return self.values[positions[0]] if positions else None
 
-        edges = [e for e in self.edges if e.context in context]
-        values = [
-            v
-            for v in self.values
-            if v.id in [e.from_id for e in edges] or v.id in [e.to_id for e in edges]
-        ]
-        trimmed_graph = MoralGraph(values, edges)
-
-        # Get n winning value(s) by calculating PageRank score.
-        n_values = 1
-        pr = nx.pagerank(trimmed_graph.to_nx_graph())
-        winning_value_ids = [
-            p[0]
-            for p in sorted(pr.items(), key=lambda x: x[1], reverse=True)[:n_values]
-        ]
-        return [v for v in values if v.id in winning_value_ids]
+    def get_edges(self, context: str, match: str = SUBSTRING) -> List[Edge]:
+        """
+        Get the edges whose context matches a context, in graph order.
+
+        Args:
+            context (str): The context to match.
+            match (str): How to match edge contexts to `context`: `EXACT`, `SUBSTRING`
+                (the edge context appears in `context`) or `TOKEN` (all words of the edge
+                context appear in `context`).
+
+        Returns:
+            List[Edge]: The matching edges.
+        """
+        self._index.sync(self.values, self.edges)
+        positions = self._index.edge_positions(self._index.contexts(context, match))
+        return [self.edges[p] for p in positions]
+
+    def get_winning_values(
+        self, context: str, n_values: int = 1, match: str = SUBSTRING
+    ) -> List[Value]:
+        """
+        Get the `n_values` winning values for the context: the values of the subgraph of
+        edges matching the context (see `get_edges`), ranked by PageRank, best first.
+        """
+        return self._winning_values([self.get_edges(context, match)], n_values)[0]
+
+    def get_winning_values_table(
+        self,
+        contexts: List[str] | None = None,
+        n_values: int = 1,
+        match: str = EXACT,
+    ) -> Dict[str, List[Value]]:
+        """
+        Get the winning values of many contexts at once, ranking all their subgraphs in
+        one batched PageRank.
+
+        Args:
+            contexts (List[str] | None): The contexts. If None, every edge context.
+            n_values (int): The number of winning values per context.
+            match (str): How to match edges to each context, like in `get_edges`.
+
+        Returns:
+            Dict[str, List[Value]]: The winning values of each context, best first.
+        """
+        if contexts is None:
+            contexts = list(dict.fromkeys(e.context for e in self.edges))
+        subgraphs = [self.get_edges(context, match) for context in contexts]
+        return dict(zip(contexts, self._winning_values(subgraphs, n_values)))
+
+    def _winning_values(
+        self, subgraphs: List[List[Edge]], n_values: int
+    ) -> List[List[Value]]:
+        from pagerank import rank_subgraphs
+
+        self._index.sync(self.values, self.edges)
+        ranked = rank_subgraphs(subgraphs, self._index.value_position, n_values)
+        return [[self.values[p] for p in positions] for positions in ranked]
 
     def to_json(self):
         """
@@ -132,7 +297,11 @@ class MoralGraph:
         Returns:
             dict: The serialized moral graph.
         """
-        return serialize(self)
+        return {
+            "values": serialize(self.values),
+            "edges": serialize(self.edges),
+            "seed_questions": serialize(self.seed_questions),
+        }
 
     def to_nx_graph(self):
         """
@@ -141,6 +310,8 @@ class MoralGraph:
         Returns:
             nx.DiGraph: The NetworkX directed graph.
         """
+        import networkx as nx
+
         G = nx.DiGraph()
 
         for value in self.values:
@@ -161,14 +332,18 @@ class MoralGraph:
     @classmethod
     def from_file(cls, path):
         """
-        Creates a MoralGraph instance from a JSON file.
+        Creates a MoralGraph instance from a JSON or binary graph file.
 
         Args:
-            path (str): The path to the JSON file.
+            path (str): The path to the JSON or binary graph file.
 
         Returns:
             MoralGraph: The created MoralGraph instance.
         """
+        from binary_graph import is_binary_graph, read_graph
+
+        if is_binary_graph(path):
+            return read_graph(path)
         with open(path, "r") as f:
             data = json.load(f)
         return cls.from_json(data)
@@ -208,6 +383,8 @@ class MoralGraph:
         Returns:
             MoralGraph: The created MoralGraph instance.
         """
+        from prisma import Prisma
+
         db = Prisma()
         db.connect()
 
@@ -241,11 +418,16 @@ class MoralGraph:
 
     def save_to_file(self, path: str | None = None):
         """
-        Saves the moral graph to a JSON file.
+        Saves the moral graph to a JSON file, or to a binary graph file if the path ends
+        in ".mgraph" (see `binary_graph`).
 
         Args:
-            path (str | None): The path to the JSON file. If None, a default path is used.
+            path (str | None): The path to the file. If None, a default JSON path is used.
         """
+        from binary_graph import SUFFIX, write_graph
+
+        if path and path.endswith(SUFFIX):
+            return write_graph(self, path)
         with open(path if path else f"./graph_{self.__hash__()}.json", "w") as f:
             json.dump(self.to_json(), f, indent=2)
 
@@ -256,6 +438,9 @@ class MoralGraph:
         Args:
             generation_id (int | None): The generation ID. If None, a new generation is created.
         """
+        from prisma import Json, Prisma
+        from prisma.enums import ProcessState
+
         db = Prisma()
         db.connect()
         # git_commit = os.popen("git rev-parse HEAD").read().strip() TODO: fix this
@@ -306,3 +491,116 @@ class MoralGraph:
         )
         db.disconnect()
         print(f"Saved graph to db with generation id {generation_id}")
+
+
+class GraphJournal:
+    """
+    An append-only JSONL log of the values, edges and seed questions of a generation run.
+
+    Each seed question is written as a "begin" event, its "value" and "edge" events and
+    a "seed" event, in one flushed write. The seed event marks the question as done, so
+    events of a question that was interrupted before its seed event are ignored on load,
+    as the next question's begin event (or a cut-off line) discards them.
+
+    Attributes:
+        path (str): The path to the journal file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def append(self, question: str, values: List[Value], edges: List[Edge]):
+        """Append the values and edges generated for a seed question."""
+        events = [{"type": "begin"}]
+        events += [{"type": "value", "value": serialize(v)} for v in values]
+        events += [{"type": "edge", "edge": serialize(e)} for e in edges]
+        events.append({"type": "seed", "question": question})
+        lines = "".join(json.dumps(event) + "\n" for event in events)
+        with open(self.path, "a+b") as f:
+            # Don't continue a line left incomplete by an interrupted run.
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def seed_questions(self) -> Iterator[str]:
+        """Stream the completed seed questions of the journal, without loading the graph."""
+        if not self.exists():
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                # Skip parsing the much longer value and edge events.
+                if '"type": "seed"' not in line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if event["type"] == "seed":
+                    yield event["question"]
+
+    def load(self, graph: "MoralGraph | None" = None) -> "MoralGraph":
+        """
+        Replay the journal into a graph.
+
+        Args:
+            graph (MoralGraph | None): A graph to add the journaled questions to, skipping
+                questions it already has. If None, a new graph is created.
+
+        Returns:
+            MoralGraph: The graph with all completed questions of the journal.
+        """
+        graph = graph if graph is not None else MoralGraph([], [], [])
+        if not self.exists():
+            return graph
+
+        done = set(graph.seed_questions)
+        pending = {"values": [], "edges": []}
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # An incomplete last line of an interrupted run, whose question's
+                    # events are incomplete too.
+                    pending = {"values": [], "edges": []}
+                    continue
+                if event["type"] == "begin":
+                    pending = {"values": [], "edges": []}
+                elif event["type"] == "value":
+                    pending["values"].append(event["value"])
+                elif event["type"] == "edge":
+                    pending["edges"].append(event["edge"])
+                elif event["type"] == "seed":
+                    if event["question"] not in done:
+                        question = MoralGraph.from_json(
+                            {**pending, "seed_questions": [event["question"]]}
+                        )
+                        graph.values += question.values
+                        graph.edges += question.edges
+                        graph.seed_questions.append(event["question"])
+                        done.add(event["question"])
+                    pending = {"values": [], "edges": []}
+
+        return graph
+
+    def compact(self, path: str) -> "MoralGraph":
+        """
+        Write the graph of all completed questions to a JSON graph file.
+
+        Args:
+            path (str): The path to the graph file.
+
+        Returns:
+            MoralGraph: The graph.
+        """
+        graph = self.load()
+        graph.save_to_file(path)
+        return graph
@@ -0,0 +1,271 @@
+import argparse
+from collections import Counter, defaultdict, deque
+import contextvars
+import os
+import queue
+import threading
+import time
+from typing import Callable, Deque, Dict, Tuple, TypeVar
+
+from admission import PROVIDERS
+import metrics
+
+T = TypeVar("T")
+
+# Hedge calls that take longer than this percentile of the observed latencies (0-1).
+# Hedging is off unless it is set.
+HEDGE_PERCENTILE = (
+    float(os.environ["LLM_HEDGE_PERCENTILE"])
+    if os.environ.get("LLM_HEDGE_PERCENTILE")
+    else None
+)
+# Where to send the duplicate of a call to each provider, as "provider" or
+# "provider:model", e.g. "sonnet=gpt gpt=sonnet:claude-3-5-sonnet-20241022".
+HEDGE_TARGETS = os.environ.get("LLM_HEDGE_TARGETS", "sonnet=gpt gpt=sonnet")
+# The number of latencies to observe before hedging, and to compute percentiles over.
+MIN_SAMPLES = 20
+WINDOW = 1000
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+
+class HedgeCancelled(Exception):
+    """Raised inside a call that lost the race against its duplicate."""
+
+
+class LatencyTracker:
+    """
+    Keeps the latest latencies of calls, by key, to compute percentiles over.
+
+    Attributes:
+        min_samples (int): The number of latencies a key needs for a percentile.
+        window (int): The number of latest latencies kept per key.
+    """
+
+    def __init__(self, min_samples: int = MIN_SAMPLES, window: int = WINDOW):
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies: Dict[Tuple, Deque[float]] = defaultdict(
+            lambda: deque(maxlen=self.window)
+        )
+        self._lock = threading.Lock()
+
+    def observe(self, key: Tuple, latency: float):
+        with self._lock:
+            self._latencies[key].append(latency)
+
+    def percentile(self, key: Tuple, q: float) -> float | None:
+        """The q-th percentile (0-1) of the latencies of a key, or None if too few were observed."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(key, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class Hedger:
+    """
+    Hedges slow calls with a duplicate call to a second provider or model.
+
+    A call runs as usual until it has taken longer than `percentile` of the latencies
+    observed for the same key (the provider and the pipeline stage). Then the duplicate
+    starts, and the first of the two to return a valid response wins, while the other
+    is cancelled. Cancelled calls count as having taken as long as they ran, so the
+    slow calls keep the percentile up.
+
+    Attributes:
+        percentile (float): The latency percentile (0-1) after which calls are hedged.
+        targets (Dict[str, str]): The "provider" or "provider:model" to hedge the calls
+            of each provider with. Providers without a target are not hedged.
+        tracker (LatencyTracker): The observed latencies.
+        stats (Dict[str, Counter]): Per provider, the number of "calls", how many were
+            "hedged", and how many of those the "hedge_wins" or "primary_wins".
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        targets: Dict[str, str],
+        tracker: LatencyTracker | None = None,
+    ):
+        if not 0 < percentile < 1:
+            raise ValueError("The hedge percentile must be between 0 and 1")
+        for provider, target in targets.items():
+            if provider not in PROVIDERS or target.partition(":")[0] not in PROVIDERS:
+                raise ValueError(f"Invalid hedge target: {provider}={target}")
+        self.percentile = percentile
+        self.targets = targets
+        self.tracker = tracker or LatencyTracker()
+        self.stats: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def target(self, provider: str) -> Tuple[str, str | None] | None:
+        """The provider and model (None for its default) to hedge a provider's calls with."""
+        target = self.targets.get(provider)
+        if not target:
+            return None
+        target_provider, _, model = target.partition(":")
+        return target_provider, model or None
+
+    def run(
+        self,
+        key: Tuple,
+        primary: Callable[[threading.Event], T],
+        hedge: Callable[[threading.Event], T],
+    ) -> T:
+        """
+        Run `primary`, and `hedge` too if `primary` is slow, returning the first result.
+
+        Both are called with an event that is set once the other has won, and should then
+        stop and raise `HedgeCancelled`. A call that raises doesn't win, so if `primary`
+        fails after `hedge` started, the result of `hedge` is awaited instead.
+
+        Args:
+            key (Tuple): The key to track the latency of `primary` under. Its first item
+                is the provider, which the stats are counted under.
+            primary (Callable): The call.
+            hedge (Callable): The duplicate call.
+
+        Raises:
+            Exception: The error of `primary`, if neither call succeeded.
+        """
+        provider = key[0]
+        delay = self.tracker.percentile(key, self.percentile)
+        self._count(provider, "calls")
+        if delay is None:
+            start = time.monotonic()
+            result = primary(threading.Event())
+            self.tracker.observe(key, time.monotonic() - start)
+            return result
+
+        results = queue.Queue()
+        cancels = {}
+        started_at = {}
+
+        def start(name: str, call: Callable[[threading.Event], T]):
+            cancels[name] = threading.Event()
+            started_at[name] = time.monotonic()
+            # The call records its metrics in the caller's span.
+            context = contextvars.copy_context()
+
+            def run_call():
+                try:
+                    results.put((name, context.run(call, cancels[name]), None))
+                except Exception as e:
+                    results.put((name, None, e))
+
+            threading.Thread(target=run_call, daemon=True).start()
+
+        start(PRIMARY, primary)
+        errors = {}
+        try:
+            finished = results.get(timeout=delay)
+        except queue.Empty:
+            self._count(provider, "hedged")
+            metrics.record(hedged_calls=1)
+            start(HEDGE, hedge)
+            finished = results.get()
+
+        while True:
+            name, result, error = finished
+            if name == PRIMARY:
+                self.tracker.observe(key, time.monotonic() - started_at[PRIMARY])
+            if error is None:
+                for other, cancel in cancels.items():
+                    if other != name:
+                        cancel.set()
+                if HEDGE in cancels:
+                    self._count(provider, f"{name}_wins")
+                    if name == HEDGE:
+                        self.tracker.observe(
+                            key, time.monotonic() - started_at[PRIMARY]
+                        )
+                return result
+            errors[name] = error
+            if len(errors) == len(cancels):
+                raise errors[PRIMARY]
+            finished = results.get()
+
+    def summary(self) -> str:
+        """The hedge rate and wins per provider."""
+        with self._lock:
+            stats = {p: Counter(c) for p, c in self.stats.items()}
+        lines = []
+        for provider, counts in stats.items():
+            hedged = counts["hedged"]
+            rate = hedged / counts["calls"] if counts["calls"] else 0.0
+            lines.append(
+                f"{provider}: {counts['calls']} calls, {hedged} hedged ({rate:.1%}), "
+                f"hedge won {counts['hedge_wins']}, original won {counts['primary_wins']}"
+            )
+        return "\n".join(lines)
+
+    def print_summary(self):
+        print(f"\nHedged calls (after p{self.percentile * 100:g} latency):")
+        print(self.summary())
+
+    def _count(self, provider: str, stat: str):
+        with self._lock:
+            self.stats[provider][stat] += 1
+
+
+def parse_targets(targets: str) -> Dict[str, str]:
+    """Parse hedge targets like "sonnet=gpt gpt=sonnet:claude-3-5-sonnet-20241022"."""
+    parsed = {}
+    for target in targets.split():
+        provider, sep, hedge = target.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid hedge target: {target}")
+        parsed[provider] = hedge
+    return parsed
+
+
+_hedger = (
+    Hedger(HEDGE_PERCENTILE, parse_targets(HEDGE_TARGETS)) if HEDGE_PERCENTILE else None
+)
+
+
+def configure_hedging(
+    percentile: float | None, targets: Dict[str, str] | None = None
+) -> Hedger | None:
+    """Hedge the calls slower than `percentile` from now on, or stop hedging if it is None."""
+    global _hedger
+    _hedger = (
+        Hedger(percentile, targets or parse_targets(HEDGE_TARGETS))
+        if percentile
+        else None
+    )
+    return _hedger
+
+
+def get_hedger() -> Hedger | None:
+    return _hedger
+
+
+def add_hedging_args(parser: argparse.ArgumentParser):
+    """Add the hedging flags to a CLI."""
+    parser.add_argument(
+        "--hedge_percentile",
+        type=float,
+        default=HEDGE_PERCENTILE,
+        help="Send a duplicate of calls slower than this latency percentile (0-1) to a second provider, using whichever response is valid first.",
+    )
+    parser.add_argument(
+        "--hedge_targets",
+        nargs="*",
+        help="The provider or provider:model to hedge each provider with, e.g. `sonnet=gpt gpt=sonnet`.",
+    )
+
+
+def configure_hedging_from_args(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> Hedger | None:
+    """Configure hedging from the flags added by `add_hedging_args`."""
+    try:
+        targets = (
+            parse_targets(" ".join(args.hedge_targets)) if args.hedge_targets else None
+        )
+        return configure_hedging(args.hedge_percentile, targets)
+    except ValueError as e:
+        parser.error(str(e))
@@ -1,13 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
+from functools import partial
 import json
 import os
-from typing import Counter, List
-import openai
-from anthropic import Anthropic
+import threading
+import time
+from typing import Callable, Counter, Dict, List, Tuple
+import weakref
 import hashlib
 
+from admission import estimate_tokens, estimated_usage, get_admission
+from batch import current_batch
+from cache import SEMANTIC_CACHE, get_cache, get_semantic_cache
+from hedging import HedgeCancelled, get_hedger
+import metrics
+from providers import Completion, get_provider
+from retries import RATE_LIMIT, circuit, classify_error, get_breaker
+from utils import MalformedResponseError, SectionParser, parse_to_dict
 
+GPT_CACHE = "gpt"
+SONNET_CACHE = "sonnet"
+
+# Legacy JSONL caches, migrated into the response cache on first use.
 GPT_CACHE_FILE = "./data/gpt_cache.jsonl"
 SONNET_CACHE_FILE = "./data/sonnet_cache.jsonl"
+LEGACY_CACHE_FILES = {GPT_CACHE: GPT_CACHE_FILE, SONNET_CACHE: SONNET_CACHE_FILE}
+
+# Maximum number of in-flight requests per provider for `agpt4` and `asonnet`.
+_concurrency = {
+    "gpt": int(os.environ.get("GPT_CONCURRENCY", 16)),
+    "sonnet": int(os.environ.get("SONNET_CONCURRENCY", 8)),
+}
+_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+# The threads `agpt4` and `asonnet` run their calls on, created on first use.
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+# Token counters are shared by the workers of a run.
+_token_counter_lock = threading.Lock()
 
 
 def _calculate_hash(messages: List[str]) -> str:
@@ -16,40 +47,241 @@ def _calculate_hash(messages: List[str]) -> str:
     )
 
 
-def _get_cached_response(messages: list, cache_file: str):
-    hash_key = _calculate_hash(messages)
-    if not os.path.exists(cache_file):
+def _get_cached_response(
+    messages: list, namespace: str, similarity_threshold: float | None = None
+):
+    cache = get_cache(namespace, LEGACY_CACHE_FILES.get(namespace))
+    response = cache.get(_calculate_hash(messages))
+    if not response and SEMANTIC_CACHE:
+        # Similarity lookups embed the prompt, which replayed runs must not do.
+        if not get_provider().cache_responses:
+            similarity_threshold = None
+        response = get_semantic_cache(namespace).get(messages, similarity_threshold)
+        if response:
+            metrics.record(semantic_cache_hits=1)
+    if response:
+        metrics.record(cache_hits=1)
+    return response
+
+
+def _cache_response(
+    messages: list,
+    response: str | dict | list,
+    namespace: str,
+    similarity_threshold: float | None = None,
+):
+    if not get_provider().cache_responses:
+        return
+    cache = get_cache(namespace, LEGACY_CACHE_FILES.get(namespace))
+    cache.set(_calculate_hash(messages), response)
+    if SEMANTIC_CACHE:
+        get_semantic_cache(namespace).set(
+            messages, response, embed=similarity_threshold is not None
+        )
+
+
+def _get_batched_response(
+    provider: str,
+    messages: list,
+    namespace: str,
+    params: dict,
+    parse: Callable,
+    similarity_threshold: float | None = None,
+):
+    """
+    In batch mode, get the batched response for an uncached request, or defer the
+    request to the current batch (raising `BatchPending`).
+    """
+    batch = current_batch()
+    if batch is None:
         return None
 
-    with open(cache_file, "r") as file:
-        for line in file:
-            record = json.loads(line.strip())
-            if record["hash"] == hash_key:
-                return record["response"]
+    response = batch.defer(
+        provider,
+        _calculate_hash(messages),
+        params,
+        parse,
+        lambda response: _cache_response(
+            messages, response, namespace, similarity_threshold
+        ),
+    )
+    if response:
+        metrics.record(cache_hits=1)
+    return response
 
-    return None
 
+@contextlib.contextmanager
+def _admitted(provider: str, params: dict, token_counter: Counter | None = None):
+    """
+    Wait until admission control lets a provider call through, and report its outcome.
 
-def _cache_response(messages: list, response: str, cache_file: str):
-    hash_key = _calculate_hash(messages)
+    Yields:
+        Completion: The completion of the call, for the caller to fill in. If the
+            provider reports no usage, it is estimated from the request and the text.
+            A call that fails after it was sent (e.g. a malformed or cancelled stream)
+            never reaches the caller's `_count_tokens`, so its usage is counted here.
+            Rate-limited calls are rejected before they are processed and count nothing.
+    """
+    admission = get_admission()
+    admission.admit(provider, estimate_tokens(params))
+    completion = Completion(None)
+    rate_limited = False
+    try:
+        yield completion
+    except Exception as e:
+        rate_limited = classify_error(e) == RATE_LIMIT
+        if not rate_limited:
+            if not completion.usage:
+                completion.usage = estimated_usage(params, completion.text)
+            _count_tokens(token_counter, completion, provider)
+        raise
+    else:
+        if not completion.usage:
+            completion.usage = estimated_usage(params, completion.text)
+    finally:
+        admission.release(provider, rate_limited)
 
-    if not os.path.exists(cache_file):
-        open(cache_file, "w").close()
 
-    with open(cache_file, "a") as file:
-        file.write(json.dumps({"hash": hash_key, "response": response}) + "\n")
+def _stream_text(
+    provider: str,
+    params: dict,
+    required_sections: List[str] | None,
+    max_preamble_chars: int | None,
+    on_section: Callable[[str, str], None] | None,
+    cancel: threading.Event | None = None,
+    completion: Completion | None = None,
+) -> Tuple[Completion, bool]:
+    """
+    Stream a text response through a `SectionParser`, calling `on_section` for every
+    completed section. Stops as soon as all required sections have arrived, and raises
+    `MalformedResponseError` as soon as the response looks malformed, or
+    `HedgeCancelled` as soon as `cancel` is set. The response is streamed into
+    `completion` if given, so its usage is known even if this raises.
 
+    Returns:
+        Tuple[Completion, bool]: The completion, and whether it was stopped early.
+    """
+    parser = SectionParser(required_sections, max_preamble_chars)
+    completion = completion if completion is not None else Completion(None)
+    chunks = get_provider().stream(provider, params, completion)
+    stopped_early = False
 
-def gpt4(
-    user_prompt: str | None = None,
-    system_prompt: str | None = None,
-    function: dict | None = None,
-    temperature: float = 0.0,
-    token_counter: Counter | None = None,
-    caching_enabled: bool = True,
-    json_mode: bool = False,
-    max_tokens: int = 4096,
-) -> str | dict | list:
+    try:
+        for chunk in chunks:
+            if cancel is not None and cancel.is_set():
+                raise HedgeCancelled()
+            for header, content in parser.feed(chunk):
+                if on_section:
+                    on_section(header, content)
+            if parser.is_complete:
+                stopped_early = True
+                break
+        else:
+            for header, content in parser.close():
+                if on_section:
+                    on_section(header, content)
+    finally:
+        chunks.close()  # type: ignore
+
+    return completion, stopped_early
+
+
+def _hedge_params(
+    provider: str,
+    user_prompt: str | None,
+    system_prompt: str | None,
+    temperature: float,
+    max_tokens: int,
+) -> Tuple[str, dict] | None:
+    """The provider and params of the duplicate request to hedge a text request with, if any."""
+    hedger = get_hedger()
+    target = hedger.target(provider) if hedger else None
+    if target is None:
+        return None
+    hedge_provider, model = target
+    if hedge_provider == "gpt":
+        messages = _gpt_messages(user_prompt, system_prompt)
+        params = _gpt_params(messages, None, temperature, False, max_tokens)
+    elif user_prompt and system_prompt:
+        params = _sonnet_params(user_prompt, system_prompt, temperature, max_tokens)
+    else:
+        # Anthropic requests need both prompts.
+        return None
+    if model:
+        params["model"] = model
+    return hedge_provider, params
+
+
+def _hedged_text(
+    provider: str,
+    params: dict,
+    hedge: Tuple[str, dict],
+    required_sections: List[str] | None,
+    max_preamble_chars: int | None,
+    on_section: Callable[[str, str], None] | None,
+    token_counter: Counter | None,
+) -> Tuple[str, bool, bool]:
+    """
+    Stream a text response like `_stream_text`, hedged with the duplicate request
+    `hedge` if it is slow (see `Hedger`). A response only wins once it has all the
+    required sections, and `on_section` is only called with the sections of the winner.
+
+    Returns:
+        Tuple[str, bool, bool]: The parsed response, whether it was stopped early, and
+            whether it came from the original request rather than the duplicate.
+    """
+
+    def call(provider: str, params: dict, primary: bool):
+        def attempt(cancel: threading.Event) -> Tuple[str, bool, bool]:
+            # The loser raises `HedgeCancelled` before its result is parsed, so its
+            # usage is counted by `_admitted` instead.
+            with circuit(provider), _admitted(
+                provider, params, token_counter
+            ) as completion:
+                _, stopped_early = _stream_text(
+                    provider,
+                    params,
+                    required_sections,
+                    max_preamble_chars,
+                    None,
+                    cancel,
+                    completion,
+                )
+            if provider == "gpt":
+                text = _parse_gpt_result(completion, None, False, token_counter)
+            else:
+                text = _parse_sonnet_result(completion, token_counter)
+            sections = parse_to_dict(text)
+            missing = [s for s in required_sections or [] if s not in sections]
+            if missing:
+                raise MalformedResponseError(f"Missing sections: {', '.join(missing)}")
+            return text, stopped_early, primary
+
+        return attempt
+
+    text, stopped_early, primary_won = get_hedger().run(  # type: ignore
+        (provider, metrics.current_stage()),
+        call(provider, params, True),
+        call(*hedge, False),
+    )
+    _emit_sections(text, on_section)
+    return text, stopped_early, primary_won
+
+
+def _emit_sections(text: str, on_section: Callable[[str, str], None] | None):
+    if on_section:
+        for header, content in parse_to_dict(text).items():
+            on_section(header, content)
+
+
+def _partial_cache_key(messages: list, required_sections: List[str] | None):
+    """The cache key for a response that was only streamed up to its required sections."""
+    if not required_sections:
+        return None
+    return [*messages, {"required_sections": required_sections}]
+
+
+def _gpt_messages(user_prompt: str | None, system_prompt: str | None) -> list:
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -59,13 +291,16 @@ def gpt4(
         raise ValueError(
             "At least one of user_prompt or system_prompt must be provided"
         )
+    return messages
 
-    if caching_enabled:
-        cached_response = _get_cached_response(messages, GPT_CACHE_FILE)
-        if cached_response:
-            print("Found cached response for gpt prompts...")
-            return cached_response
 
+def _gpt_params(
+    messages: list,
+    function: dict | None,
+    temperature: float,
+    json_mode: bool,
+    max_tokens: int,
+) -> dict:
     params = {
         "model": "chatgpt-4o-latest" if json_mode else "gpt-4o",
         "messages": [*messages],
@@ -84,28 +319,201 @@ def gpt4(
             "function": {"name": function["name"]},
         }
 
-    result = openai.OpenAI().chat.completions.create(**params)
+    return params
+
 
-    if token_counter is not None and result.usage:
-        token_counter["prompt_tokens"] += result.usage.prompt_tokens
-        token_counter["completion_tokens"] += result.usage.completion_tokens
+def _parse_gpt_result(
+    result: Completion,
+    function: dict | None,
+    json_mode: bool,
+    token_counter: Counter | None,
+    batch: bool = False,
+) -> str | dict | list:
+    _count_tokens(token_counter, result, "gpt", batch)
 
     if json_mode:
-        parsed_result = json.loads(
-            result.choices[0]
-            .message.content.split("```json")[1]
-            .split("```")[0]
-            .strip()
+        return json.loads(
+            str(result.text).split("```json")[1].split("```")[0].strip()
         )
     elif function:
-        parsed_result = json.loads(
-            result.choices[0].message.tool_calls[0].function.arguments
-        )
+        return json.loads(str(result.tool_arguments))
     else:
-        parsed_result = result.choices[0].message.content.strip()
+        return str(result.text).strip()
+
+
+def _parse_sonnet_result(
+    result: Completion, token_counter: Counter | None, batch: bool = False
+) -> str:
+    _count_tokens(token_counter, result, "sonnet", batch)
+    return str(result.text)
+
+
+def _count_tokens(
+    token_counter: Counter | None,
+    result: Completion,
+    provider: str,
+    batch: bool = False,
+):
+    """
+    Add a response's token usage to a counter, to the current span and to the spent
+    budget of the run.
+
+    gpt tokens are counted under "prompt_tokens", "completion_tokens" and
+    "cached_prompt_tokens", sonnet tokens under the same keys prefixed with "sonnet_"
+    plus "sonnet_cache_write_tokens", so both can be priced separately. Tokens of a
+    batch response are further prefixed with "batch_", as they cost half as much.
+    """
+    metrics.record(cache_misses=1, provider_latency=result.latency, **result.usage)
+    get_admission().record(provider, result.usage, batch)
+    if token_counter is None:
+        return
+    prefix = ("batch_" if batch else "") + ("sonnet_" if provider == "sonnet" else "")
+    with _token_counter_lock:
+        for key, count in result.usage.items():
+            token_counter[prefix + key] += count
+
+
+def _sonnet_params(
+    user_prompt: str,
+    system_prompt: str,
+    temperature: float,
+    max_tokens: int,
+    prompt_caching: bool = True,
+) -> dict:
+    beta_features = []
+    if max_tokens > 4096:
+        beta_features.append("max-tokens-3-5-sonnet-2024-07-15")
+    if prompt_caching:
+        beta_features.append("prompt-caching-2024-07-31")
+    extra_headers = (
+        {"anthropic-beta": ",".join(beta_features)} if beta_features else {}
+    )
+
+    # The system prompts are static, so mark them as a cacheable prefix.
+    system = (
+        [
+            {
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+        if prompt_caching
+        else system_prompt
+    )
+
+    return {
+        "model": "claude-3-5-sonnet-20240620",
+        "system": system,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "extra_headers": extra_headers,
+        "messages": [
+            {"role": "user", "content": [{"type": "text", "text": user_prompt}]}
+        ],
+    }
+
+
+def gpt4(
+    user_prompt: str | None = None,
+    system_prompt: str | None = None,
+    function: dict | None = None,
+    temperature: float = 0.0,
+    token_counter: Counter | None = None,
+    caching_enabled: bool = True,
+    json_mode: bool = False,
+    max_tokens: int = 4096,
+    required_sections: List[str] | None = None,
+    max_preamble_chars: int | None = None,
+    on_section: Callable[[str, str], None] | None = None,
+    similarity_threshold: float | None = None,
+) -> str | dict | list:
+    """
+    Get a completion from gpt-4o.
+
+    If any of `required_sections`, `max_preamble_chars` or `on_section` is set, the
+    response is streamed and parsed into markdown sections as it arrives (see
+    `SectionParser`), which is only supported for text responses. Generation then stops
+    as soon as all `required_sections` have arrived, and fails as soon as no header
+    has appeared within `max_preamble_chars` characters.
+
+    With a `similarity_threshold`, a cache miss falls back to the cached response of the
+    most similar user prompt (by embedding cosine similarity) with the same system
+    prompt, if it is at least that similar (see `SemanticCache`).
+    """
+    messages = _gpt_messages(user_prompt, system_prompt)
+    params = _gpt_params(messages, function, temperature, json_mode, max_tokens)
+    streaming = bool(required_sections or max_preamble_chars or on_section)
+    if streaming and (function or json_mode):
+        raise ValueError("Streaming is only supported for text responses")
+    partial_key = _partial_cache_key(messages, required_sections)
 
     if caching_enabled:
-        _cache_response(messages, parsed_result, GPT_CACHE_FILE)
+        cached_response = _get_cached_response(
+            messages, GPT_CACHE, similarity_threshold
+        )
+        if not cached_response and partial_key:
+            cached_response = _get_cached_response(partial_key, GPT_CACHE)
+        if cached_response:
+            print("Found cached response for gpt prompts...")
+            _emit_sections(str(cached_response), on_section)
+            return cached_response
+        batched_response = _get_batched_response(
+            "gpt",
+            messages,
+            GPT_CACHE,
+            params,
+            lambda c: _parse_gpt_result(c, function, json_mode, token_counter, True),
+            similarity_threshold,
+        )
+        if batched_response:
+            _emit_sections(str(batched_response), on_section)
+            return batched_response
+
+    stopped_early = False
+    # A response of the hedge's provider or model isn't cached as this request's.
+    primary_won = True
+    hedge = (
+        None
+        if function or json_mode
+        else _hedge_params("gpt", user_prompt, system_prompt, temperature, max_tokens)
+    )
+    if hedge:
+        parsed_result, stopped_early, primary_won = _hedged_text(
+            "gpt",
+            params,
+            hedge,
+            required_sections,
+            max_preamble_chars,
+            on_section,
+            token_counter,
+        )
+    else:
+        # The breaker is waited for first, so calls waiting out its cooldown don't
+        # hold admission slots or rate limit budget.
+        with circuit("gpt"), _admitted("gpt", params, token_counter) as result:
+            if streaming:
+                _, stopped_early = _stream_text(
+                    "gpt",
+                    params,
+                    required_sections,
+                    max_preamble_chars,
+                    on_section,
+                    completion=result,
+                )
+            else:
+                reply = get_provider().complete("gpt", params)
+                result.text = reply.text
+                result.tool_arguments = reply.tool_arguments
+                result.usage = reply.usage
+                result.latency = reply.latency
+        parsed_result = _parse_gpt_result(result, function, json_mode, token_counter)
+
+    if caching_enabled and primary_won:
+        if stopped_early:
+            _cache_response(partial_key, parsed_result, GPT_CACHE)
+        else:
+            _cache_response(messages, parsed_result, GPT_CACHE, similarity_threshold)
 
     return parsed_result
 
@@ -116,32 +524,162 @@ def sonnet(
     temperature: float = 0.2,
     caching_enabled: bool = True,
     max_tokens: int = 4096,
+    token_counter: Counter | None = None,
+    prompt_caching: bool = True,
+    required_sections: List[str] | None = None,
+    max_preamble_chars: int | None = None,
+    on_section: Callable[[str, str], None] | None = None,
+    similarity_threshold: float | None = None,
+    variant: int = 0,
 ) -> str:
+    """
+    Get a completion from claude-3.5-sonnet.
+
+    Calls with a different `variant` are cached separately, to sample several
+    independent responses to the same prompts.
+
+    Streaming works like in `gpt4`: if any of `required_sections`, `max_preamble_chars`
+    or `on_section` is set, the response is parsed into sections as it arrives, stopped
+    once the required sections are complete, and aborted early if malformed. So does
+    the `similarity_threshold` cache lookup.
+
+    With `prompt_caching`, the system prompt is marked as a cacheable prefix, so repeated
+    calls with the same system prompt are billed at the cached input rate.
+    """
     prompts = [system_prompt, user_prompt]
+    if variant:
+        prompts.append({"variant": variant})
+    params = _sonnet_params(
+        user_prompt, system_prompt, temperature, max_tokens, prompt_caching
+    )
+    streaming = bool(required_sections or max_preamble_chars or on_section)
+    partial_key = _partial_cache_key(prompts, required_sections)
 
     if caching_enabled:
-        cached_response = _get_cached_response(prompts, SONNET_CACHE_FILE)
+        cached_response = _get_cached_response(
+            prompts, SONNET_CACHE, similarity_threshold
+        )
+        if not cached_response and partial_key:
+            cached_response = _get_cached_response(partial_key, SONNET_CACHE)
         if cached_response:
             print("Found cached response for sonnet prompts...")
+            _emit_sections(cached_response, on_section)
             return cached_response
+        batched_response = _get_batched_response(
+            "sonnet",
+            prompts,
+            SONNET_CACHE,
+            params,
+            lambda c: _parse_sonnet_result(c, token_counter, True),
+            similarity_threshold,
+        )
+        if batched_response:
+            _emit_sections(batched_response, on_section)
+            return batched_response
 
-    extra_headers = (
-        {"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"}
-        if max_tokens > 4096
-        else {}
-    )
-
-    message = Anthropic().messages.create(
-        model="claude-3-5-sonnet-20240620",
-        system=system_prompt,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        extra_headers=extra_headers,
-        messages=[{"role": "user", "content": [{"type": "text", "text": user_prompt}]}],
-    )
-    response = message.content[0].text  # type: ignore
+    stopped_early = False
+    # A response of the hedge's provider or model isn't cached as this request's.
+    primary_won = True
+    hedge = _hedge_params("sonnet", user_prompt, system_prompt, temperature, max_tokens)
+    if hedge:
+        response, stopped_early, primary_won = _hedged_text(
+            "sonnet",
+            params,
+            hedge,
+            required_sections,
+            max_preamble_chars,
+            on_section,
+            token_counter,
+        )
+    else:
+        with circuit("sonnet"), _admitted(
+            "sonnet", params, token_counter
+        ) as completion:
+            if streaming:
+                _, stopped_early = _stream_text(
+                    "sonnet",
+                    params,
+                    required_sections,
+                    max_preamble_chars,
+                    on_section,
+                    completion=completion,
+                )
+            else:
+                reply = get_provider().complete("sonnet", params)
+                completion.text = reply.text
+                completion.usage = reply.usage
+                completion.latency = reply.latency
+        response = _parse_sonnet_result(completion, token_counter)
 
-    if caching_enabled:
-        _cache_response(prompts, response, SONNET_CACHE_FILE)
+    if caching_enabled and primary_won:
+        if stopped_early:
+            _cache_response(partial_key, response, SONNET_CACHE)
+        else:
+            _cache_response(prompts, response, SONNET_CACHE, similarity_threshold)
 
     return response
+
+
+def set_concurrency(provider: str, limit: int):
+    """Set the maximum number of in-flight async requests for a provider ("gpt" or "sonnet")."""
+    global _executor
+    if provider not in _concurrency:
+        raise ValueError(f"Unknown provider: {provider}")
+    if limit < 1:
+        raise ValueError("Concurrency limit must be at least 1")
+    with _executor_lock:
+        _concurrency[provider] = limit
+        _semaphores.clear()
+        # Calls already running finish on the old threads.
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _get_semaphore(provider: str) -> asyncio.Semaphore:
+    # Semaphores are bound to the event loop they are first used in.
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = {}
+    loop_semaphores: Dict[str, asyncio.Semaphore] = _semaphores[loop]
+    if provider not in loop_semaphores:
+        loop_semaphores[provider] = asyncio.Semaphore(_concurrency[provider])
+    return loop_semaphores[provider]
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=sum(_concurrency.values()), thread_name_prefix="llm"
+            )
+        return _executor
+
+
+async def _run_limited(provider: str, fn: Callable, *args, **kwargs):
+    """
+    Run a sync provider call on a thread, once the provider's breaker is closed and one
+    of its concurrency slots is free. The call runs in a copy of the current context,
+    so batch mode and metrics still apply.
+    """
+    queued_at = time.time()
+    await get_breaker(provider).async_wait()
+    async with _get_semaphore(provider):
+        metrics.record(queue_time=time.time() - queued_at)
+        call = partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), call)
+
+
+async def agpt4(*args, **kwargs) -> str | dict | list:
+    """
+    Async version of `gpt4`, with the same arguments, limited to the "gpt" concurrency
+    limit. The call runs `gpt4` on a thread, so it caches, streams, hedges and is
+    admitted exactly like the sync call.
+    """
+    return await _run_limited("gpt", gpt4, *args, **kwargs)
+
+
+async def asonnet(*args, **kwargs) -> str:
+    """Async version of `sonnet`, limited to the "sonnet" concurrency limit (see `agpt4`)."""
+    return await _run_limited("sonnet", sonnet, *args, **kwargs)
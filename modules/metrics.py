@@ -0,0 +1,208 @@
+from collections import Counter, defaultdict
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+from batch import BatchPending
+
+TRACE_DIR = "./data/traces"
+
+
+class Span:
+    """
+    Measures one execution of a pipeline stage.
+
+    Attributes:
+        stage (str): The name of the stage, e.g. "context" or "dedupe-card".
+        attempt (int): The attempt number, starting at 1. Spans with a higher attempt
+            number are retries.
+        started_at (float): The start time, as a unix timestamp.
+        wall_time (float): The time the stage took, in seconds.
+        counts (Counter): Counters recorded during the stage: "cache_hits", "cache_misses",
+            "queue_time" and "provider_latency" (in seconds) and token counts.
+        error (str | None): The error the stage failed with, if any.
+    """
+
+    def __init__(self, stage: str, attempt: int = 1):
+        self.stage = stage
+        self.attempt = attempt
+        self.started_at = time.time()
+        self.wall_time = 0.0
+        self.counts = Counter()
+        self.error = None
+
+    def to_json(self) -> dict:
+        return {
+            "stage": self.stage,
+            "attempt": self.attempt,
+            "started_at": self.started_at,
+            "wall_time": self.wall_time,
+            "error": self.error,
+            **self.counts,
+        }
+
+
+class Trace:
+    """
+    Collects the spans of a run and appends each one to a JSONL trace file.
+
+    Attributes:
+        name (str): The name of the run.
+        path (str | None): The trace file. If None, spans are only kept in memory.
+        spans (List[Span]): The finished spans.
+    """
+
+    def __init__(self, name: str, path: str | None = None):
+        self.name = name
+        self.path = path
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+            if self.path:
+                with open(self.path, "a") as file:
+                    file.write(json.dumps(span.to_json()) + "\n")
+
+    def summary(self) -> str:
+        """A table of wall time, queue time, cache hits, tokens and retries per stage."""
+        with self._lock:
+            spans = list(self.spans)
+
+        by_stage: Dict[str, List[Span]] = defaultdict(list)
+        for s in spans:
+            by_stage[s.stage].append(s)
+
+        columns = [
+            ("stage", 16),
+            ("calls", 6),
+            ("wall s", 9),
+            ("p50 s", 8),
+            ("p95 s", 8),
+            ("queue s", 8),
+            ("hits", 6),
+            ("misses", 6),
+            ("in tok", 10),
+            ("cached", 10),
+            ("out tok", 9),
+            ("retries", 7),
+            ("errors", 6),
+        ]
+        lines = [_format_row([name for name, _ in columns], columns)]
+        for stage, stage_spans in by_stage.items():
+            wall_times = sorted(s.wall_time for s in stage_spans)
+            totals = sum((s.counts for s in stage_spans), Counter())
+            row = [
+                stage,
+                len(stage_spans),
+                f"{sum(wall_times):.1f}",
+                f"{_percentile(wall_times, 0.5):.2f}",
+                f"{_percentile(wall_times, 0.95):.2f}",
+                f"{totals['queue_time']:.1f}",
+                totals["cache_hits"],
+                totals["cache_misses"],
+                totals["prompt_tokens"],
+                totals["cached_prompt_tokens"],
+                totals["completion_tokens"],
+                sum(1 for s in stage_spans if s.attempt > 1),
+                sum(1 for s in stage_spans if s.error),
+            ]
+            lines.append(_format_row(row, columns))
+        return "\n".join(lines)
+
+    def print_summary(self):
+        print(f"\nStage summary for {self.name}:")
+        print(self.summary())
+        if self.path:
+            print(f"Trace written to {self.path}")
+
+
+def _format_row(row: list, columns: List[tuple]) -> str:
+    # Stage names are left-aligned, numbers right-aligned.
+    cells = [str(row[0]).ljust(columns[0][1])]
+    cells += [str(v).rjust(width) for v, (_, width) in zip(row[1:], columns[1:])]
+    return " ".join(cells)
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+_trace: Trace | None = None
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_current_attempt: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "current_attempt", default=1
+)
+
+
+def start_trace(name: str, write: bool = True) -> Trace:
+    """Start collecting spans for a run, written to `TRACE_DIR/<name>_<timestamp>.jsonl`."""
+    global _trace
+    path = (
+        os.path.join(TRACE_DIR, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+        if write
+        else None
+    )
+    _trace = Trace(name, path)
+    return _trace
+
+
+def current_trace() -> Trace | None:
+    return _trace
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Measure a stage, collecting everything `record` is called with inside it."""
+    s = Span(stage, _current_attempt.get())
+    token = _current_span.set(s)
+    start = time.time()
+    deferred = False
+    try:
+        yield s
+    except BatchPending:
+        # The stage runs again once its batch is done, and is measured then.
+        deferred = True
+        raise
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.wall_time = time.time() - start
+        _current_span.reset(token)
+        if _trace is not None and not deferred:
+            _trace.add(s)
+
+
+@contextlib.contextmanager
+def attempt(n: int):
+    """Mark the spans started in this block as attempt `n` of a retried call."""
+    token = _current_attempt.set(n)
+    try:
+        yield
+    finally:
+        _current_attempt.reset(token)
+
+
+def current_stage() -> str | None:
+    """The stage of the current span, if there is one."""
+    s = _current_span.get()
+    return s.stage if s is not None else None
+
+
+def record(**counts: float):
+    """Add counts to the current span, if there is one."""
+    s = _current_span.get()
+    if s is not None:
+        s.counts.update(counts)
@@ -0,0 +1,177 @@
+import argparse
+import json
+from typing import Callable, List
+
+import numpy as np
+
+from graph import EXACT, MATCH_MODES, Edge, MoralGraph
+
+# The defaults of `nx.pagerank`, which winning values used to be ranked with.
+ALPHA = 0.85
+MAX_ITER = 100
+TOL = 1.0e-6
+
+
+def batched_pagerank(
+    sources: np.ndarray,
+    targets: np.ndarray,
+    node_blocks: np.ndarray,
+    alpha: float = ALPHA,
+    max_iter: int = MAX_ITER,
+    tol: float = TOL,
+) -> np.ndarray:
+    """
+    PageRank of many separate graphs in one power iteration, like `nx.pagerank` on each.
+
+    The graphs are the blocks of one block-diagonal graph: node i belongs to graph
+    `node_blocks[i]`, and every edge connects two nodes of the same graph. As in a
+    `DiGraph`, parallel edges count once. Each graph teleports to, and spreads the
+    score of its dangling nodes over, its own nodes only, and stops iterating once it
+    has converged on its own.
+
+    Args:
+        sources (np.ndarray): The source node of each edge.
+        targets (np.ndarray): The target node of each edge.
+        node_blocks (np.ndarray): The graph of each node, numbered from 0.
+        alpha (float): The damping factor.
+        max_iter (int): The most iterations.
+        tol (float): The convergence tolerance per node, as in `nx.pagerank`.
+
+    Returns:
+        np.ndarray: The score of each node. The scores of each graph sum to 1.
+    """
+    n_nodes = len(node_blocks)
+    if n_nodes == 0:
+        return np.zeros(0)
+    n_blocks = int(node_blocks.max()) + 1
+    sizes = np.bincount(node_blocks, minlength=n_blocks).astype(float)
+    node_sizes = sizes[node_blocks]
+
+    edges = np.unique(sources.astype(np.int64) * n_nodes + targets)
+    sources, targets = edges // n_nodes, edges % n_nodes
+    out_degrees = np.bincount(sources, minlength=n_nodes)
+    edge_weights = 1.0 / out_degrees[sources]
+    dangling = out_degrees == 0
+
+    x = 1.0 / node_sizes
+    active = np.ones(n_blocks, dtype=bool)
+    for _ in range(max_iter):
+        dangling_scores = np.bincount(
+            node_blocks, weights=x * dangling, minlength=n_blocks
+        )
+        spread = np.bincount(
+            targets, weights=x[sources] * edge_weights, minlength=n_nodes
+        )
+        new_x = (
+            alpha * (spread + dangling_scores[node_blocks] / node_sizes)
+            + (1 - alpha) / node_sizes
+        )
+        errors = np.bincount(node_blocks, weights=np.abs(new_x - x), minlength=n_blocks)
+        # Graphs that converged earlier keep the scores they converged to.
+        x = np.where(active[node_blocks], new_x, x)
+        active &= errors >= sizes * tol
+        if not active.any():
+            return x
+
+    print(f"PageRank did not converge for {int(active.sum())} graphs.")
+    return x
+
+
+def rank_subgraphs(
+    subgraphs: List[List[Edge]],
+    value_position: Callable[[str], int | None],
+    n_values: int = 1,
+) -> List[List[int]]:
+    """
+    Rank the values of many subgraphs of a graph by PageRank, all at once.
+
+    Args:
+        subgraphs (List[List[Edge]]): The edges of each subgraph.
+        value_position (Callable): Gives the position of a value in the graph by id, or
+            None if the graph has no such value.
+        n_values (int): The number of values to return per subgraph.
+
+    Returns:
+        List[List[int]]: The positions of the `n_values` best ranked values of each
+            subgraph, best first. Ties go to the value that comes first in the graph.
+            Edge endpoints that are not values of the graph are ranked, but not returned.
+    """
+    source_ids = [e.from_id for edges in subgraphs for e in edges]
+    target_ids = [e.to_id for edges in subgraphs for e in edges]
+    blocks = np.repeat(
+        np.arange(len(subgraphs), dtype=np.int64), [len(e) for e in subgraphs]
+    )
+
+    # Nodes are keyed by their value's position in the graph, so they sort in graph
+    # order within their subgraph. Ids without a value sort after all values.
+    keys = {id: value_position(id) for id in dict.fromkeys(source_ids + target_ids)}
+    missing = [id for id, key in keys.items() if key is None]
+    n_values_keys = max((k for k in keys.values() if k is not None), default=-1) + 1
+    for i, id in enumerate(missing):
+        keys[id] = n_values_keys + i
+    n_keys = n_values_keys + len(missing)
+
+    source_nodes = blocks * n_keys + np.array(
+        [keys[id] for id in source_ids], dtype=np.int64
+    )
+    target_nodes = blocks * n_keys + np.array(
+        [keys[id] for id in target_ids], dtype=np.int64
+    )
+    nodes = np.unique(np.concatenate([source_nodes, target_nodes]))
+    node_blocks, node_keys = nodes // n_keys, nodes % n_keys
+    # Number the subgraphs that have edges consecutively.
+    block_ids, node_blocks = np.unique(node_blocks, return_inverse=True)
+
+    scores = batched_pagerank(
+        np.searchsorted(nodes, source_nodes),
+        np.searchsorted(nodes, target_nodes),
+        node_blocks,
+    )
+
+    # Sort the value nodes by subgraph, then by score, and keep the first n of each.
+    order = np.lexsort((node_keys, -scores, node_blocks))
+    order = order[node_keys[order] < n_values_keys]
+    ordered_blocks = node_blocks[order]
+    ranks = np.arange(len(order)) - np.searchsorted(ordered_blocks, ordered_blocks)
+    ranked: List[List[int]] = [[] for _ in subgraphs]
+    for node in order[ranks < n_values]:
+        ranked[block_ids[node_blocks[node]]].append(int(node_keys[node]))
+    return ranked
+
+
+if __name__ == "__main__":
+    """Write the winning values of every context of a graph file to a JSON file."""
+
+    parser = argparse.ArgumentParser(
+        description="Precompute the winning values of every context of a graph."
+    )
+    parser.add_argument("graph", type=str, help="The graph JSON file.")
+    parser.add_argument(
+        "--n_values",
+        type=int,
+        default=1,
+        help="The number of winning values per context.",
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCH_MODES,
+        default=EXACT,
+        help="Which edges make up the subgraph of a context (see `MoralGraph.get_edges`).",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./winning_values.json",
+        help="The JSON file to write the table of context -> winning value ids to.",
+    )
+    args = parser.parse_args()
+
+    graph = MoralGraph.from_file(args.graph)
+    table = graph.get_winning_values_table(n_values=args.n_values, match=args.match)
+    with open(args.output, "w") as f:
+        json.dump(
+            {context: [v.id for v in values] for context, values in table.items()},
+            f,
+            indent=2,
+        )
+    print(f"Wrote the winning values of {len(table)} contexts to {args.output}")
@@ -0,0 +1,137 @@
+import contextlib
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+# Marks the end of the input of a stage.
+_DONE = object()
+
+
+class Stage:
+    """
+    A step of a pipeline, run by its own pool of worker threads.
+
+    Attributes:
+        name (str): The name of the stage.
+        fn (Callable[[Any], Any]): Turns the state of an item into its next state.
+        concurrency (int): The number of items the stage processes at once.
+        queue_size (int): The number of items that can wait for the stage. A full queue
+            blocks the stage before it, so no stage runs far ahead of a slower one.
+        slots (threading.Semaphore | None): Shared by stages that together may only
+            process that many items at once, e.g. the same step repeated for every hop.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Any],
+        concurrency: int = 1,
+        queue_size: int | None = None,
+        slots: threading.Semaphore | None = None,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"Concurrency of stage {name} must be at least 1")
+        self.name = name
+        self.fn = fn
+        self.concurrency = concurrency
+        self.queue_size = queue_size or 2 * concurrency
+        self.slots = slots
+
+
+def run_pipeline(
+    items: Iterable[Any], stages: List[Stage]
+) -> Iterator[Tuple[Any, Any, Exception | None]]:
+    """
+    Run every item through the stages, with all stages working at the same time.
+
+    Stages are connected by bounded queues, so throughput is set by the slowest stage
+    rather than by the slowest item. An item that fails in a stage skips the remaining
+    stages.
+
+    Yields:
+        Tuple: `(item, state, error)` for every item, in the order of `items`, where
+            `state` is the output of the last stage the item passed and `error` is the
+            exception it failed with, if any.
+    """
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+    output: queue.Queue = queue.Queue()
+    feed_errors: List[BaseException] = []
+
+    def feed():
+        try:
+            for i, item in enumerate(items):
+                queues[0].put((i, item, item, None))
+        except BaseException as e:
+            feed_errors.append(e)
+        finally:
+            for _ in range(stages[0].concurrency):
+                queues[0].put(_DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for n, stage in enumerate(stages):
+        last = n + 1 == len(stages)
+        out_queue = output if last else queues[n + 1]
+        n_next = 1 if last else stages[n + 1].concurrency
+        countdown = _Countdown(stage.concurrency)
+        threads += [
+            threading.Thread(
+                target=_work,
+                args=(stage, queues[n], out_queue, n_next, countdown),
+                name=f"{stage.name}-{k}",
+                daemon=True,
+            )
+            for k in range(stage.concurrency)
+        ]
+
+    for thread in threads:
+        thread.start()
+
+    # Results arrive in any order; hold them back until all earlier items are out.
+    finished: Dict[int, Tuple[Any, Any, Exception | None]] = {}
+    next_index = 0
+    while (task := output.get()) is not _DONE:
+        i, item, state, error = task
+        finished[i] = (item, state, error)
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+    if feed_errors:
+        raise feed_errors[0]
+
+
+class _Countdown:
+    """Counts down the running workers of a stage."""
+
+    def __init__(self, n: int):
+        self.n = n
+        self._lock = threading.Lock()
+
+    def finish(self) -> bool:
+        """Count down one worker, returning whether it was the last one."""
+        with self._lock:
+            self.n -= 1
+            return self.n == 0
+
+
+def _work(
+    stage: Stage,
+    in_queue: queue.Queue,
+    out_queue: queue.Queue,
+    n_next: int,
+    countdown: _Countdown,
+):
+    while (task := in_queue.get()) is not _DONE:
+        i, item, state, error = task
+        if error is None:
+            try:
+                with stage.slots or contextlib.nullcontext():
+                    state = stage.fn(state)
+            except Exception as e:
+                error = e
+        out_queue.put((i, item, state, error))
+
+    # The last worker of a stage to finish ends the input of the next stage.
+    if countdown.finish():
+        for _ in range(n_next):
+            out_queue.put(_DONE)
@@ -0,0 +1,486 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator
+
+from admission import estimated_usage
+from clients import get_client
+
+
+PROVIDER_MODE = os.environ.get("LLM_PROVIDER_MODE", "live")
+TRACE_FILE = os.environ.get("LLM_TRACE_FILE", "./data/llm_trace.jsonl")
+REPLAY_LATENCY = (
+    float(os.environ["LLM_REPLAY_LATENCY"])
+    if os.environ.get("LLM_REPLAY_LATENCY")
+    else None
+)
+
+# Sections the generation pipeline parses, but which its prompts only name in
+# passing rather than as a markdown header.
+SYNTHETIC_EXTRA_SECTIONS = ["Problem"]
+
+
+class Completion:
+    """
+    A provider response, normalized across OpenAI and Anthropic.
+
+    Attributes:
+        text (str | None): The text of the response.
+        tool_arguments (str | None): The JSON arguments of the first tool call, if any.
+        usage (dict): Token usage. "prompt_tokens" counts all input tokens, including the
+            "cached_prompt_tokens" read from the provider's prompt cache and (for
+            Anthropic) the "cache_write_tokens" written to it.
+        latency (float): The time the provider took to respond, in seconds.
+    """
+
+    def __init__(
+        self,
+        text: str | None,
+        tool_arguments: str | None = None,
+        usage: dict | None = None,
+        latency: float = 0.0,
+    ):
+        self.text = text
+        self.tool_arguments = tool_arguments
+        self.usage = usage or {}
+        self.latency = latency
+
+    def to_json(self) -> dict:
+        return {
+            "text": self.text,
+            "tool_arguments": self.tool_arguments,
+            "usage": self.usage,
+            "latency": self.latency,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Completion":
+        return cls(
+            text=data.get("text"),
+            tool_arguments=data.get("tool_arguments"),
+            usage=data.get("usage"),
+            latency=data.get("latency", 0.0),
+        )
+
+
+def request_key(provider: str, params: dict) -> str:
+    """A stable key for a provider request, used to match recorded responses."""
+    return hashlib.sha256(
+        json.dumps([provider, params], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class Provider:
+    """
+    Base class for the backends `gpt4()` and `sonnet()` send their requests to.
+
+    Attributes:
+        calls (int): The number of requests served.
+        total_latency (float): The summed provider latency of all requests, in seconds.
+        cache_responses (bool): Whether responses may be written to the response cache.
+    """
+
+    cache_responses = True
+
+    def __init__(self):
+        self.calls = 0
+        self.total_latency = 0.0
+        self._stats_lock = threading.Lock()
+
+    def complete(self, provider: str, params: dict) -> Completion:
+        raise NotImplementedError
+
+    def stream(
+        self, provider: str, params: dict, completion: Completion
+    ) -> Iterator[str]:
+        """
+        Stream the text of a response in chunks.
+
+        Once the stream is exhausted or closed early, `completion` holds the text
+        streamed so far, the usage (if the provider reported it) and the latency.
+        """
+        result = self.complete(provider, params)
+        completion.text = result.text
+        completion.usage = result.usage
+        completion.latency = result.latency
+        yield result.text or ""
+
+    def _track(self, completion: Completion) -> Completion:
+        with self._stats_lock:
+            self.calls += 1
+            self.total_latency += completion.latency
+        return completion
+
+
+class LiveProvider(Provider):
+    """Sends requests to the OpenAI and Anthropic APIs."""
+
+    def complete(self, provider: str, params: dict) -> Completion:
+        start = time.time()
+        if provider == "gpt":
+            result = get_client("openai").chat.completions.create(**params)
+            completion = _from_openai(result)
+        elif provider == "sonnet":
+            message = get_client("anthropic").messages.create(**params)
+            completion = _from_anthropic(message)
+        else:
+            raise ValueError(f"Unknown provider: {provider}")
+        completion.latency = time.time() - start
+        return self._track(completion)
+
+    def stream(
+        self, provider: str, params: dict, completion: Completion
+    ) -> Iterator[str]:
+        start = time.time()
+        chunks = []
+        try:
+            if provider == "gpt":
+                response = get_client("openai").chat.completions.create(
+                    **params, stream=True, stream_options={"include_usage": True}
+                )
+                with response:
+                    for chunk in response:
+                        if chunk.usage:
+                            completion.usage = _openai_usage(chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            chunks.append(chunk.choices[0].delta.content)
+                            yield chunks[-1]
+            elif provider == "sonnet":
+                with get_client("anthropic").messages.stream(**params) as response:
+                    for event in response:
+                        # The input tokens are known from the first event, so they
+                        # are counted even if the stream is closed early.
+                        if event.type == "message_start":
+                            completion.usage = _anthropic_usage(event.message.usage)
+                        elif (
+                            event.type == "content_block_delta"
+                            and event.delta.type == "text_delta"
+                        ):
+                            chunks.append(event.delta.text)
+                            yield chunks[-1]
+                    completion.usage = _anthropic_usage(
+                        response.get_final_message().usage
+                    )
+            else:
+                raise ValueError(f"Unknown provider: {provider}")
+        finally:
+            completion.text = "".join(chunks)
+            # A stream closed early never gets its final usage, so the missing
+            # counts are estimated from the request and the text streamed so far.
+            estimate = estimated_usage(params, completion.text)
+            if not completion.usage:
+                completion.usage = estimate
+            completion.usage["completion_tokens"] = max(
+                completion.usage.get("completion_tokens", 0),
+                estimate["completion_tokens"],
+            )
+            completion.latency = time.time() - start
+            self._track(completion)
+
+
+class RecordingProvider(Provider):
+    """
+    Forwards requests to another provider and appends every request, response and
+    latency to a JSONL trace file, which a `ReplayProvider` can serve later.
+    """
+
+    def __init__(self, trace_file: str = TRACE_FILE, inner: Provider | None = None):
+        super().__init__()
+        self.trace_file = trace_file
+        self.inner = inner or LiveProvider()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+
+    def complete(self, provider: str, params: dict) -> Completion:
+        completion = self.inner.complete(provider, params)
+        self._record(provider, params, completion)
+        return self._track(completion)
+
+    def stream(
+        self, provider: str, params: dict, completion: Completion
+    ) -> Iterator[str]:
+        exhausted = False
+        try:
+            yield from self.inner.stream(provider, params, completion)
+            exhausted = True
+        finally:
+            self._record(provider, params, completion, partial=not exhausted)
+            self._track(completion)
+
+    def _record(
+        self,
+        provider: str,
+        params: dict,
+        completion: Completion,
+        partial: bool = False,
+    ):
+        record = {
+            "provider": provider,
+            "key": request_key(provider, params),
+            "request": params,
+            "response": completion.to_json(),
+            "latency": completion.latency,
+            "timestamp": time.time(),
+        }
+        if partial:
+            # A stream that was stopped early only holds the start of the response.
+            record["partial"] = True
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            with open(self.trace_file, "a") as file:
+                file.write(line)
+
+
+class ReplayProvider(Provider):
+    """
+    Serves responses from a recorded trace file without any network access.
+
+    Requests that are not in the trace get a synthetic response (see
+    `synthetic_completion`), unless `synthesize` is False, in which case a
+    KeyError is raised. Replayed responses are never written to the response cache,
+    so synthetic responses can't leak into live runs.
+
+    Attributes:
+        trace_file (str | None): The JSONL trace written by a `RecordingProvider`.
+        latency (float | None): If set, every response is delayed by this many seconds.
+            Otherwise recorded responses are delayed by their recorded latency
+            (scaled by `latency_scale`) and synthetic responses are served immediately.
+        latency_scale (float): A multiplier for the recorded latencies.
+        synthesize (bool): Whether to synthesize responses for unrecorded requests.
+        synthesizer (Callable): Builds a synthetic completion from a provider name and
+            request params.
+    """
+
+    cache_responses = False
+
+    def __init__(
+        self,
+        trace_file: str | None = TRACE_FILE,
+        latency: float | None = REPLAY_LATENCY,
+        latency_scale: float = 1.0,
+        synthesize: bool = True,
+        synthesizer: Callable[[str, dict], Completion] | None = None,
+    ):
+        super().__init__()
+        self.trace_file = trace_file
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.synthesize = synthesize
+        self.synthesizer = synthesizer or synthetic_completion
+        self.misses = 0
+        self._responses: Dict[str, Completion] = {}
+        self._partial_responses: Dict[str, Completion] = {}
+
+        if trace_file and os.path.exists(trace_file):
+            with open(trace_file, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    responses = (
+                        self._partial_responses
+                        if record.get("partial")
+                        else self._responses
+                    )
+                    responses[record["key"]] = Completion.from_json(
+                        record["response"]
+                    )
+
+    def _lookup(
+        self, provider: str, params: dict, allow_partial: bool = False
+    ) -> tuple[Completion, float]:
+        key = request_key(provider, params)
+        recorded = self._responses.get(key)
+        if recorded is None and allow_partial:
+            recorded = self._partial_responses.get(key)
+        if recorded is not None:
+            delay = recorded.latency * self.latency_scale
+            completion = Completion(
+                recorded.text, recorded.tool_arguments, dict(recorded.usage)
+            )
+        elif self.synthesize:
+            with self._stats_lock:
+                self.misses += 1
+            delay = 0.0
+            completion = self.synthesizer(provider, params)
+        else:
+            raise KeyError(f"No recorded response for {provider} request")
+
+        if self.latency is not None:
+            delay = self.latency
+        completion.latency = delay
+        return completion, delay
+
+    def complete(self, provider: str, params: dict) -> Completion:
+        completion, delay = self._lookup(provider, params)
+        if delay:
+            time.sleep(delay)
+        return self._track(completion)
+
+    def stream(
+        self, provider: str, params: dict, completion: Completion
+    ) -> Iterator[str]:
+        # Serve the response in small chunks, spreading the latency across them.
+        result, delay = self._lookup(provider, params, allow_partial=True)
+        text = result.text or ""
+        chunks = [text[i : i + 64] for i in range(0, len(text), 64)] or [""]
+        completion.usage = result.usage
+        start = time.time()
+        streamed = 0
+        try:
+            for chunk in chunks:
+                if delay:
+                    time.sleep(delay / len(chunks))
+                streamed += 1
+                yield chunk
+        finally:
+            completion.text = "".join(chunks[:streamed])
+            completion.latency = time.time() - start
+            self._track(completion)
+
+
+def _from_openai(result) -> Completion:
+    message = result.choices[0].message
+    tool_calls = getattr(message, "tool_calls", None)
+    return Completion(
+        text=message.content,
+        tool_arguments=tool_calls[0].function.arguments if tool_calls else None,
+        usage=_openai_usage(result.usage) if result.usage else {},
+    )
+
+
+def _from_anthropic(message) -> Completion:
+    return Completion(
+        text=message.content[0].text,  # type: ignore
+        usage=_anthropic_usage(message.usage) if message.usage else {},
+    )
+
+
+def _openai_usage(usage) -> dict:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_prompt_tokens": (getattr(details, "cached_tokens", 0) or 0),
+    }
+
+
+def _anthropic_usage(usage) -> dict:
+    # Anthropic reports cached input tokens separately from `input_tokens`.
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    return {
+        "prompt_tokens": usage.input_tokens + cache_write + cache_read,
+        "completion_tokens": usage.output_tokens,
+        "cached_prompt_tokens": cache_read,
+        "cache_write_tokens": cache_write,
+    }
+
+
+def _prompt_texts(provider: str, params: dict) -> list[str]:
+    texts = []
+    if provider == "sonnet":
+        system = params.get("system")
+        if isinstance(system, str):
+            texts.append(system)
+        elif system:
+            texts += [block["text"] for block in system]
+    for message in params.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts += [block["text"] for block in content if "text" in block]
+    return texts
+
+
+def synthetic_completion(provider: str, params: dict) -> Completion:
+    """
+    Build a deterministic, well-formed response for a request that was never recorded.
+
+    The response contains one markdown section for every header in the prompts (plus
+    `SYNTHETIC_EXTRA_SECTIONS`), so that `parse_to_dict` finds the sections the
+    pipeline expects. Tool calls get empty arguments and JSON mode an empty object.
+    Prompts without any headers are echoed back.
+    """
+    digest = request_key(provider, params)[:8]
+    texts = _prompt_texts(provider, params)
+    prompt_tokens = sum(len(t) for t in texts) // 4
+
+    if params.get("tools"):
+        return Completion(
+            text=None,
+            tool_arguments="{}",
+            usage={"prompt_tokens": prompt_tokens, "completion_tokens": 1},
+        )
+    if params.get("response_format", {}).get("type") == "json_object":
+        text = "```json\n{}\n```"
+    else:
+        headers = []
+        for text in texts:
+            for header in re.findall(r"^#+\s*(.+?)\s*$", text, re.MULTILINE):
+                if header not in headers:
+                    headers.append(header)
+
+        if headers:
+            headers += [h for h in SYNTHETIC_EXTRA_SECTIONS if h not in headers]
+            sections = []
+            for header in headers:
+                if "polic" in header.lower():
+                    content = "\n".join(
+                        f"SYNTHETIC POLICY {i} for {digest}" for i in range(1, 4)
+                    )
+                else:
+                    content = f"synthetic {header.lower()} {digest}"
+                sections.append(f"## {header}\n\n{content}")
+            text = "\n\n".join(sections)
+        else:
+            text = texts[-1] if texts else ""
+
+    return Completion(
+        text=text,
+        usage={"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4},
+    )
+
+
+_provider: Provider | None = None
+_provider_lock = threading.Lock()
+
+
+def set_provider(provider: Provider):
+    """Route all `gpt4()`/`sonnet()` requests through a provider."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
+
+
+def get_provider() -> Provider:
+    """Get the current provider, creating it from `LLM_PROVIDER_MODE` on first use."""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = make_provider(PROVIDER_MODE)
+        return _provider
+
+
+def make_provider(mode: str, trace_file: str = TRACE_FILE, **kwargs) -> Provider:
+    """
+    Create a provider for a mode.
+
+    Args:
+        mode (str): "live", "record" (live, writing a trace to `trace_file`) or "replay"
+            (serving responses from `trace_file`).
+        trace_file (str): The JSONL trace file to record to or replay from.
+        kwargs: Extra arguments for the `ReplayProvider`.
+    """
+    if mode == "live":
+        return LiveProvider()
+    if mode == "record":
+        return RecordingProvider(trace_file)
+    if mode == "replay":
+        return ReplayProvider(trace_file, **kwargs)
+    raise ValueError(f"Unknown provider mode: {mode}")
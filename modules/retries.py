@@ -0,0 +1,264 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, TypeVar
+
+from admission import BudgetExceeded
+from batch import BatchPending
+import metrics
+from utils import MalformedResponseError
+
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+SERVER = "server"
+PARSE = "parse"
+CONTENT = "content"
+OTHER = "other"
+
+# Errors that mean the provider itself is struggling, as opposed to the request.
+PROVIDER_ERRORS = [RATE_LIMIT, TIMEOUT, SERVER]
+
+BREAKER_THRESHOLD = int(os.environ.get("LLM_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30.0))
+
+
+class StageFailed(Exception):
+    """Raised when a pipeline stage failed on every attempt, or with an error that isn't retried."""
+
+    def __init__(self, stage: str, kind: str, attempts: int, error: Exception):
+        super().__init__(
+            f"Stage {stage} failed after {attempts} attempt(s) ({kind} error): {error}"
+        )
+        self.stage = stage
+        self.kind = kind
+        self.attempts = attempts
+        self.error = error
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Classify an error as RATE_LIMIT, TIMEOUT, SERVER (connection and 5xx errors),
+    PARSE (a malformed response), CONTENT (a request the provider refuses) or OTHER.
+    """
+    if isinstance(error, _sdk_errors("RateLimitError")):
+        return RATE_LIMIT
+    if isinstance(error, (*_sdk_errors("APITimeoutError"), TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, _sdk_errors("APIConnectionError")):
+        return SERVER
+    if isinstance(
+        error,
+        _sdk_errors(
+            "ContentFilterFinishReasonError", "BadRequestError", "PermissionDeniedError"
+        ),
+    ):
+        return CONTENT
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return RATE_LIMIT
+    # 529 is Anthropic's "overloaded".
+    if isinstance(status_code, int) and status_code >= 500:
+        return SERVER
+    if isinstance(
+        error,
+        (MalformedResponseError, KeyError, IndexError, json.JSONDecodeError),
+    ):
+        return PARSE
+    return OTHER
+
+
+def _sdk_errors(*names: str) -> tuple:
+    """
+    The exception classes with these names in the openai and anthropic SDKs. SDKs that
+    weren't imported can't have raised the error, so they aren't imported for this.
+    """
+    classes = []
+    for sdk in ["openai", "anthropic"]:
+        module = sys.modules.get(sdk)
+        if module is not None:
+            classes += [getattr(module, n) for n in names if hasattr(module, n)]
+    return tuple(classes)
+
+
+class RetryPolicy:
+    """
+    How often, and how long after, a failed stage is retried.
+
+    Delays grow exponentially from a base delay per error class, with full jitter, so
+    workers that failed together don't retry together. A provider's `retry-after`
+    header takes precedence. Parse errors are retried right away, since waiting doesn't
+    change the response, and content errors are not retried at all.
+
+    Attributes:
+        max_attempts (int): The maximum number of attempts, including the first one.
+        base_delays (Dict[str, float]): The delay before the first retry per error class,
+            in seconds. Error classes without a delay are not retried.
+        max_delay (float): The maximum delay between attempts, in seconds.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delays: Dict[str, float] | None = None,
+        max_delay: float = 60.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delays = (
+            base_delays
+            if base_delays is not None
+            else {RATE_LIMIT: 4.0, TIMEOUT: 2.0, SERVER: 2.0, PARSE: 0.0, OTHER: 1.0}
+        )
+        self.max_delay = max_delay
+
+    def should_retry(self, kind: str, attempt: int) -> bool:
+        return kind in self.base_delays and attempt < self.max_attempts
+
+    def delay(self, kind: str, attempt: int, error: Exception | None = None) -> float:
+        """The time to wait before the attempt after `attempt` (starting at 1)."""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        cap = min(self.max_delay, self.base_delays[kind] * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+def _retry_after(error: Exception | None) -> float | None:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+T = TypeVar("T")
+
+
+def run_stage(
+    stage: str,
+    fn: Callable[[int], T],
+    policy: RetryPolicy = DEFAULT_POLICY,
+) -> T:
+    """
+    Run one stage of the pipeline, retrying it on failure according to `policy`.
+
+    `fn` gets the attempt number (starting at 1), so that retries can bypass a cached
+    response that failed to parse. Stages that ran before keep their results, so only
+    the failing stage is retried. Each attempt is measured as a span of the stage.
+
+    Raises:
+        StageFailed: If the stage failed on its last attempt, or with an error that
+            isn't retried.
+    """
+    attempt = 1
+    while True:
+        try:
+            with metrics.attempt(attempt), metrics.span(stage):
+                return fn(attempt)
+        except (BatchPending, BudgetExceeded):
+            raise
+        except Exception as e:
+            kind = classify_error(e)
+            if not policy.should_retry(kind, attempt):
+                raise StageFailed(stage, kind, attempt, e) from e
+            delay = policy.delay(kind, attempt, e)
+            print(
+                f"Stage {stage} failed ({kind} error: {e}), retrying in {delay:.1f}s..."
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+class CircuitBreaker:
+    """
+    Pauses all calls to a provider while it is failing.
+
+    After `threshold` consecutive rate-limit, timeout or server errors, the breaker
+    opens: every worker that tries to call the provider waits until `cooldown` seconds
+    have passed. Then calls are let through again, and a single further failure opens
+    the breaker again, while a success closes it.
+
+    Attributes:
+        name (str): The name of the provider.
+        threshold (int): The number of consecutive failures that opens the breaker.
+        cooldown (float): How long the breaker stays open, in seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        threshold: int = BREAKER_THRESHOLD,
+        cooldown: float = BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """The time until the breaker lets calls through again, in seconds."""
+        return max(0.0, self.open_until - time.time())
+
+    def wait(self):
+        """Block until the breaker lets calls through."""
+        while (remaining := self.remaining()) > 0:
+            time.sleep(remaining)
+
+    async def async_wait(self):
+        """Wait until the breaker lets calls through, without blocking the event loop."""
+        while (remaining := self.remaining()) > 0:
+            await asyncio.sleep(remaining)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self, error: Exception):
+        if classify_error(error) not in PROVIDER_ERRORS:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and not self.remaining():
+                self.open_until = time.time() + self.cooldown
+                # After the cooldown, one more failure is enough to reopen.
+                self.failures = self.threshold - 1
+                print(
+                    f"{self.name} is failing, pausing all {self.name} calls for {self.cooldown}s..."
+                )
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    """Get the shared circuit breaker of a provider ("gpt" or "sonnet")."""
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+@contextlib.contextmanager
+def circuit(provider: str):
+    """Guard a provider call with the provider's circuit breaker, waiting while it is open."""
+    breaker = get_breaker(provider)
+    breaker.wait()
+    try:
+        yield
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+    breaker.record_success()
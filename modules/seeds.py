@@ -0,0 +1,114 @@
+import glob
+import hashlib
+import json
+import os
+import random
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+GENERATED_QUESTIONS_DIR = "./data/generated_questions"
+CAI_PATH = "./data/cai_dataset.jsonl"
+
+
+class SeedSource:
+    """
+    A file of seed questions, read lazily one line at a time.
+
+    Attributes:
+        name (str): The name of the source, used to set its weight.
+        path (str): The path to the file: a text file with one question per line, or a
+            JSONL file with the question in `field`.
+        field (str | None): The field holding the question in each JSONL row.
+        weight (float): The share of the sampled questions drawn from this source,
+            relative to the other sources.
+    """
+
+    def __init__(
+        self, name: str, path: str, field: str | None = None, weight: float = 1.0
+    ):
+        self.name = name
+        self.path = path
+        self.field = field
+        self.weight = weight
+
+    def __iter__(self) -> Iterator[str]:
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                if self.field:
+                    line = json.loads(line)[self.field] if line.strip() else ""
+                question = line.strip()
+                if question:
+                    yield question
+
+
+def default_sources(
+    generated_questions_dir: str = GENERATED_QUESTIONS_DIR, cai_path: str = CAI_PATH
+) -> List[SeedSource]:
+    """The generated question files, one source per file, and the CAI dataset."""
+    sources = [
+        SeedSource(os.path.splitext(os.path.basename(path))[0], path)
+        for path in sorted(glob.glob(os.path.join(generated_questions_dir, "*.txt")))
+    ]
+    sources.append(SeedSource("cai", cai_path, field="init_prompt"))
+    return sources
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse a shard spec like "2/8" into `(2, 8)`. Shards are numbered from 0."""
+    index, count = (int(n) for n in shard.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}: expected i/N with 0 <= i < N")
+    return index, count
+
+
+def in_shard(question: str, shard: Tuple[int, int]) -> bool:
+    """Whether a question belongs to a shard, by a hash that is stable across runs."""
+    index, count = shard
+    digest = hashlib.sha256(question.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+
+def sample_seed_questions(
+    sources: List[SeedSource],
+    n: int,
+    seed: int = 0,
+    shard: Tuple[int, int] = (0, 1),
+    skip: Iterable[str] = (),
+) -> Iterator[str]:
+    """
+    Stream up to `n` seed questions drawn from the sources by weight.
+
+    Each question is drawn from a source picked at random by weight, taking the next
+    question of that source in file order, so only the lines read so far are ever in
+    memory. Once a source runs out, the remaining questions come from the others. The
+    same arguments always yield the same questions.
+
+    Args:
+        sources (List[SeedSource]): The sources to draw from.
+        n (int): The number of questions to yield.
+        seed (int): The seed of the source choices.
+        shard (Tuple[int, int]): `(i, N)` to only yield questions of shard i out of N, so
+            that N processes can split the sources without overlap.
+        skip (Iterable[str]): Questions that are already done, and are not yielded.
+
+    Yields:
+        str: The seed questions, without duplicates.
+    """
+    rng = random.Random(seed)
+    skip = set(skip)
+    seen: Set[str] = set()
+    streams: Dict[str, Iterator[str]] = {s.name: iter(s) for s in sources}
+    weights = {s.name: s.weight for s in sources if s.weight > 0}
+
+    while len(seen) < n and weights:
+        name = rng.choices(list(weights), list(weights.values()))[0]
+        for question in streams[name]:
+            if (
+                question not in seen
+                and question not in skip
+                and in_shard(question, shard)
+            ):
+                seen.add(question)
+                yield question
+                break
+        else:
+            del weights[name]
@@ -1,20 +1,81 @@
 from collections import Counter
 import re
+from typing import List, Tuple
 
 
 def serialize(obj) -> dict | list:
     if isinstance(obj, list):
         return [serialize(item) for item in obj]
+    elif hasattr(obj, "__slots__"):
+        return {key: serialize(getattr(obj, key)) for key in obj.__slots__}
     elif hasattr(obj, "__dict__"):
         return {key: serialize(value) for key, value in obj.__dict__.items()}
     else:
         return obj
 
 
+# The batch APIs of OpenAI and Anthropic charge half the price of interactive requests.
+BATCH_DISCOUNT = 0.5
+
+
 def gp4o_price(token_counter: Counter) -> float:
-    input_tokens = token_counter["prompt_tokens"]
+    cached_tokens = token_counter["cached_prompt_tokens"]
+    input_tokens = token_counter["prompt_tokens"] - cached_tokens
     output_tokens = token_counter["completion_tokens"]
-    return ((input_tokens * 5) / 1_000_000) + ((output_tokens * 15) / 1_000_000)
+    return (
+        ((input_tokens * 5) / 1_000_000)
+        + ((cached_tokens * 2.5) / 1_000_000)
+        + ((output_tokens * 15) / 1_000_000)
+    )
+
+
+def sonnet_price(token_counter: Counter) -> float:
+    cache_read_tokens = token_counter["sonnet_cached_prompt_tokens"]
+    cache_write_tokens = token_counter["sonnet_cache_write_tokens"]
+    input_tokens = (
+        token_counter["sonnet_prompt_tokens"] - cache_read_tokens - cache_write_tokens
+    )
+    output_tokens = token_counter["sonnet_completion_tokens"]
+    return (
+        ((input_tokens * 3) / 1_000_000)
+        + ((cache_write_tokens * 3.75) / 1_000_000)
+        + ((cache_read_tokens * 0.3) / 1_000_000)
+        + ((output_tokens * 15) / 1_000_000)
+    )
+
+
+def batch_price(token_counter: Counter) -> float:
+    """The price of the batch tokens of a counter, counted under keys prefixed with "batch_"."""
+    batch_counter = Counter(
+        {
+            key.removeprefix("batch_"): count
+            for key, count in token_counter.items()
+            if key.startswith("batch_")
+        }
+    )
+    return BATCH_DISCOUNT * (gp4o_price(batch_counter) + sonnet_price(batch_counter))
+
+
+def print_token_usage(token_counter: Counter):
+    print("gpt input tokens: ", token_counter["prompt_tokens"])
+    print("gpt cached input tokens: ", token_counter["cached_prompt_tokens"])
+    print("gpt output tokens: ", token_counter["completion_tokens"])
+    print("sonnet input tokens: ", token_counter["sonnet_prompt_tokens"])
+    print("sonnet cached input tokens: ", token_counter["sonnet_cached_prompt_tokens"])
+    print("sonnet cache write tokens: ", token_counter["sonnet_cache_write_tokens"])
+    print("sonnet output tokens: ", token_counter["sonnet_completion_tokens"])
+    print("batch gpt input tokens: ", token_counter["batch_prompt_tokens"])
+    print("batch gpt output tokens: ", token_counter["batch_completion_tokens"])
+    print("batch sonnet input tokens: ", token_counter["batch_sonnet_prompt_tokens"])
+    print(
+        "batch sonnet output tokens: ", token_counter["batch_sonnet_completion_tokens"]
+    )
+    print(
+        "price: ",
+        gp4o_price(token_counter)
+        + sonnet_price(token_counter)
+        + batch_price(token_counter),
+    )
 
 
 def parse_to_dict(text):
@@ -27,21 +88,85 @@ def parse_to_dict(text):
     return result
 
 
-def count_sentences(text: str) -> int:
-    return len([s for s in re.split(r"[.!?]+\s*", text.strip()) if s])
+class MalformedResponseError(ValueError):
+    """Raised when a streamed response doesn't have the expected markdown structure."""
+
 
+class SectionParser:
+    """
+    Incrementally splits streamed markdown text into sections, like `parse_to_dict`.
 
-def retry(times=3):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            for _ in range(times):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    kwargs["retry"] = True
-                    print(f"Error: {e}")
-            return None
+    A section is complete once the next `#` arrives (or the stream ends), so sections
+    are emitted one chunk after they are written.
+
+    Attributes:
+        sections (dict): The completed sections so far, by header.
+        required_sections (List[str]): The sections the caller needs. Once all of them
+            are complete, `is_complete` is True and the stream can be stopped early.
+        max_preamble_chars (int | None): If set, the response is considered malformed
+            when this many characters arrive before the first header.
+    """
+
+    def __init__(
+        self,
+        required_sections: List[str] | None = None,
+        max_preamble_chars: int | None = None,
+    ):
+        self.sections = {}
+        self.required_sections = required_sections or []
+        self.max_preamble_chars = max_preamble_chars
+        self._buffer = ""
+        self._in_preamble = True
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.required_sections) and all(
+            s in self.sections for s in self.required_sections
+        )
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """Feed a chunk of text, returning the sections it completed."""
+        parts = (self._buffer + chunk).split("#")
+        self._buffer = parts.pop()
+        completed = self._complete(parts)
+
+        if (
+            self._in_preamble
+            and self.max_preamble_chars is not None
+            and len(self._buffer) > self.max_preamble_chars
+        ):
+            raise MalformedResponseError(
+                f"No section header in the first {self.max_preamble_chars} characters"
+            )
+        return completed
+
+    def close(self) -> List[Tuple[str, str]]:
+        """End the stream, returning the last section."""
+        parts, self._buffer = [self._buffer], ""
+        return self._complete(parts)
+
+    def _complete(self, parts: List[str]) -> List[Tuple[str, str]]:
+        completed = []
+        for part in parts:
+            if self._in_preamble:
+                # Skip the text before the first header.
+                self._in_preamble = False
+                continue
+            if "\n" in part:
+                header, content = part.split("\n", 1)
+                self.sections[header.strip()] = content.strip()
+                completed.append((header.strip(), content.strip()))
+        return completed
+
+
+def count_sentences(text: str) -> int:
+    return len([s for s in re.split(r"[.!?]+\s*", text.strip()) if s])
 
-        return wrapper
 
-    return decorator
+def jaccard_similarity(a: str, b: str) -> float:
+    """The Jaccard similarity of the sets of lowercase words in two texts."""
+    words_a = set(re.findall(r"\w+", a.lower()))
+    words_b = set(re.findall(r"\w+", b.lower()))
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
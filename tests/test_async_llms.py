@@ -0,0 +1,68 @@
+"""The concurrency limits of `agpt4` and `asonnet`."""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+import pytest  # noqa: E402
+
+import llms  # noqa: E402
+import providers  # noqa: E402
+
+
+class CountingProvider(providers.Provider):
+    """Answers after a short delay, keeping track of the most calls in flight."""
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def complete(self, provider: str, params: dict) -> providers.Completion:
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.02)
+        with self._lock:
+            self.in_flight -= 1
+        usage = {"prompt_tokens": 10, "completion_tokens": 5}
+        return self._track(providers.Completion(f"{provider} answer", usage=usage))
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    provider = CountingProvider()
+    monkeypatch.setattr(providers, "_provider", provider)
+    monkeypatch.setitem(llms._concurrency, "gpt", 3)
+    monkeypatch.setitem(llms._concurrency, "sonnet", 3)
+    yield provider
+    llms.set_concurrency("gpt", llms._concurrency["gpt"])
+
+
+def test_agpt4_stays_within_the_concurrency_limit(provider):
+    llms.set_concurrency("gpt", 3)
+
+    async def run():
+        return await asyncio.gather(
+            *(llms.agpt4(f"prompt {i}", caching_enabled=False) for i in range(12))
+        )
+
+    assert asyncio.run(run()) == ["gpt answer"] * 12
+    assert provider.peak == 3
+
+
+def test_asonnet_shares_the_sync_path(provider):
+    async def run():
+        return await llms.asonnet("user", "system", caching_enabled=False)
+
+    assert asyncio.run(run()) == "sonnet answer"
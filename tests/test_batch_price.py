@@ -0,0 +1,53 @@
+"""Pricing the token usage of batch responses at the batch discount."""
+
+from collections import Counter
+import os
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+import pytest  # noqa: E402
+
+import admission  # noqa: E402
+import llms  # noqa: E402
+from providers import Completion  # noqa: E402
+from utils import batch_price, gp4o_price, sonnet_price  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def controller(monkeypatch):
+    controller = admission.AdmissionController()
+    monkeypatch.setattr(admission, "_controller", controller)
+    return controller
+
+
+def _completion() -> Completion:
+    return Completion("text", usage={"prompt_tokens": 1000, "completion_tokens": 500})
+
+
+def test_batch_gpt_response_costs_half(controller):
+    token_counter = Counter()
+    llms._parse_gpt_result(_completion(), None, False, token_counter)
+    interactive_cost = controller.spent_cost
+    llms._parse_gpt_result(_completion(), None, False, token_counter, batch=True)
+
+    assert controller.spent_cost == pytest.approx(1.5 * interactive_cost)
+    assert token_counter["prompt_tokens"] == 1000
+    assert token_counter["batch_prompt_tokens"] == 1000
+    assert batch_price(token_counter) == pytest.approx(gp4o_price(token_counter) / 2)
+
+
+def test_batch_sonnet_response_costs_half(controller):
+    token_counter = Counter()
+    llms._parse_sonnet_result(_completion(), token_counter)
+    interactive_cost = controller.spent_cost
+    llms._parse_sonnet_result(_completion(), token_counter, batch=True)
+
+    assert controller.spent_cost == pytest.approx(1.5 * interactive_cost)
+    assert token_counter["batch_sonnet_completion_tokens"] == 500
+    assert batch_price(token_counter) == pytest.approx(sonnet_price(token_counter) / 2)
@@ -0,0 +1,61 @@
+"""Workers of the work queue that hit database errors."""
+
+import os
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+import coordinator  # noqa: E402
+from coordinator import DONE, SqliteWorkQueue, run_worker  # noqa: E402
+
+
+class FlakyQueue(SqliteWorkQueue):
+    """Fails the first `complete` and `lease`, and every heartbeat."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = {"complete": 1, "lease": 1}
+        self.heartbeats = 0
+
+    def _maybe_fail(self, method: str):
+        if self.errors[method]:
+            self.errors[method] -= 1
+            raise ConnectionError(f"{method} failed")
+
+    def lease(self, *args, **kwargs):
+        self._maybe_fail("lease")
+        return super().lease(*args, **kwargs)
+
+    def complete(self, *args, **kwargs):
+        self._maybe_fail("complete")
+        return super().complete(*args, **kwargs)
+
+    def heartbeat(self, *args, **kwargs):
+        self.heartbeats += 1
+        raise ConnectionError("heartbeat failed")
+
+
+def test_worker_survives_database_errors(tmp_path, monkeypatch):
+    def generate_question(question, n_hops, token_counter):
+        # Slow enough for the heartbeat thread to run a few times.
+        for _ in range(20):
+            if queue.heartbeats >= 2:
+                break
+            coordinator.time.sleep(0.01)
+        return [], []
+
+    monkeypatch.setattr(coordinator, "generate_question", generate_question)
+    path = str(tmp_path / "queue.sqlite")
+    queue = FlakyQueue(SqliteWorkQueue.create_generation(path), path)
+    queue.enqueue(["q1", "q2"], n_hops=1)
+
+    completed = run_worker(queue, poll_interval=0.01, heartbeat_interval=0.01)
+
+    assert completed == 2
+    assert queue.counts()[DONE] == 2
+    assert queue.heartbeats >= 2
@@ -0,0 +1,74 @@
+"""Journaling the questions that finished when a run runs out of budget."""
+
+import os
+import sys
+import threading
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+import pytest  # noqa: E402
+
+import generate  # noqa: E402
+from admission import BudgetExceeded  # noqa: E402
+from graph import GraphJournal, MoralGraph, Value, ValuesData  # noqa: E402
+
+QUESTIONS = ["q0", "q1", "q2", "q3"]
+
+
+def test_questions_finished_after_the_budget_ran_out_are_journaled(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(generate, "runs_dir", str(tmp_path))
+    later_questions_done = threading.Barrier(3)
+
+    def fake_generate(question, **kwargs):
+        if question == "q1":
+            # Run out of budget only once the questions after this one have finished.
+            later_questions_done.wait(timeout=5)
+            raise BudgetExceeded("out of budget")
+        if question != "q0":
+            later_questions_done.wait(timeout=5)
+        return [Value(ValuesData(question, [], "context"))], []
+
+    monkeypatch.setattr(generate, "_try_generate_question", fake_generate)
+
+    with pytest.raises(BudgetExceeded):
+        generate.generate_graph(QUESTIONS, workers=4, run_name="run")
+
+    journal = GraphJournal(str(tmp_path / "run.jsonl"))
+    graph = journal.load(MoralGraph([], [], []))
+    assert sorted(graph.seed_questions) == ["q0", "q2", "q3"]
+
+
+def test_pipelined_questions_finished_after_the_budget_ran_out_are_journaled(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(generate, "runs_dir", str(tmp_path))
+
+    def context_stage(state, token_counter):
+        if state.question == "q1":
+            raise BudgetExceeded("out of budget")
+        return state
+
+    def value_stage(state, token_counter):
+        state.values.append(Value(ValuesData(state.question, [], "context")))
+        return state
+
+    monkeypatch.setattr(generate, "_context_stage", context_stage)
+    monkeypatch.setattr(generate, "_value_stage", value_stage)
+    monkeypatch.setattr(generate, "_stories_stage", lambda state, token_counter: state)
+    monkeypatch.setattr(generate, "_upgrade_stage", lambda state, token_counter: state)
+
+    with pytest.raises(BudgetExceeded):
+        generate.generate_graph(QUESTIONS, pipelined=True, run_name="run")
+
+    journal = GraphJournal(str(tmp_path / "run.jsonl"))
+    graph = journal.load(MoralGraph([], [], []))
+    assert graph.seed_questions == ["q0", "q2", "q3"]
@@ -0,0 +1,49 @@
+"""Replaying run journals that were interrupted while writing a question."""
+
+import json
+import os
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+from graph import GraphJournal, Value, ValuesData, serialize  # noqa: E402
+
+
+def _value(title: str) -> Value:
+    return Value(ValuesData(title, [f"{title} policy"], "context"))
+
+
+def _write(path: str, text: str):
+    with open(path, "a") as f:
+        f.write(text)
+
+
+def test_load_drops_events_before_a_cut_off_line(tmp_path):
+    journal = GraphJournal(str(tmp_path / "run.jsonl"))
+    journal.append("q1", [_value("A")], [])
+    orphan = json.dumps({"type": "value", "value": serialize(_value("ORPHAN"))})
+    _write(journal.path, orphan + '\n{"type": "seed", "quest')
+    journal.append("q3", [_value("B")], [])
+
+    graph = journal.load()
+
+    assert [v.data.title for v in graph.values] == ["A", "B"]
+    assert graph.seed_questions == ["q1", "q3"]
+
+
+def test_load_drops_events_of_a_question_cut_off_between_lines(tmp_path):
+    journal = GraphJournal(str(tmp_path / "run.jsonl"))
+    journal.append("q1", [_value("A")], [])
+    orphan = json.dumps({"type": "value", "value": serialize(_value("ORPHAN"))})
+    _write(journal.path, json.dumps({"type": "begin"}) + "\n" + orphan + "\n")
+    journal.append("q3", [_value("B")], [])
+
+    graph = journal.load()
+
+    assert [v.data.title for v in graph.values] == ["A", "B"]
+    assert list(journal.seed_questions()) == ["q1", "q3"]
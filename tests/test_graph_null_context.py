@@ -0,0 +1,53 @@
+"""Loading values whose choice context is null in the database."""
+
+import os
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+from binary_graph import read_compact_graph, read_graph  # noqa: E402
+from compact_graph import CompactMoralGraph  # noqa: E402
+from graph import Edge, EdgeMetadata, MoralGraph, Value, ValuesData  # noqa: E402
+
+
+def _graph() -> MoralGraph:
+    values = [
+        Value(ValuesData("A", ["A policy"], None), "a"),
+        Value(ValuesData("B", ["B policy"], "context"), "b"),
+    ]
+    edges = [Edge("a", "b", "context", EdgeMetadata("s", "x", {}, []))]
+    return MoralGraph(values, edges, ["q"])
+
+
+def test_json_round_trip_keeps_a_null_choice_context(tmp_path):
+    path = str(tmp_path / "graph.json")
+    _graph().save_to_file(path)
+    graph = MoralGraph.from_file(path)
+    assert [v.data.choice_context for v in graph.values] == [None, "context"]
+
+
+def test_compact_graph_keeps_a_null_choice_context():
+    graph = _graph()
+    compact = CompactMoralGraph.from_graph(graph)
+    assert [v.data.choice_context for v in compact.values] == [None, "context"]
+    copy = CompactMoralGraph(
+        compact.value_columns(), compact.edge_columns(), compact.seed_questions
+    )
+    assert copy.to_json() == graph.to_json()
+
+
+def test_binary_files_keep_a_null_choice_context(tmp_path):
+    path = str(tmp_path / "graph.mgraph")
+    _graph().save_to_file(path)
+    assert [v.data.choice_context for v in read_graph(path).values] == [
+        None,
+        "context",
+    ]
+    CompactMoralGraph.from_file(path).save_to_file(path)
+    compact = read_compact_graph(path, ["choice_context"])
+    assert [v.data.choice_context for v in compact.values] == [None, "context"]
@@ -0,0 +1,199 @@
+"""Token usage of streamed responses that are closed before their final usage chunk."""
+
+from collections import Counter
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"
+    ),
+)
+
+import pytest  # noqa: E402
+
+import hedging  # noqa: E402
+import llms  # noqa: E402
+import metrics  # noqa: E402
+import providers  # noqa: E402
+
+TEXT_CHUNKS = ["# Answer\n", "Be kind.\n", "# Notes\n", "More text.\n", "# Done\n"]
+
+
+class FakeGptStream:
+    """An OpenAI chat completion stream, which sends its usage in the last chunk."""
+
+    def __init__(self):
+        self.chunks = [
+            SimpleNamespace(
+                usage=None,
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=text))],
+            )
+            for text in TEXT_CHUNKS
+        ]
+        usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=500)
+        self.chunks.append(SimpleNamespace(usage=usage, choices=[]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+class FakeSonnetStream:
+    """An Anthropic message stream, which sends its input tokens in the first event."""
+
+    def __init__(self):
+        start = SimpleNamespace(
+            usage=SimpleNamespace(input_tokens=1000, output_tokens=1)
+        )
+        self.events = [SimpleNamespace(type="message_start", message=start)]
+        self.events += [
+            SimpleNamespace(
+                type="content_block_delta",
+                delta=SimpleNamespace(type="text_delta", text=text),
+            )
+            for text in TEXT_CHUNKS
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def get_final_message(self):
+        raise AssertionError("The stream should have been closed early")
+
+
+class FakeClient:
+    def __init__(self):
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=lambda **params: FakeGptStream())
+        )
+        self.messages = SimpleNamespace(stream=lambda **params: FakeSonnetStream())
+
+
+@pytest.fixture(autouse=True)
+def live_provider(monkeypatch):
+    monkeypatch.setattr(providers, "get_client", lambda name: FakeClient())
+    monkeypatch.setattr(providers, "_provider", providers.LiveProvider())
+
+
+def test_gpt_stream_closed_early_counts_estimated_usage():
+    token_counter = Counter()
+    response = llms.gpt4(
+        "user prompt",
+        "system prompt",
+        token_counter=token_counter,
+        caching_enabled=False,
+        required_sections=["Answer"],
+    )
+
+    assert "Be kind." in response
+    assert token_counter["prompt_tokens"] > 0
+    assert token_counter["completion_tokens"] > 0
+
+
+def test_sonnet_stream_closed_early_counts_input_tokens():
+    token_counter = Counter()
+    llms.sonnet(
+        "user prompt",
+        "system prompt",
+        token_counter=token_counter,
+        caching_enabled=False,
+        required_sections=["Answer"],
+    )
+
+    assert token_counter["sonnet_prompt_tokens"] == 1000
+    assert token_counter["sonnet_completion_tokens"] > 0
+
+
+class BrokenGptStream(FakeGptStream):
+    """A stream whose connection drops after the first chunk."""
+
+    def __iter__(self):
+        yield self.chunks[0]
+        raise ConnectionError("Connection dropped")
+
+
+def test_failed_stream_counts_estimated_usage(monkeypatch):
+    client = FakeClient()
+    client.chat.completions.create = lambda **params: BrokenGptStream()
+    monkeypatch.setattr(providers, "get_client", lambda name: client)
+    token_counter = Counter()
+    with pytest.raises(ConnectionError):
+        llms.gpt4(
+            "user prompt",
+            "system prompt",
+            token_counter=token_counter,
+            caching_enabled=False,
+            required_sections=["Answer"],
+        )
+
+    assert token_counter["prompt_tokens"] > 0
+    assert token_counter["completion_tokens"] > 0
+
+
+class SlowGptStream(FakeGptStream):
+    def __iter__(self):
+        for chunk in self.chunks:
+            time.sleep(0.05)
+            yield chunk
+
+
+def _hedge_slow_gpt(monkeypatch) -> hedging.Hedger:
+    """Make gpt calls slow and hedge them with sonnet right away."""
+    client = FakeClient()
+    client.chat.completions.create = lambda **params: SlowGptStream()
+    monkeypatch.setattr(providers, "get_client", lambda name: client)
+    tracker = hedging.LatencyTracker(min_samples=1)
+    tracker.observe(("gpt", metrics.current_stage()), 0.01)
+    hedger = hedging.Hedger(0.5, {"gpt": "sonnet"}, tracker)
+    monkeypatch.setattr(hedging, "_hedger", hedger)
+    return hedger
+
+
+def test_cancelled_hedge_loser_counts_usage(monkeypatch):
+    hedger = _hedge_slow_gpt(monkeypatch)
+    token_counter = Counter()
+    llms.gpt4(
+        "user prompt",
+        "system prompt",
+        token_counter=token_counter,
+        caching_enabled=False,
+        required_sections=["Answer"],
+    )
+
+    assert hedger.stats["gpt"]["hedge_wins"] == 1
+    # The cancelled gpt call finishes in the background.
+    deadline = time.monotonic() + 5
+    while not token_counter["prompt_tokens"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert token_counter["prompt_tokens"] > 0
+    assert token_counter["sonnet_prompt_tokens"] == 1000
+
+
+def test_response_won_by_the_hedge_is_not_cached(monkeypatch):
+    _hedge_slow_gpt(monkeypatch)
+    monkeypatch.setattr(llms, "_get_cached_response", lambda *args, **kwargs: None)
+    monkeypatch.setattr(llms, "_get_batched_response", lambda *args, **kwargs: None)
+    cached = []
+    monkeypatch.setattr(
+        llms, "_cache_response", lambda *args, **kwargs: cached.append(args)
+    )
+
+    response = llms.gpt4("user prompt", "system prompt", required_sections=["Answer"])
+
+    assert "Be kind." in response
+    assert cached == []